@@ -17,6 +17,7 @@ from xopt import VOCS
 
 from scripts.characterize_emittance import characterize_emittance
 from scripts.image import ImageDiagnostic
+from scripts.utils.hyperparameters import HyperparameterStore
 
 
 class BeamlineConfig(BaseModel):
@@ -69,6 +70,9 @@ class BaseEmittanceMeasurement(BaseModel, ABC):
     secondary_observables: list = []
     constants: dict = {}
     visualize: int = 0
+    analysis_kwargs: dict = {}
+    joint_acquisition: bool = False
+    hyperparameter_file: str = None
     _dump_file: str = None
 
     class Config:
@@ -83,6 +87,11 @@ class BaseEmittanceMeasurement(BaseModel, ABC):
     def dump_file(self):
         return self._dump_file
 
+    @property
+    def screen_name(self):
+        """name of the beam size diagnostic, used to key stored hyperparameters"""
+        return None
+
     @property
     @abstractmethod
     def x_measurement_vocs(self):
@@ -93,6 +102,18 @@ class BaseEmittanceMeasurement(BaseModel, ABC):
     def y_measurement_vocs(self):
         pass
 
+    def get_pv(self, name):
+        """read a pv, override to run against a simulated machine"""
+        return caget(name)
+
+    def get_pvs(self, names):
+        """read several pvs at once"""
+        return caget_many(names)
+
+    def set_pv(self, name, value):
+        """set a pv, override to run against a simulated machine"""
+        caput(name, value)
+
     def get_initial_points(self):
         return None
 
@@ -130,9 +151,14 @@ class BaseEmittanceMeasurement(BaseModel, ABC):
         print(f"initial data gathering took: {time.perf_counter() - start} s")
 
         # get old setting
-        old_pv_value = caget(self.beamline_config.scan_quad_pv)
+        old_pv_value = self.get_pv(self.beamline_config.scan_quad_pv)
+
+        # load hyperparameters of previous measurements to warm start model fits
+        if self.hyperparameter_file is not None:
+            hyperparameter_store = HyperparameterStore(self.hyperparameter_file)
+        else:
+            hyperparameter_store = None
 
-        
         # run scan
         try:
             emit_results, emit_Xopt = characterize_emittance(
@@ -149,6 +175,10 @@ class BaseEmittanceMeasurement(BaseModel, ABC):
                 turbo_length=self.turbo_length,
                 visualize=self.visualize,
                 dump_file=self.dump_file,
+                quad_scan_analysis_kwargs=self.analysis_kwargs,
+                joint=self.joint_acquisition,
+                hyperparameter_store=hyperparameter_store,
+                screen=self.screen_name,
             )
     
             # add self info to dump file
@@ -161,7 +191,7 @@ class BaseEmittanceMeasurement(BaseModel, ABC):
         except Exception:
             print(traceback.format_exc())
         finally:
-            caput(self.beamline_config.scan_quad_pv,old_pv_value)
+            self.set_pv(self.beamline_config.scan_quad_pv, old_pv_value)
         
         return emit_results, emit_Xopt
         
@@ -6,23 +6,24 @@ import numpy as np
 
 import pandas as pd
 import torch
-from botorch import fit_gpytorch_mll
 
 from botorch.models.gp_regression import SingleTaskGP
 from botorch.models.transforms import Normalize, Standardize
-from gpytorch import ExactMarginalLogLikelihood
 from gpytorch.kernels import MaternKernel, PolynomialKernel, ScaleKernel
-from gpytorch.likelihoods import GaussianLikelihood
+from gpytorch.likelihoods import FixedNoiseGaussianLikelihood, GaussianLikelihood
 from gpytorch.priors import GammaPrior
 from pandas import DataFrame
 from xopt import Evaluator, VOCS, Xopt
 from xopt.generators import UpperConfidenceBoundGenerator
-from xopt.generators.bayesian.models.standard import StandardModelConstructor
 from xopt.numerical_optimizer import GridOptimizer
 from emitopt.utils import get_quad_strength_conversion_factor
 
-from scripts.custom_turbo import QuadScanTurbo
+from scripts.custom_model import WarmStartModelConstructor
+from scripts.custom_turbo import JointQuadScanTurbo, QuadScanTurbo
+from scripts.utils.hyperparameters import HyperparameterStore, fit_model
+from scripts.utils.statistics import QuantileSketch, RunningStatistics
 from scripts.utils.visualization import visualize_step
+from scripts.utils.writer import AsyncWriter, write_text_file
 
 def perform_sampling(
     vocs,
@@ -34,15 +35,36 @@ def perform_sampling(
     n_iterations,
     quad_strength_key,
     initial_data=None,
-    visualize=False
+    visualize=False,
+    objective_names=None,
+    hyperparameter_store=None,
+    hyperparameter_keys=None,
 ):
+    """
+    Run the quad scan for the objective of `vocs`. If `objective_names` is given,
+    the generator minimizes these objectives in turn, one per step, with a trust
+    region that covers the minima of all of them (see `JointQuadScanTurbo`) and a
+    list with the minimum point of each objective is returned. The models of the
+    outputs in `hyperparameter_keys` are warm started from `hyperparameter_store`.
+    """
     # run points to determine emittance
     # ===================================
     
     # set up Xopt object
     # use beta to control the relative spacing between points and the observed minimum
-    turbo_controller = QuadScanTurbo(vocs, length=turbo_length)
-    model_constructor = StandardModelConstructor(use_low_noise_prior=False)
+    if objective_names is None:
+        turbo_controller = QuadScanTurbo(vocs, length=turbo_length)
+    else:
+        # the active objective is changed in place
+        vocs = deepcopy(vocs)
+        turbo_controller = JointQuadScanTurbo(
+            vocs, length=turbo_length, objective_names=objective_names
+        )
+    model_constructor = WarmStartModelConstructor(
+        hyperparameter_store=hyperparameter_store,
+        hyperparameter_keys=hyperparameter_keys,
+        use_low_noise_prior=False,
+    )
     generator = UpperConfidenceBoundGenerator(
         vocs=vocs,
         beta=100.0,
@@ -54,7 +76,14 @@ def perform_sampling(
 
     beamsize_evaluator = Evaluator(function=beamsize_evaluator)
     X = Xopt(generator=generator, evaluator=beamsize_evaluator, vocs=vocs)
-    X.options.dump_file = dump_file
+
+    # dump files are written by a background thread, the state is serialized here
+    # so that the writer never sees a partially updated Xopt object
+    writer = AsyncWriter(maxsize=2) if dump_file is not None else None
+
+    def dump_state():
+        if writer is not None:
+            writer.submit(write_text_file, dump_file, X.yaml())
 
     # add old data if specified
     if initial_data is not None:
@@ -63,6 +92,7 @@ def perform_sampling(
     # evaluate initial points if specified
     if initial_points is not None:
         X.evaluate_data(initial_points)
+    dump_state()
 
     if len(X.data) == 0:
         raise RuntimeError(
@@ -71,23 +101,34 @@ def perform_sampling(
             "to perform sampling"
         )
 
-    if visualize > 1:
-        visualize_step(X.generator, f"{X.vocs.objective_names[0]}, step:{1}")
-    X.step()
-       
     # perform exploration
-    for i in range(n_iterations - 1):
+    for i in range(n_iterations):
+        if objective_names is not None:
+            # alternate between objectives
+            vocs.objectives = {objective_names[i % len(objective_names)]: "MINIMIZE"}
         if visualize > 1:
-            visualize_step(X.generator, f"{X.vocs.objective_names[0]}, step:{i + 2}")
+            visualize_step(X.generator, f"{X.vocs.objective_names[0]}, step:{i + 1}")
         X.step()
-        
+        dump_state()
+
+    if writer is not None:
+        writer.close()
+
+    if hyperparameter_store is not None:
+        hyperparameter_store.save()
 
     # get minimum point
     turbo_controller = X.generator.turbo_controller
-    min_pt = (
-        turbo_controller.center_x, 
-        turbo_controller.best_value
-    )
+    if objective_names is None:
+        min_pt = (
+            turbo_controller.center_x, 
+            turbo_controller.best_value
+        )
+    else:
+        min_pt = [
+            (turbo_controller.centers[name], turbo_controller.best_values[name])
+            for name in objective_names
+        ]
 
     # return data
     return X.data, min_pt, X
@@ -108,6 +149,10 @@ def characterize_emittance(
     generator_kwargs: Dict = None,
     visualize: int = 0,
     dump_file: str = None,
+    quad_scan_analysis_kwargs: Dict = None,
+    joint: bool = False,
+    hyperparameter_store: HyperparameterStore = None,
+    screen: str = None,
 ):
     """
     Script to evaluate beam emittance using an automated quadrupole scan.
@@ -160,11 +205,27 @@ def characterize_emittance(
         Dictionary passed to generator to customize Bayesian Exploration.
 
     quad_scan_analysis_kwargs : dict, optional
-        Dictionary used to customize quadrupole scan analysis / emittance calculation.
+        Dictionary used to customize quadrupole scan analysis / emittance calculation,
+        passed to `analyze_data`, e.g. `{"streaming": True, "rtol": 0.01}`.
 
     dump_file : str, optional
         Filename to specify dump file for Xopt object.
 
+    joint : bool, optional
+        If True, both planes are characterized in a single scan of `n_iterations`
+        steps. One generator models both beam sizes and minimizes the objectives of
+        `xvocs` and `yvocs` in turn, within a trust region that covers both minima.
+        Default: False
+
+    hyperparameter_store : HyperparameterStore, optional
+        Store of GP hyperparameters used to warm start the model fits of the beam
+        sizes during sampling and analysis, the fitted values of this measurement
+        are saved in it. Entries are keyed by `screen`, the scan quad and the beam
+        energy of `beamline_config` and the plane.
+
+    screen : str, optional
+        Name of the screen used to measure the beam sizes.
+
     Returns
     -------
     result : dict
@@ -191,48 +252,100 @@ def characterize_emittance(
     # set up kwarg objects
     generator_kwargs = generator_kwargs or {}
 
-    # perform sampling for X
-    print("sampling points for x emittance")
-    start = time.perf_counter()
-    gen_data_x, min_pt_x, X = perform_sampling(
-        xvocs,
-        turbo_length,
-        beamsize_evaluator,
-        dump_file,
-        generator_kwargs,
-        initial_points,
-        n_iterations,
-        quad_strength_key,
-        initial_data=initial_data,
-        visualize=visualize,
-    )
-    print(f"Runtime: {time.perf_counter() - start}")
+    if hyperparameter_store is not None:
+        hyperparameter_keys = [
+            hyperparameter_store.key(
+                screen,
+                beamline_config.scan_quad_pv,
+                beamline_config.beam_energy,
+                plane,
+            )
+            for plane in ["x", "y"]
+        ]
+        sampling_kwargs = {
+            "hyperparameter_store": hyperparameter_store,
+            # constraints are modeled in both scans and stored with the x plane
+            "hyperparameter_keys": dict.fromkeys(
+                xvocs.output_names + yvocs.output_names, hyperparameter_keys[0]
+            )
+            | {rms_x_key: hyperparameter_keys[0], rms_y_key: hyperparameter_keys[1]},
+        }
+    else:
+        hyperparameter_keys = None
+        sampling_kwargs = {}
 
-    # perform sampling for Y
-    print("sampling points for y emittance")
-    start = time.perf_counter()
-    gen_data_y, min_pt_y, X = perform_sampling(
-        yvocs,
-        turbo_length,
-        beamsize_evaluator,
-        dump_file,
-        generator_kwargs,
-        None,
-        n_iterations,
-        quad_strength_key,
-        initial_data=gen_data_x,
-        visualize=visualize,
-    )
-    print(f"Runtime: {time.perf_counter() - start}")
+    if joint:
+        # model both beam sizes with the same generator
+        objective_names = xvocs.objective_names + yvocs.objective_names
+        vocs = deepcopy(xvocs)
+        vocs.observables = list(dict.fromkeys(vocs.observables + objective_names))
 
+        print("sampling points for x and y emittance")
+        start = time.perf_counter()
+        gen_data, (min_pt_x, min_pt_y), X = perform_sampling(
+            vocs,
+            turbo_length,
+            beamsize_evaluator,
+            dump_file,
+            generator_kwargs,
+            initial_points,
+            n_iterations,
+            quad_strength_key,
+            initial_data=initial_data,
+            visualize=visualize,
+            objective_names=objective_names,
+            **sampling_kwargs,
+        )
+        print(f"Runtime: {time.perf_counter() - start}")
+
+    else:
+        # perform sampling for X
+        print("sampling points for x emittance")
+        start = time.perf_counter()
+        gen_data_x, min_pt_x, X = perform_sampling(
+            xvocs,
+            turbo_length,
+            beamsize_evaluator,
+            dump_file,
+            generator_kwargs,
+            initial_points,
+            n_iterations,
+            quad_strength_key,
+            initial_data=initial_data,
+            visualize=visualize,
+            **sampling_kwargs,
+        )
+        print(f"Runtime: {time.perf_counter() - start}")
+
+        # perform sampling for Y
+        print("sampling points for y emittance")
+        start = time.perf_counter()
+        gen_data, min_pt_y, X = perform_sampling(
+            yvocs,
+            turbo_length,
+            beamsize_evaluator,
+            dump_file,
+            generator_kwargs,
+            None,
+            n_iterations,
+            quad_strength_key,
+            initial_data=gen_data_x,
+            visualize=visualize,
+            **sampling_kwargs,
+        )
+        print(f"Runtime: {time.perf_counter() - start}")
+
+    analysis_kwargs = {"visualize": visualize} | (quad_scan_analysis_kwargs or {})
     return analyze_data(
-        gen_data_y, 
+        gen_data, 
         beamline_config, 
         quad_strength_key, 
         rms_x_key, 
         rms_y_key,
         [min_pt_x, min_pt_y],
-        visualize
+        hyperparameter_store=hyperparameter_store,
+        hyperparameter_keys=hyperparameter_keys,
+        **analysis_kwargs
     ), X
 
 
@@ -243,8 +356,26 @@ def analyze_data(
     rms_x_key, 
     rms_y_key, 
     minimum_pts, 
-    visualize
+    visualize,
+    streaming=False,
+    n_samples=None,
+    chunk_size=10000,
+    rtol=None,
+    hyperparameter_store=None,
+    hyperparameter_keys=None,
 ):
+    """
+    Calculate the emittance of each plane from the quad scan data around the
+    minimum beam size. Both planes are modeled by a single batched GP, fit in one
+    hyperparameter optimization, and their emittances are computed from one
+    batched sample of the posterior. If `streaming` is set, the emittance posterior
+    is sampled in chunks with constant memory (see
+    `stream_emit_bmag_samples_from_quad_scan`), optionally stopping when the
+    quantiles have converged to `rtol`, and the standard error of the median
+    emittance is returned as `<plane>_emittance_sem`. The GP fit is warm started
+    from the hyperparameters of the planes stored under `hyperparameter_keys` in
+    `hyperparameter_store`, which are updated and saved.
+    """
     # get subset of data for analysis, drop Nan measurements
     analysis_data = deepcopy(analysis_data)[
         [quad_strength_key, rms_x_key, rms_y_key]
@@ -256,9 +387,9 @@ def analyze_data(
     name = ["x", "y"]
     beta0 = [beamline_config.design_beta_x, beamline_config.design_beta_y]
     alpha0 = [beamline_config.design_alpha_x, beamline_config.design_alpha_y]
-    
-    result = {}
 
+    # windowed focusing strengths and beam sizes of each plane
+    ks, rmss = [], []
     for i in range(2):
         # make a copy of the analysis data
         data = deepcopy(analysis_data)
@@ -292,37 +423,90 @@ def analyze_data(
         
         rms = data[key[i]].to_numpy(dtype=np.double)
 
-        # get transport matrix from quad to screen
-        rmat_quad_to_screen = torch.tensor(rmat[i]).double()
+        ks += [k]
+        rmss += [rms]
 
-        # calculate emittances (note negative sign in y-calculation)
-        print(f"creating emittance fit {name[i]}")
-        start = time.perf_counter()
-        stats = get_valid_emit_bmag_samples_from_quad_scan(
-            k,
-            rms,
-            beamline_config.scan_quad_length,
-            rmat_quad_to_screen,
-            beta0=beta0[i],
-            alpha0=alpha0[i],
-            visualize=visualize > 0,
+    # model both planes with a single batched GP
+    tkwargs = {"dtype": torch.double, "device": "cpu"}
+    rmat_quad_to_screen = torch.tensor(rmat, **tkwargs)
+    if None in beta0 + alpha0:
+        beta0 = alpha0 = None
+    else:
+        beta0 = torch.tensor(beta0, **tkwargs).reshape(2, 1, 1)
+        alpha0 = torch.tensor(alpha0, **tkwargs).reshape(2, 1, 1)
+
+    print("creating emittance fits")
+    start = time.perf_counter()
+    sample = _emittance_sampler(
+        [torch.tensor(k, **tkwargs) for k in ks],
+        [torch.tensor(rms, **tkwargs) for rms in rmss],
+        beamline_config.scan_quad_length,
+        rmat_quad_to_screen,
+        beta0=beta0,
+        alpha0=alpha0,
+        tkwargs=tkwargs,
+        hyperparameter_store=hyperparameter_store,
+        hyperparameter_keys=hyperparameter_keys,
+    )
+    if hyperparameter_store is not None:
+        hyperparameter_store.save()
+    if streaming:
+        stats = _stream_emittance_statistics(
+            sample,
+            n_samples=n_samples or 1000000,
+            chunk_size=chunk_size,
+            quantiles=(0.05, 0.5, 0.95),
+            rtol=rtol,
+            min_chunks=10,
+            with_bmag=beta0 is not None,
         )
-        print(f"Runtime: {time.perf_counter() - start}")
+    else:
+        emit, bmag, sig, is_valid = sample(n_samples or 10000)
+    print(f"Runtime: {time.perf_counter() - start}")
+
+    result = {}
+    for i in range(2):
+        if streaming:
+            emit_05, emit_50, emit_95 = stats[i]["emit_quantiles"]
+            emit_var = stats[i]["emit_var"]
+            bmag_median = stats[i]["bmag_median"]
+        else:
+            # filter on physical validity
+            emit_valid = emit[i][is_valid[i]]
+            bmag_valid = bmag[i][is_valid[i]] if bmag is not None else None
+            if visualize > 0:
+                plot_valid_thick_quad_fits(
+                    ks[i],
+                    rmss[i],
+                    beamline_config.scan_quad_length,
+                    rmat_quad_to_screen[i],
+                    emit=emit_valid,
+                    bmag=bmag_valid,
+                    sig=sig[i][is_valid[i]],
+                )
+
+            emit_05, emit_50, emit_95 = torch.quantile(
+                emit_valid.flatten(), torch.tensor([0.05, 0.5, 0.95]).to(emit_valid)
+            )
+            emit_var = torch.var(emit_valid)
+            bmag_median = (
+                torch.quantile(bmag_valid, 0.5) if bmag_valid is not None else None
+            )
 
         # return emittance results in [mm-mrad]
         gamma = beamline_config.beam_energy / 0.511e-3
         result = result | {
-            f"{name[i]}_emittance": float(gamma * torch.quantile(stats[0], 0.5)),
-            f"{name[i]}_emittance_05": float(
-                gamma * torch.quantile(stats[0], 0.05)
-            ),
-            f"{name[i]}_emittance_95": float(
-                gamma * torch.quantile(stats[0], 0.95)
-            ),
-            f"{name[i]}_emittance_var": float(torch.var(gamma * stats[0])),
+            f"{name[i]}_emittance": float(gamma * emit_50),
+            f"{name[i]}_emittance_05": float(gamma * emit_05),
+            f"{name[i]}_emittance_95": float(gamma * emit_95),
+            f"{name[i]}_emittance_var": float(gamma**2 * emit_var),
         }
-        if stats[1] is not None:
-            result[f"bmag_{name[i]}_median"] = float(torch.quantile(stats[1], 0.5))
+        if streaming:
+            result[f"{name[i]}_emittance_sem"] = float(
+                gamma * stats[i]["emit_quantiles_sem"][1]
+            )
+        if bmag_median is not None:
+            result[f"bmag_{name[i]}_median"] = float(bmag_median)
 
     return result
 
@@ -337,88 +521,150 @@ def compute_emit_bmag_thick_quad(
     A function that computes the emittance(s) corresponding to a set of quadrupole measurement scans
     using a thick quad model.
 
+    All arguments may carry leading batch dimensions `...` (e.g. planes, tuning
+    configurations or sets of virtual scans) that broadcast against each other,
+    so that many scan grids are analyzed in a single tensor program.
+
     Parameters:
-        k: 1d torch tensor of shape (n_steps_quad_scan,)
+        k: torch tensor of shape (... x n_steps_quad_scan)
             representing the measurement quad geometric focusing strengths in [m^-2]
             used in the emittance scan
 
-        y_batch: 2d torch tensor of shape (n_scans x n_steps_quad_scan),
+        y_batch: torch tensor of shape (... x n_scans x n_steps_quad_scan),
                 where each row represents the mean-square beamsize outputs in [m^2] of an emittance scan
                 with inputs given by k
 
         q_len: float defining the (longitudinal) quadrupole length or "thickness" in [m]
 
         rmat_quad_to_screen: the (fixed) 2x2 R matrix describing the transport from the end of the
-                measurement quad to the observation screen.
+                measurement quad to the observation screen, shape (... x 2 x 2).
 
         beta0: the design beta twiss parameter at the screen
 
         alpha0: the design alpha twiss parameter at the screen
 
     Returns:
-        emit: shape (n_scans x 1) containing the geometric emittance fit results for each scan
-        bmag_min: (n_scans x 1) containing the bmag corresponding to the optimal point for each scan
-        sig: shape (n_scans x 3 x 1) containing column vectors of [sig11, sig12, sig22]
-        is_valid: 1d tensor identifying physical validity of the emittance fit results
+        emit: shape (... x n_scans x 1) containing the geometric emittance fit results for each scan
+        bmag_min: (... x n_scans x 1) containing the bmag corresponding to the optimal point for each scan
+        sig: shape (... x n_scans x 3 x 1) containing column vectors of [sig11, sig12, sig22]
+        is_valid: tensor of shape (... x n_scans) identifying physical validity of the emittance fit results
 
     SOURCE PAPER: http://www-library.desy.de/preparch/desy/thesis/desy-thesis-05-014.pdf
     """
 
     # construct the A matrix from eq. (3.2) & (3.3) of source paper
-    quad_rmats = build_quad_rmat(k, q_len)  # result shape (len(k) x 2 x 2)
-    total_rmats = (
-        rmat_quad_to_screen.reshape(1, 2, 2) @ quad_rmats
-    )  # result shape (len(k) x 2 x 2)
-
-    amat = torch.tensor([])  # prepare the A matrix
-    for rmat in total_rmats:
-        r11, r12 = rmat[0, 0], rmat[0, 1]
-        amat = torch.cat(
-            (amat, torch.tensor([[r11**2, 2.0 * r11 * r12, r12**2]])), dim=0
-        )
-    # amat result shape (len(k) x 3)
+    total_rmats, amat = _thick_quad_amat(k, q_len, rmat_quad_to_screen)
 
     # get sigma matrix elements just before measurement quad from pseudo-inverse
-    sig = amat.pinverse().unsqueeze(0) @ y_batch.unsqueeze(
+    sig = torch.linalg.pinv(amat).unsqueeze(-3) @ y_batch.unsqueeze(
         -1
-    )  # shapes (1 x 3 x len(k)) @ (n_scans x len(k) x 1)
-    # result shape (n_scans x 3 x 1) containing column vectors of [sig11, sig12, sig22]
+    )  # shapes (... x 1 x 3 x n_steps_quad_scan) @ (... x n_scans x n_steps_quad_scan x 1)
+    # result shape (... x n_scans x 3 x 1) containing column vectors of [sig11, sig12, sig22]
+
+    emit, bmag_min, is_valid = _emit_bmag_from_sig(sig, total_rmats, beta0, alpha0)
+
+    return emit, bmag_min, sig, is_valid
+
+
+def compute_emit_bmag_quadratic(
+    coefficients, k, q_len, rmat_quad_to_screen, beta0=1.0, alpha0=0.0
+):
+    """
+    Computes the emittance(s) of quad scans whose mean-square beam sizes are given
+    analytically as quadratic polynomials of the focusing strength, see
+    `sample_quad_scan_polynomials`. Equivalent to calling
+    `compute_emit_bmag_thick_quad` with the polynomials evaluated at `k`, but the
+    sigma matrix of each scan is obtained from its 3 coefficients with a single
+    3 x 3 map, independent of the number of scan steps.
+
+    Parameters:
+        coefficients: torch tensor of shape (... x n_scans x 3) containing the
+            coefficients c0, c1, c2 of the mean-square beam sizes
+            c0 + c1 * k + c2 * k**2 in [m^2]
+
+        k: torch tensor of shape (... x n_steps_quad_scan), the focusing strengths
+            in [m^-2] of the virtual scan, used to fit the sigma matrix and to find
+            the minimum bmag
+
+        q_len, rmat_quad_to_screen, beta0, alpha0: see `compute_emit_bmag_thick_quad`
+
+    Returns:
+        emit, bmag_min, sig, is_valid: see `compute_emit_bmag_thick_quad`
+    """
+    total_rmats, amat = _thick_quad_amat(k, q_len, rmat_quad_to_screen)
+
+    # map from polynomial coefficients to sigma matrix elements
+    vandermonde = torch.stack((torch.ones_like(k), k, k**2), dim=-1)
+    sig_map = torch.linalg.pinv(amat) @ vandermonde  # result shape (... x 3 x 3)
+    sig = sig_map.unsqueeze(-3) @ coefficients.unsqueeze(-1)
+    # result shape (... x n_scans x 3 x 1)
+
+    emit, bmag_min, is_valid = _emit_bmag_from_sig(sig, total_rmats, beta0, alpha0)
+
+    return emit, bmag_min, sig, is_valid
+
+
+def _thick_quad_amat(k, q_len, rmat_quad_to_screen):
+    """
+    transport matrices from the quad entrance to the screen, shape (... x
+    n_steps_quad_scan x 2 x 2), and the A matrix, shape (... x n_steps_quad_scan x 3)
+    """
+    quad_rmats = build_quad_rmat(k.flatten(), q_len).reshape(*k.shape, 2, 2)
+    total_rmats = rmat_quad_to_screen.unsqueeze(-3) @ quad_rmats
+
+    r11, r12 = total_rmats[..., 0, 0], total_rmats[..., 0, 1]
+    amat = torch.stack((r11**2, 2.0 * r11 * r12, r12**2), dim=-1)
+
+    return total_rmats, amat
+
+
+def _emit_bmag_from_sig(sig, total_rmats, beta0, alpha0):
+    """
+    emittance, minimum bmag along the scan and physical validity from sigma matrix
+    elements of shape (... x n_scans x 3 x 1)
+    """
+    sig11, sig12, sig22 = sig[..., 0, 0], sig[..., 1, 0], sig[..., 2, 0]
 
     # compute emit
-    emit = torch.sqrt(sig[:, 0, 0] * sig[:, 2, 0] - sig[:, 1, 0] ** 2).reshape(
-        -1, 1
-    )  # result shape (n_scans x 1)
+    emit = torch.sqrt(sig11 * sig22 - sig12**2).unsqueeze(
+        -1
+    )  # result shape (... x n_scans x 1)
 
     # check sigma matrix and emit for physical validity
-    is_valid = torch.logical_and(sig[:, 0, 0] > 0, sig[:, 2, 0] > 0)  # result 1d tensor
-    is_valid = torch.logical_and(
-        is_valid, ~torch.isnan(emit.flatten())
-    )  # result 1d tensor
-
-    # propagate beam parameters to screen
-    twiss_at_screen = propagate_sig(sig, emit, total_rmats)[1]
-    # result shape (n_scans x len(k) x 3 x 1)
+    is_valid = torch.logical_and(sig11 > 0, sig22 > 0)
+    is_valid = torch.logical_and(is_valid, ~torch.isnan(emit[..., 0]))
+    # result shape (... x n_scans)
 
     if alpha0 is not None and beta0 is not None:
         # get design gamma0 from design beta0, alpha0
         gamma0 = (1 + alpha0**2) / beta0
 
-        # compute bmag
-        bmag = 0.5 * (
-            twiss_at_screen[:, :, 0, 0] * gamma0
-            - 2 * twiss_at_screen[:, :, 1, 0] * alpha0
-            + twiss_at_screen[:, :, 2, 0] * beta0
-        )
-        # result shape (n_scans, n_steps_quad_scan)
+        # bmag at the screen is linear in the sigma matrix elements at the quad,
+        # 2 * emit * bmag = gamma0 * s11 + 2 * alpha0 * s12 + beta0 * s22 where s is
+        # the beam matrix at the screen, s = R sig R^T
+        r11, r12 = total_rmats[..., 0, 0], total_rmats[..., 0, 1]
+        r21, r22 = total_rmats[..., 1, 0], total_rmats[..., 1, 1]
+        weights = (
+            gamma0 * torch.stack((r11**2, 2 * r11 * r12, r12**2), dim=-1)
+            + 2
+            * alpha0
+            * torch.stack((r11 * r21, r11 * r22 + r12 * r21, r12 * r22), dim=-1)
+            + beta0 * torch.stack((r21**2, 2 * r21 * r22, r22**2), dim=-1)
+        )  # result shape (... x n_steps_quad_scan x 3)
+
+        bmag = (sig.transpose(-1, -2) @ weights.transpose(-1, -2).unsqueeze(-3))[
+            ..., 0, :
+        ] / (2 * emit)
+        # result shape (... x n_scans x n_steps_quad_scan)
 
         # select minimum bmag from quad scan
         bmag_min, bmag_min_id = torch.min(
-            bmag, dim=1, keepdim=True
-        )  # result shape (n_scans, 1)
+            bmag, dim=-1, keepdim=True
+        )  # result shape (... x n_scans x 1)
     else:
         bmag_min = None
 
-    return emit, bmag_min, sig, is_valid
+    return emit, bmag_min, is_valid
 
 
 def get_valid_emit_bmag_samples_from_quad_scan(
@@ -433,6 +679,7 @@ def get_valid_emit_bmag_samples_from_quad_scan(
     covar_module=None,
     visualize=False,
     tkwargs=None,
+    weight_space=True,
 ):
     """
     A function that produces a distribution of possible (physically valid) emittance values corresponding
@@ -440,6 +687,11 @@ def get_valid_emit_bmag_samples_from_quad_scan(
     scan samples are then drawn from the model posterior, the samples are modeled by thick-quad transport
     to obtain fits to the beam parameters, and physically invalid results are discarded.
 
+    With the (default) quadratic kernel and `weight_space` set, the posterior is
+    sampled in weight space (see `sample_quad_scan_polynomials`) and the virtual
+    scans are passed to the thick-quad fit analytically, which makes large numbers
+    of samples (10^6) practical.
+
     Parameters:
 
         k: 1d numpy array of shape (n_steps_quad_scan,)
@@ -471,6 +723,9 @@ def get_valid_emit_bmag_samples_from_quad_scan(
 
         tkwargs: dict containing the tensor device and dtype
 
+        weight_space: boolean. Set to False to always sample virtual scans on the
+                    k grid from the GP posterior.
+
     Returns:
         emits_valid: a tensor of physically valid emittance results from sampled measurement scans.
 
@@ -490,23 +745,19 @@ def get_valid_emit_bmag_samples_from_quad_scan(
     k = torch.tensor(k, **tkwargs)
     y = torch.tensor(y, **tkwargs)
 
-    k_virtual, bss = fit_gp_quad_scan(
-        k=k,
-        y=y,
-        n_samples=n_samples,
+    sample = _emittance_sampler(
+        k,
+        y,
+        q_len,
+        rmat_quad_to_screen,
+        beta0=beta0,
+        alpha0=alpha0,
         n_steps_quad_scan=n_steps_quad_scan,
         covar_module=covar_module,
+        weight_space=weight_space,
         tkwargs=tkwargs,
     )
-
-    (emit, bmag, sig, is_valid) = compute_emit_bmag_thick_quad(
-        k=k_virtual,
-        y_batch=bss,
-        q_len=q_len,
-        rmat_quad_to_screen=rmat_quad_to_screen,
-        beta0=beta0,
-        alpha0=alpha0,
-    )
+    emit, bmag, sig, is_valid = sample(n_samples)
 
     sample_validity_rate = (torch.sum(is_valid) / is_valid.shape[0]).reshape(1)
 
@@ -533,6 +784,256 @@ def get_valid_emit_bmag_samples_from_quad_scan(
     return emit_valid, bmag_valid, sig_valid, sample_validity_rate
 
 
+def stream_emit_bmag_samples_from_quad_scan(
+    k,
+    y,
+    q_len,
+    rmat_quad_to_screen,
+    beta0=1.0,
+    alpha0=0.0,
+    n_samples=1000000,
+    chunk_size=10000,
+    n_steps_quad_scan=10,
+    covar_module=None,
+    quantiles=(0.05, 0.5, 0.95),
+    rtol=None,
+    min_chunks=10,
+    tkwargs=None,
+    weight_space=True,
+):
+    """
+    Streaming version of `get_valid_emit_bmag_samples_from_quad_scan` that uses
+    constant memory regardless of `n_samples`. Virtual scans are drawn from the
+    model posterior in chunks of `chunk_size`, physically invalid results are
+    discarded per chunk and only running quantile sketches, mean and variance of
+    the valid emittances (and minimum bmags) are kept.
+
+    The standard error of each emittance quantile is estimated from the spread of
+    the quantiles of the individual chunks (batch means). If `rtol` is given,
+    sampling stops early once the standard errors of all quantiles are below
+    `rtol` times the quantiles, after at least `min_chunks` chunks.
+
+    Parameters:
+
+        k, y, q_len, rmat_quad_to_screen, beta0, alpha0, n_steps_quad_scan,
+        covar_module, tkwargs, weight_space:
+            see `get_valid_emit_bmag_samples_from_quad_scan`
+
+        n_samples: the maximum number of virtual measurement scan samples
+
+        chunk_size: the number of samples drawn and analyzed at once
+
+        quantiles: emittance quantiles to estimate
+
+        rtol: relative standard error of the quantiles at which sampling stops
+
+        min_chunks: the minimum number of chunks drawn when `rtol` is given
+
+    Returns:
+        dict containing
+            emit_quantiles: numpy array of the geometric emittance quantiles
+            emit_quantiles_sem: numpy array of the standard errors of the quantiles
+            emit_mean: mean of the geometric emittance
+            emit_var: variance of the geometric emittance
+            bmag_median: median of the minimum bmag (None without design twiss)
+            sample_validity_rate: fraction of physically valid samples
+            n_samples: the number of samples drawn
+    """
+    if tkwargs is None:
+        tkwargs = {"dtype": torch.double, "device": "cpu"}
+
+    k = torch.tensor(k, **tkwargs)
+    y = torch.tensor(y, **tkwargs)
+
+    sample = _emittance_sampler(
+        k,
+        y,
+        q_len,
+        rmat_quad_to_screen,
+        beta0=beta0,
+        alpha0=alpha0,
+        n_steps_quad_scan=n_steps_quad_scan,
+        covar_module=covar_module,
+        weight_space=weight_space,
+        tkwargs=tkwargs,
+    )
+
+    return _stream_emittance_statistics(
+        sample,
+        n_samples=n_samples,
+        chunk_size=chunk_size,
+        quantiles=quantiles,
+        rtol=rtol,
+        min_chunks=min_chunks,
+        with_bmag=beta0 is not None and alpha0 is not None,
+    )[0]
+
+
+def _stream_emittance_statistics(
+    sample, n_samples, chunk_size, quantiles, rtol, min_chunks, with_bmag
+):
+    """
+    draw chunks from an emittance sampler (see `_emittance_sampler`) and collect
+    the statistics returned by `stream_emit_bmag_samples_from_quad_scan`, returns
+    one dictionary per quad scan of a batched sampler
+    """
+    n_valid = None
+
+    n_drawn = 0
+    while n_drawn < n_samples:
+        n_chunk = min(chunk_size, n_samples - n_drawn)
+        emit, bmag, _, is_valid = sample(n_chunk)
+        n_drawn += n_chunk
+
+        # flatten leading scan dimensions, result shape (n_scans x n_chunk)
+        emit = emit[..., 0].reshape(-1, n_chunk).cpu().numpy()
+        is_valid = is_valid.reshape(-1, n_chunk).cpu().numpy()
+        if bmag is not None:
+            bmag = bmag[..., 0].reshape(-1, n_chunk).cpu().numpy()
+
+        if n_valid is None:
+            n_scans = len(emit)
+            emit_sketches = [QuantileSketch() for _ in range(n_scans)]
+            bmag_sketches = [QuantileSketch() for _ in range(n_scans)]
+            emit_statistics = [RunningStatistics() for _ in range(n_scans)]
+            chunk_statistics = [RunningStatistics() for _ in range(n_scans)]
+            n_valid = np.zeros(n_scans, dtype=int)
+
+        converged = True
+        for i in range(len(emit)):
+            # filter on physical validity
+            emit_valid = emit[i][is_valid[i]]
+            n_valid[i] += len(emit_valid)
+            if len(emit_valid):
+                emit_sketches[i].update(emit_valid)
+                emit_statistics[i].update_batch(emit_valid)
+                chunk_statistics[i].update(np.quantile(emit_valid, quantiles))
+                if bmag is not None:
+                    bmag_sketches[i].update(bmag[i][is_valid[i]])
+
+            if rtol is None or chunk_statistics[i].count < min_chunks:
+                converged = False
+            else:
+                sem = chunk_statistics[i].std / np.sqrt(chunk_statistics[i].count)
+                quantile_values = emit_sketches[i].quantile(quantiles)
+                converged &= bool(np.all(sem < rtol * np.abs(quantile_values)))
+
+        if converged:
+            break
+
+    results = []
+    for i in range(len(n_valid)):
+        result = {
+            "emit_quantiles": emit_sketches[i].quantile(quantiles),
+            "emit_quantiles_sem": np.full(len(quantiles), np.nan),
+            "emit_mean": np.nan,
+            "emit_var": np.nan,
+            "bmag_median": None,
+            "sample_validity_rate": n_valid[i] / n_drawn,
+            "n_samples": n_drawn,
+        }
+        if n_valid[i]:
+            result["emit_mean"] = float(emit_statistics[i].mean)
+            result["emit_var"] = float(emit_statistics[i].variance)
+        if chunk_statistics[i].count > 1:
+            result["emit_quantiles_sem"] = chunk_statistics[i].std / np.sqrt(
+                chunk_statistics[i].count
+            )
+        if with_bmag:
+            result["bmag_median"] = float(bmag_sketches[i].quantile(0.5))
+        results += [result]
+
+    return results
+
+
+def _emittance_sampler(
+    k,
+    y,
+    q_len,
+    rmat_quad_to_screen,
+    beta0=1.0,
+    alpha0=0.0,
+    n_steps_quad_scan=10,
+    covar_module=None,
+    weight_space=True,
+    tkwargs=None,
+    hyperparameter_store=None,
+    hyperparameter_keys=None,
+):
+    """
+    fit a GP model to a quad scan, returns a function that draws virtual scans from
+    the model posterior and returns the outputs of `compute_emit_bmag_thick_quad`
+    for them
+
+    If `k` and `y` are lists of quad scans (e.g. one per plane) a single batched
+    model is fit to all scans and the outputs carry a leading scan dimension, in
+    that case `rmat_quad_to_screen` is of shape (n_scans x 2 x 2) and `beta0`,
+    `alpha0` are tensors of shape (n_scans x 1 x 1)
+
+    The fit is warm started from `hyperparameter_store`, with one key in
+    `hyperparameter_keys` per scan (or a single key), see `fit_model`
+    """
+    if isinstance(k, (list, tuple)):
+        k_virtual = torch.stack(
+            [
+                torch.linspace(ele.min(), ele.max(), n_steps_quad_scan, **tkwargs)
+                for ele in k
+            ]
+        )
+        model, k = _fit_batched_quad_scan_model(
+            k, y, covar_module, hyperparameter_store, hyperparameter_keys
+        )
+    else:
+        k_virtual = torch.linspace(k.min(), k.max(), n_steps_quad_scan, **tkwargs)
+        model = None
+
+    if weight_space and (covar_module is None or is_quadratic_kernel(covar_module)):
+        if model is None:
+            sample_polynomials = quad_scan_polynomial_sampler(
+                k=k,
+                y=y,
+                covar_module=covar_module,
+                tkwargs=tkwargs,
+                hyperparameter_store=hyperparameter_store,
+                hyperparameter_key=hyperparameter_keys,
+            )
+        else:
+            sample_polynomials = _polynomial_sampler(model, k)
+
+        def sample(n_samples):
+            return compute_emit_bmag_quadratic(
+                coefficients=sample_polynomials(n_samples),
+                k=k_virtual,
+                q_len=q_len,
+                rmat_quad_to_screen=rmat_quad_to_screen,
+                beta0=beta0,
+                alpha0=alpha0,
+            )
+
+    else:
+        if model is None:
+            model = _fit_quad_scan_model(
+                k, y, covar_module, hyperparameter_store, hyperparameter_keys
+            )
+        posterior = model.posterior(k_virtual.unsqueeze(-1))
+
+        def sample(n_samples):
+            with torch.no_grad():
+                bss = posterior.sample(torch.Size([n_samples]))
+            # move the sample dimension behind the scan dimension
+            bss = bss.squeeze(-1).movedim(0, -2)
+            return compute_emit_bmag_thick_quad(
+                k=k_virtual,
+                y_batch=bss,
+                q_len=q_len,
+                rmat_quad_to_screen=rmat_quad_to_screen,
+                beta0=beta0,
+                alpha0=alpha0,
+            )
+
+    return sample
+
+
 def plot_valid_thick_quad_fits(
     k, y, q_len, rmat_quad_to_screen, emit, bmag, sig, ci=0.95, tkwargs=None
 ):
@@ -626,6 +1127,8 @@ def fit_gp_quad_scan(
     n_steps_quad_scan=10,
     covar_module=None,
     tkwargs=None,
+    hyperparameter_store=None,
+    hyperparameter_key=None,
 ):
     """
     A function that fits a GP model to an emittance beam size measurement quad scan
@@ -653,6 +1156,10 @@ def fit_gp_quad_scan(
 
         n_steps_quad_scan: the number of steps in our virtual measurement scans
 
+        hyperparameter_store: HyperparameterStore used to warm start the fit from
+                    the hyperparameters stored under `hyperparameter_key`, the
+                    fitted values are recorded in the store
+
 
     Returns:
         k_virtual: a 1d tensor representing the inputs for the virtual measurement scans.
@@ -668,6 +1175,174 @@ def fit_gp_quad_scan(
     k = torch.tensor(k, **tkwargs)
     y = torch.tensor(y, **tkwargs)
 
+    model = _fit_quad_scan_model(
+        k, y, covar_module, hyperparameter_store, hyperparameter_key
+    )
+
+    k_virtual = torch.linspace(k.min(), k.max(), n_steps_quad_scan, **tkwargs)
+
+    p = model.posterior(k_virtual.reshape(-1, 1))
+    bss = p.sample(torch.Size([n_samples])).reshape(-1, n_steps_quad_scan)
+
+    return k_virtual, bss
+
+
+def sample_quad_scan_polynomials(
+    k,
+    y,
+    n_samples=10000,
+    covar_module=None,
+    tkwargs=None,
+):
+    """
+    Fits the same GP model as `fit_gp_quad_scan` to a quad scan and samples the
+    posterior of the beam size squared in weight space. With the quadratic kernel
+    ScaleKernel(PolynomialKernel(2)) the GP is a Bayesian quadratic regression, the
+    3 weights of the regression are sampled from their Gaussian posterior instead
+    of sampling functions on a grid of virtual scan points. The cost of sampling is
+    independent of the number of virtual scan steps.
+
+    Parameters:
+
+        k: 1d numpy array of shape (n_steps_quad_scan,)
+        representing the measurement quad geometric focusing strengths in [m^-2]
+        used in the emittance scan
+
+        y: 1d numpy array of shape (n_steps_quad_scan, )
+            representing the root-mean-square beam size measurements in [m] of an emittance scan
+            with inputs given by k
+
+        n_samples: the number of posterior samples
+
+        covar_module: the covariance module to be used in fitting of the SingleTaskGP,
+                    must be a ScaleKernel(PolynomialKernel(2)). If None, uses the
+                    default kernel of `fit_gp_quad_scan`.
+
+        tkwargs: dict containing the tensor device and dtype
+
+    Returns:
+        coefficients: a tensor of shape (n_samples x 3) where each row contains the
+        coefficients c0, c1, c2 of a sampled beam size squared c0 + c1 * k + c2 * k**2
+        in [m^2]
+    """
+    return quad_scan_polynomial_sampler(
+        k=k, y=y, covar_module=covar_module, tkwargs=tkwargs
+    )(n_samples)
+
+
+def quad_scan_polynomial_sampler(
+    k,
+    y,
+    covar_module=None,
+    tkwargs=None,
+    hyperparameter_store=None,
+    hyperparameter_key=None,
+):
+    """
+    fit the quad scan GP model and compute the posterior of its weights, returns a
+    function that draws `n_samples` sets of coefficients, see
+    `sample_quad_scan_polynomials`
+    """
+    if tkwargs is None:
+        tkwargs = {"dtype": torch.double, "device": "cpu"}
+
+    if covar_module is not None and not is_quadratic_kernel(covar_module):
+        raise ValueError(
+            "weight space sampling requires a ScaleKernel(PolynomialKernel(2)) "
+            f"covariance module, got {covar_module}"
+        )
+
+    k = torch.as_tensor(k, **tkwargs)
+    y = torch.as_tensor(y, **tkwargs)
+
+    model = _fit_quad_scan_model(
+        k, y, covar_module, hyperparameter_store, hyperparameter_key
+    )
+
+    return _polynomial_sampler(model, k)
+
+
+def _polynomial_sampler(model, k):
+    """
+    compute the posterior of the weights of a quad scan GP model with a quadratic
+    kernel fit to the focusing strengths `k` of shape (batch_shape x n_points),
+    returns a function that draws coefficients of shape
+    (batch_shape x n_samples x 3), see `sample_quad_scan_polynomials`
+    """
+    model.eval()
+    tkwargs = {"dtype": k.dtype, "device": k.device}
+
+    # kernel s * (x x' + c)^2 of normalized inputs x corresponds to the features
+    # sqrt(s) * [x^2, sqrt(2 c) x, c] with standard normal weights
+    outputscale = model.covar_module.outputscale.detach().unsqueeze(-1)
+    offset = model.covar_module.base_kernel.offset.detach()
+    scales = outputscale.sqrt() * torch.cat(
+        (torch.ones_like(offset), (2 * offset).sqrt(), offset), dim=-1
+    )  # result shape (batch_shape x 3)
+
+    x = model.input_transform(k.unsqueeze(-1)).squeeze(-1)
+    features = torch.stack((x**2, x, torch.ones_like(x)), dim=-1) * scales.unsqueeze(
+        -2
+    )  # result shape (batch_shape x n_points x 3)
+
+    # posterior of the weights given the standardized training targets
+    mean = model.mean_module.constant.detach().unsqueeze(-1)
+    noise = model.likelihood.noise.detach()
+    precision = features.transpose(-1, -2) @ (
+        features / noise.unsqueeze(-1)
+    ) + torch.eye(3, **tkwargs)
+    covariance = torch.linalg.inv(precision)
+    weight_mean = (
+        covariance
+        @ features.transpose(-1, -2)
+        @ ((model.train_targets - mean) / noise).unsqueeze(-1)
+    ).squeeze(-1)  # result shape (batch_shape x 3)
+
+    weight_cholesky = torch.linalg.cholesky(covariance)
+
+    # undo the input normalization x = (k - o) / a and the outcome standardization
+    o = model.input_transform.offset[..., 0, :]
+    a = model.input_transform.coefficient[..., 0, :]
+    y_mean = model.outcome_transform.means[..., 0, :]
+    y_std = model.outcome_transform.stdvs[..., 0, :]
+
+    def sample(n_samples):
+        weights = weight_mean.unsqueeze(-2) + torch.randn(
+            *weight_mean.shape[:-1], n_samples, 3, **tkwargs
+        ) @ weight_cholesky.transpose(-1, -2)
+
+        # coefficients of the standardized function of normalized inputs
+        d = weights * scales.unsqueeze(-2)
+        d0, d1, d2 = d[..., 2] + mean, d[..., 1], d[..., 0]
+
+        return torch.stack(
+            (
+                y_std * (d0 - d1 * o / a + d2 * o**2 / a**2) + y_mean,
+                y_std * (d1 / a - 2 * d2 * o / a**2),
+                y_std * d2 / a**2,
+            ),
+            dim=-1,
+        )
+
+    return sample
+
+
+def is_quadratic_kernel(covar_module):
+    """check if a covariance module is ScaleKernel(PolynomialKernel(2))"""
+    return (
+        isinstance(covar_module, ScaleKernel)
+        and isinstance(covar_module.base_kernel, PolynomialKernel)
+        and covar_module.base_kernel.power == 2
+    )
+
+
+def _fit_quad_scan_model(
+    k, y, covar_module=None, hyperparameter_store=None, hyperparameter_key=None
+):
+    """
+    fit a GP model of the beam size squared vs. focusing strength, warm started
+    from `hyperparameter_store` if given
+    """
     if covar_module is None:
         covar_module = ScaleKernel(
             PolynomialKernel(2), outputscale_prior=GammaPrior(2.0, 0.15)
@@ -683,12 +1358,84 @@ def fit_gp_quad_scan(
             noise_prior=GammaPrior(1.0, 1.0),
         ),
     )
-    mll = ExactMarginalLogLikelihood(model.likelihood, model)
-    fit_gpytorch_mll(mll)
+    return fit_model(
+        model, hyperparameter_store, hyperparameter_key, label="analysis"
+    )
 
-    k_virtual = torch.linspace(k.min(), k.max(), n_steps_quad_scan, **tkwargs)
 
-    p = model.posterior(k_virtual.reshape(-1, 1))
-    bss = p.sample(torch.Size([n_samples])).reshape(-1, n_steps_quad_scan)
+# fixed noise of padding points of batched quad scan models, in units of the
+# standardized targets
+_PADDING_NOISE = 1e6
 
-    return k_virtual, bss
+
+def _fit_batched_quad_scan_model(
+    k, y, covar_module=None, hyperparameter_store=None, hyperparameter_keys=None
+):
+    """
+    fit a GP model of the beam size squared vs. focusing strength to several quad
+    scans (e.g. one per plane) at once, with one batch of hyperparameters per scan
+    optimized in a single fit. Returns the model and the (padded) focusing
+    strengths of shape (n_scans x n_points).
+
+    Scans with fewer points are padded with points at their first focusing
+    strength that have a large fixed noise, so that they do not contribute to the
+    fit or the posterior of their scan. The padding targets keep the mean and
+    standard deviation of each scan, which leaves the outcome standardization (and
+    with it the effect of the hyperparameter priors) unchanged. The fit of each
+    scan is warm started from `hyperparameter_store` if given.
+    """
+    batch_shape = torch.Size([len(k)])
+    n_points = max(len(ele) for ele in k)
+
+    # a single padding point cannot preserve the standard deviation
+    if any(n_points - len(ele) == 1 for ele in k):
+        n_points += 2
+
+    if covar_module is None:
+        covar_module = ScaleKernel(
+            PolynomialKernel(2, batch_shape=batch_shape),
+            batch_shape=batch_shape,
+            outputscale_prior=GammaPrior(2.0, 0.15),
+        )
+
+    train_x, train_y, padding = [], [], []
+    for k_scan, y_scan in zip(k, y):
+        n_padding = n_points - len(k_scan)
+        train_x += [torch.cat((k_scan, k_scan[:1].expand(n_padding)))]
+        train_y += [
+            torch.cat((y_scan.pow(2), _padding_targets(y_scan.pow(2), n_padding)))
+        ]
+        padding += [torch.arange(n_points) >= len(k_scan)]
+    train_x = torch.stack(train_x)
+    train_y = torch.stack(train_y)
+
+    fixed_noise = torch.stack(padding).to(train_y) * _PADDING_NOISE
+
+    model = SingleTaskGP(
+        train_x.unsqueeze(-1),
+        train_y.unsqueeze(-1),
+        covar_module=covar_module,
+        input_transform=Normalize(1, batch_shape=batch_shape),
+        outcome_transform=Standardize(1, batch_shape=batch_shape),
+        likelihood=FixedNoiseGaussianLikelihood(
+            noise=fixed_noise,
+            learn_additional_noise=True,
+            batch_shape=batch_shape,
+            noise_prior=GammaPrior(1.0, 1.0),
+        ),
+    )
+    fit_model(model, hyperparameter_store, hyperparameter_keys, label="analysis")
+
+    return model, train_x
+
+
+def _padding_targets(y, n_padding):
+    """
+    `n_padding` values that leave the mean and the (unbiased) standard deviation
+    of `y` unchanged when appended to it, `n_padding` must not be 1
+    """
+    n_pairs = n_padding // 2
+    deviation = y.std() * (n_padding / max(2 * n_pairs, 1)) ** 0.5
+    signs = torch.tensor([1.0, -1.0]).to(y).repeat(n_pairs)
+
+    return y.mean() + torch.cat((torch.zeros(n_padding % 2).to(y), signs * deviation))
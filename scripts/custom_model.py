@@ -0,0 +1,71 @@
+from typing import Dict, List, Union
+
+import pandas as pd
+import torch
+from botorch.models import ModelListGP, SingleTaskGP
+from pydantic import PrivateAttr
+from xopt.generators.bayesian.models.standard import StandardModelConstructor
+
+from scripts.utils.hyperparameters import HyperparameterStore, fit_model
+
+
+class WarmStartModelConstructor(StandardModelConstructor):
+    """
+    Standard model constructor that warm starts the fits of the outcomes in
+    `hyperparameter_keys` (a dict of outcome names and store keys) from the
+    hyperparameters in `hyperparameter_store` and records the fitted values in it.
+    The store is not serialized with the generator, a dumped constructor is loaded
+    as a standard model constructor.
+    """
+
+    _hyperparameter_store: HyperparameterStore = PrivateAttr(None)
+    _hyperparameter_keys: Dict[str, str] = PrivateAttr({})
+    _outcome_name: str = PrivateAttr(None)
+
+    def __init__(
+        self,
+        hyperparameter_store: HyperparameterStore = None,
+        hyperparameter_keys: Dict[str, str] = None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self._hyperparameter_store = hyperparameter_store
+        self._hyperparameter_keys = hyperparameter_keys or {}
+
+    def build_model(
+        self,
+        input_names: List[str],
+        outcome_names: List[str],
+        data: pd.DataFrame,
+        input_bounds: Dict[str, List] = None,
+        dtype: torch.dtype = torch.double,
+        device: Union[torch.device, str] = "cpu",
+    ) -> ModelListGP:
+        # build the models one outcome at a time to know which outcome is fit
+        models = []
+        for name in outcome_names:
+            self._outcome_name = name
+            models += super().build_model(
+                input_names, [name], data, input_bounds, dtype, device
+            ).models
+        self._outcome_name = None
+
+        return ModelListGP(*models)
+
+    def build_single_task_gp(self, train_X, train_Y, **kwargs):
+        key = self._hyperparameter_keys.get(self._outcome_name)
+        if self._hyperparameter_store is None or key is None:
+            return StandardModelConstructor.build_single_task_gp(
+                train_X, train_Y, **kwargs
+            )
+
+        if train_X.shape[0] == 0 or train_Y.shape[0] == 0:
+            raise ValueError("no data found to train model!")
+        model = SingleTaskGP(train_X, train_Y, **kwargs)
+
+        return fit_model(
+            model,
+            self._hyperparameter_store,
+            key,
+            label=f"sampling:{self._outcome_name}",
+        )
@@ -1,3 +1,5 @@
+from typing import Dict, List
+
 import numpy as np
 import pandas as pd
 import torch
@@ -14,15 +16,22 @@ class QuadScanTurbo(OptimizeTurboController):
         if self.center_x is None:
             raise RuntimeError("need to set best point first, call `update_state`")
 
+        return self._trust_region(model.models[0], self.center_x)
+
+    def _trust_region(self, objective_model, center_x):
+        """
+        trust region around `center_x` proportional to the lengthscales of
+        `objective_model`
+        """
         # get bounds width
         bounds = torch.tensor(self.vocs.bounds, **self.tkwargs)
         bound_widths = bounds[1] - bounds[0]
 
         # Scale the TR to be proportional to the lengthscales of the objective model
         x_center = torch.tensor(
-            [self.center_x[ele] for ele in self.vocs.variable_names], **self.tkwargs
+            [center_x[ele] for ele in self.vocs.variable_names], **self.tkwargs
         )
-        lengthscales = model.models[0].covar_module.base_kernel.lengthscale.detach()
+        lengthscales = objective_model.covar_module.base_kernel.lengthscale.detach()
 
         # calculate the ratios of lengthscales for each axis
         weights = lengthscales / torch.prod(lengthscales) ** (1 / self.dim)
@@ -70,13 +79,19 @@ class QuadScanTurbo(OptimizeTurboController):
             self._set_best_point(data[feas_data["feasible"]])
 
     def _set_best_point(self, data):
+        self.center_x, self.best_value = self._best_point(
+            data, self.vocs.objective_names[0]
+        )
+
+    def _best_point(self, data, objective_name):
+        """location and value of the best (mean) measurement of an objective"""
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
         
             # aggregate data to get the mean value
             mean_pivot_table = pd.pivot_table(
                 data,
-                values=self.vocs.objective_names[0],
+                values=objective_name,
                 columns=self.vocs.variable_names,
                 aggfunc=np.mean,
             )
@@ -101,5 +116,52 @@ class QuadScanTurbo(OptimizeTurboController):
     
             # get location and value of best (mean) point so far
             best_idx = mean_pivot_table.to_numpy().argmin()
-            self.center_x = {mean_pivot_table.index.name: mean_pivot_table.index[best_idx]}
-            self.best_value = mean_pivot_table.to_numpy().min()
+            center_x = {mean_pivot_table.index.name: mean_pivot_table.index[best_idx]}
+            best_value = mean_pivot_table.to_numpy().min()
+
+        return center_x, best_value
+
+
+class JointQuadScanTurbo(QuadScanTurbo):
+    """
+    Trust region for a quad scan that minimizes several objectives in turn with a
+    single generator, e.g. the beam sizes in both planes. The trust region is the
+    smallest box containing the trust regions around the best points of all
+    objectives, `center_x` and `best_value` track the active (first) objective of
+    the vocs.
+    """
+
+    objective_names: List[str]
+    centers: Dict[str, Dict[str, float]] = {}
+    best_values: Dict[str, float] = {}
+
+    def get_trust_region(self, model: ModelListGP):
+        if not isinstance(model, ModelListGP):
+            raise RuntimeError("getting trust region requires a ModelListGP")
+
+        if not self.centers:
+            raise RuntimeError("need to set best points first, call `update_state`")
+
+        trust_regions = torch.stack(
+            [
+                self._trust_region(
+                    model.models[self.vocs.output_names.index(name)],
+                    self.centers[name],
+                )
+                for name in self.objective_names
+            ]
+        )
+        return torch.stack(
+            (
+                trust_regions[:, 0].min(dim=0).values,
+                trust_regions[:, 1].max(dim=0).values,
+            )
+        )
+
+    def _set_best_point(self, data):
+        for name in self.objective_names:
+            self.centers[name], self.best_values[name] = self._best_point(data, name)
+
+        active_name = self.vocs.objective_names[0]
+        self.center_x = self.centers[active_name]
+        self.best_value = self.best_values[active_name]
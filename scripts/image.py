@@ -1,19 +1,35 @@
 import json
 import os.path
 import time
-from copy import copy
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy, deepcopy
 from time import sleep
-from typing import Union, List
+from typing import Literal, Union, List
 
 import h5py
 import numpy as np
 import pandas as pd
 import yaml
 from epics import PV
-from matplotlib import patches, pyplot as plt
-from pydantic import BaseModel, PositiveFloat, PositiveInt
-
-from .utils.fitting_methods import fit_gaussian_linear_background
+from pydantic import BaseModel, PositiveFloat, PositiveInt, field_validator
+
+from .utils.archive import ImageArchive
+from .utils.background import BackgroundCache
+from .utils.camera import MonitoredCamera
+from .utils.fitting_methods import FIT_METHODS
+from .utils.image_processing import (
+    binned_dtype,
+    crop_to_window,
+    image_intensity,
+    preprocess_image,
+    project_image,
+    replace_hot_pixels,
+    split_level,
+)
+from .utils.rendering import DiagnosticRenderer
+from .utils.shot_results import ShotResults
+from .utils.statistics import RunningMedian, RunningStatistics
+from .utils.writer import AsyncWriter
 
 
 class ROI(BaseModel):
@@ -47,23 +63,64 @@ class ImageDiagnostic(BaseModel):
     array_n_rows_suffix: str = "Image:ArraySize1_RBV"
     resolution_suffix: Union[str, None] = "RESOLUTION"
     resolution: float = 1.0
-    beam_shutter_pv: str = None
+    beam_shutter_pv: Union[str, None] = None
     extra_pvs: List[str] = []
 
-    background_file: str = None
+    background_file: Union[str, None] = None
+    hot_pixel_file: Union[str, None] = None
     save_image_location: Union[str, None] = None
-    roi: ROI = None
+    save_mode: Literal["file", "archive"] = "file"
+    async_save: bool = False
+    save_queue_size: PositiveInt = 8
+    roi: Union[ROI, None] = None
 
     min_log_intensity: float = 4.0
     bounding_box_half_width: PositiveFloat = 3.0
     wait_time: PositiveFloat = 1.0
     n_fitting_restarts: PositiveInt = 1
+    fit_method: str = "gaussian"
     visualize: bool = True
+    render_mode: Literal["on_demand", "background"] = "on_demand"
+    figure_cache_size: PositiveInt = 16
+    figure_location: Union[str, None] = None
+    pipelined: bool = False
+    n_workers: PositiveInt = 2
+    capture_mode: Literal["poll", "monitor"] = "poll"
+    frame_buffer_size: PositiveInt = 16
+    frame_timeout: PositiveFloat = 5.0
     return_statistics: bool = False
+    adaptive_shots: bool = False
+    min_shots: PositiveInt = 2
+    max_shots: PositiveInt = 10
+    target_relative_error: PositiveFloat = 0.05
     threshold: float = 0.0
+    binning: Union[Literal["auto"], PositiveInt] = 1
+    min_binned_size: PositiveFloat = 5.0
+    track_roi: bool = False
+    tracking_margin: PositiveFloat = 5.0
 
     testing: bool = False
 
+    @field_validator("fit_method")
+    def validate_fit_method(cls, value):
+        if value not in FIT_METHODS:
+            raise ValueError(
+                f"fit method must be one of {list(FIT_METHODS)}, got `{value}`"
+            )
+        return value
+
+    @field_validator("max_shots")
+    def validate_max_shots(cls, value, info):
+        if value < info.data.get("min_shots", 1):
+            raise ValueError("max_shots must not be smaller than min_shots")
+        return value
+
+    @field_validator("binning")
+    def validate_binning(cls, value):
+        if value not in ["auto", 1, 2, 4]:
+            raise ValueError(f"binning must be 1, 2, 4 or `auto`, got `{value}`")
+        return value
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -71,43 +128,93 @@ class ImageDiagnostic(BaseModel):
         self._pvs = [
             PV(name) for name in self.pv_names + self.extra_pvs
         ]
-        self._shutter_pv_obj = PV(self.beam_shutter_pv)
+        self._shutter_pv_obj = (
+            PV(self.beam_shutter_pv) if self.beam_shutter_pv is not None else None
+        )
+        self._background_cache = BackgroundCache()
+        self._camera = None
+        self._archive = None
+        self._archive_columns = None
+        self._writer = None
+        self._auto_bin_factor = 1
+        self._tracking = None
+        self._renderer = None
 
     def measure_beamsize(self, n_shots: int = 1, fit_image=True, **kwargs):
         """
         conduct a multi-shot measurement to get the beam size from images, returns
         sizes in units of `resolution`
 
+        if `pipelined` is set, frames are captured while previously captured frames
+        are fit by a pool of `n_workers` threads
+
+        if `visualize` is set, the data of each shot is recorded and diagnostic
+        figures are rendered by `render` (`render_mode="on_demand"`) or by a
+        background thread (`render_mode="background"`), see `DiagnosticRenderer`
+
+        if `capture_mode` is "monitor", frames are taken from a buffer filled by a
+        camera monitor, the next `n_shots` unique frames are used without waiting
+        `wait_time` between shots
+
+        if `binning` is set, frames are binned right after capture and sizes,
+        centroids and bounding box penalties are returned in units of the unbinned
+        frame, "auto" picks the largest binning that keeps the last measured beam
+        size above `min_binned_size` binned pixels
+
+        if `track_roi` is set, frames are cropped to a window around the last
+        measured beam before preprocessing and fit inside it, the full roi is used
+        when there is no valid previous measurement or the beam is not inside the
+        window (processed images that are saved to files are not cropped, they are
+        only fit inside the window)
+
+        if `save_mode` is "archive", the raw frames (before cropping, background
+        subtraction and binning) and per-shot results are appended to a single
+        archive file per run and the file name is returned with the indices of the
+        images in the archive (`save_index`)
+
+        if `async_save` is set, images are saved by a background writer and this
+        returns as soon as the images are queued, call `flush` to wait for them
+
+        if `adaptive_shots` is set, `n_shots` is ignored and between `min_shots`
+        and `max_shots` shots are taken, stopping as soon as the relative standard
+        errors of the mean of `Sx` and `Sy` are below `target_relative_error` or
+        none of the first `min_shots` shots could be fit
+
         allows attaching extra information to dataset via kwargs
         """
-        results = []
-        images = []
-        start_time = time.time()
-        for _ in range(n_shots):
+        start_time = self._start_measurement()
 
-            # get image and PV's at the same time
-            img, extra_data = self.get_processed_image()
-            if fit_image:
-                result = self.calculate_beamsize(img)
-
-                # convert beam size results to microns
-                if result["Sx"] is not None:
-                    result["Sx"] = result["Sx"] * self.resolution
-                    result["Sy"] = result["Sy"] * self.resolution
-            else:
-                result = {}
+        if self.adaptive_shots and fit_image:
+            results, images = self._adaptive_acquisition()
+        elif self.pipelined and fit_image and n_shots > 1:
+            results, images = self._pipelined_acquisition(n_shots)
+        else:
+            results, images = self._serial_acquisition(n_shots, fit_image)
 
-            results += [result | extra_data]
-            images += [img]
-            sleep(self.wait_time)
+        return self._collect_outputs(results, images, fit_image, start_time, **kwargs)
+
+    def _start_measurement(self):
+        """prepare the capture of a new measurement, returns the start time"""
+        if self._monitoring:
+            # discard frames captured before this measurement was requested
+            self.camera.buffer.clear()
+
+        return time.time()
+
+    def _collect_outputs(self, results, images, fit_image, start_time, **kwargs):
+        """
+        combine per-shot results into the measurement output and save images,
+        `images` are the raw frames in "archive" save mode and the processed
+        images otherwise (see `_capture`)
+        """
+        n_shots = len(results)
 
         # combine data into a single dictionary output
         if n_shots == 1:
             outputs = results[0]
         else:
-            # collect results into lists
-            outputs = pd.DataFrame(results).reset_index().to_dict(orient="list")
-            outputs.pop("index")
+            # collect results into one array per quantity
+            outputs = ShotResults.from_shots(results)
 
             # if the number of nans is greater than half but less than all of
             # the number of shots this could be an inconsistent measurement -- raise a warning
@@ -119,47 +226,317 @@ class ImageDiagnostic(BaseModel):
             #        "This could indicate consistency issues in the measurement."
             #    )
 
-            # create numpy arrays from lists
-            outputs = {key: list(np.array(ele)) for key, ele in outputs.items()}
-
-            # if specified, modify dictionary elements to return
-            # statistics of numerical lists
+            # if specified, return statistics of numerical results
             if self.return_statistics:
-                new_outputs = {}
-                for name, ele in outputs.items():
-                    if isinstance(ele, list):
-                        if isinstance(ele[0], float):
-                            new_outputs[name] = np.array(ele).mean()
-                            new_outputs[f"{name}_var"] = np.array(ele).var()
-                        else:
-                            new_outputs[name] = ele
-                    else:
-                        new_outputs[name] = ele
-
-                outputs = new_outputs
-
-        # if specified, save image data to location based on time stamp
+                outputs = outputs.statistics()
+
+        bin_factor = self.bin_factor
+        if fit_image:
+            self._update_auto_bin_factor(results)
+
+        # if specified, save image data to location based on time stamp or append
+        # it to the archive of this run
         if self.save_image_location is not None:
+            images = np.array(images)
+            if self.save_mode == "archive":
+                metadata = deepcopy(
+                    [result | kwargs | {"bin_factor": bin_factor} for result in results]
+                )
+                # columns cannot be added to an archive, rows with new columns
+                # (e.g. fit results after unfitted shots) start a new run
+                columns = {key for row in metadata for key in row}
+                if self._archive_columns is not None and not (
+                    columns <= self._archive_columns
+                ):
+                    self.close_archive()
+                if self._archive_columns is None:
+                    self._archive_columns = columns
+                indices = self.archive.reserve(len(images))
+                self._save(self.archive.append, images, metadata)
+                outputs["save_filename"] = self.archive.fname
+                outputs["save_index"] = indices[0] if n_shots == 1 else indices
+            else:
+                screen_name = self.screen_name.replace(":", "_")
+                save_filename = os.path.join(
+                    self.save_image_location, f"{screen_name}_{int(start_time)}.h5"
+                )
+                attrs = deepcopy(outputs | kwargs | {"bin_factor": bin_factor})
+                attrs |= json.loads(self.model_dump_json())
+                self._save(save_image_file, save_filename, images, attrs)
+                outputs["save_filename"] = save_filename
+
+        return outputs
+
+    def _save(self, function, *args):
+        """run a save function now or queue it in the writer if `async_save` is set"""
+        if self.async_save:
+            self.writer.submit(function, *args)
+        else:
+            function(*args)
+
+    @property
+    def writer(self) -> AsyncWriter:
+        """background writer used to save images if `async_save` is set"""
+        if self._writer is None:
+            self._writer = AsyncWriter(maxsize=self.save_queue_size)
+        return self._writer
+
+    def flush(self):
+        """wait until all queued images are saved"""
+        if self._writer is not None:
+            self._writer.flush()
+
+    @property
+    def archive(self) -> ImageArchive:
+        """archive of the current run in "archive" save mode, created on first use"""
+        if self._archive is None:
             screen_name = self.screen_name.replace(":", "_")
-            save_filename = os.path.join(
-                self.save_image_location, f"{screen_name}_{int(start_time)}.h5"
+            run_name = f"{screen_name}_run_{int(time.time())}"
+            save_filename = os.path.join(self.save_image_location, f"{run_name}.h5")
+            n_runs = 1
+            while os.path.exists(save_filename):
+                # runs started within the same second
+                save_filename = os.path.join(
+                    self.save_image_location, f"{run_name}_{n_runs}.h5"
+                )
+                n_runs += 1
+            self._archive = ImageArchive(
+                save_filename, attrs=json.loads(self.model_dump_json())
             )
-            screen_stats = json.loads(self.model_dump_json())
-            with h5py.File(save_filename, "w") as hf:
-                dset = hf.create_dataset("images", data=np.array(images))
-                for name, val in (outputs | kwargs | screen_stats).items():
-                    if val is not None:
-                        try:
-                            dset.attrs[name] = val
-                        except TypeError:
-                            dset.attrs[name] = str(val)
-
-            outputs["save_filename"] = save_filename
+        return self._archive
 
-        return outputs
+    def close_archive(self):
+        """close the archive of the current run, the next save starts a new run"""
+        if self._archive is not None:
+            self._save(self._archive.close)
+            self.flush()
+            self._archive = None
+        self._archive_columns = None
+
+    def _serial_acquisition(self, n_shots, fit_image=True):
+        """
+        capture images one after another, then fit the projections of all images
+        in a single batch
+        """
+        images, extra_data, raw_images, window = self._capture(n_shots)
+        results = self._fit_shots(images, extra_data, fit_image, window, raw_images)
+        return results, self._saved_images(images, raw_images)
+
+    def _capture(self, n_shots):
+        """
+        capture `n_shots` frames and the extra data of each shot, returns the
+        processed images, the extra data, the raw frames and the tracking window
+        the frames were cropped to before preprocessing (None if the full roi was
+        processed, see `_capture_window`)
+        """
+        images = []
+        extra_data = []
+        raw_images = []
+        window = None
+        for i in range(n_shots):
+
+            # get image and PV's at the same time
+            raw_img, extra = self.get_raw_data()
+            if i == 0:
+                window = self._capture_window(raw_img.shape)
+            images += [self._preprocess(raw_img, window)]
+            extra_data += [extra]
+            raw_images += [raw_img]
+            self._wait_for_next_frame()
+
+        return images, extra_data, raw_images, window
+
+    def _capture_window(self, raw_shape):
+        """
+        tracking window that frames of `raw_shape` are cropped to before
+        preprocessing, None if the full roi is processed, which is also the case
+        when the processed images are saved to files
+        """
+        if self.save_image_location is not None and not self._archiving:
+            return None
+        return self._tracking_window(self._processed_shape(raw_shape))
+
+    @property
+    def _archiving(self) -> bool:
+        """images are saved to the archive of the run, which keeps the raw frames"""
+        return self.save_image_location is not None and self.save_mode == "archive"
+
+    def _saved_images(self, images, raw_images):
+        """images to save, the raw frames in "archive" save mode"""
+        return raw_images if self._archiving else images
+
+    def _fit_shots(
+        self, images, extra_data, fit_image=True, window=None, raw_images=None
+    ):
+        """
+        calculate the beam sizes of captured images, if `window` is given the
+        images were cropped to it before preprocessing (see `_capture`)
+        """
+        n_shots = len(images)
+        if fit_image and window is None:
+            results = self.calculate_beamsizes(images)
+        elif fit_image:
+            results = self._analyze_beams(
+                *self._fit_beams(images, window, raw_images)
+            )
+        else:
+            results = [{}] * n_shots
+
+        if fit_image:
+            results = [self._convert_units(result) for result in results]
+
+        results = [result | extra for result, extra in zip(results, extra_data)]
+
+        return results
+
+    def _adaptive_acquisition(self):
+        """
+        capture and fit `min_shots` images in a single batch, then add one shot at
+        a time until the beam size estimate has converged or `max_shots` is reached
+        """
+        images, extra_data, raw_images, window = self._capture(self.min_shots)
+        results = self._fit_shots(images, extra_data, True, window, raw_images)
+        saved_images = self._saved_images(images, raw_images)
+
+        while len(results) < self.max_shots and not self._converged(results):
+            images, extra_data, raw_images, window = self._capture(1)
+            results += self._fit_shots(images, extra_data, True, window, raw_images)
+            saved_images += self._saved_images(images, raw_images)
+
+        return results, saved_images
+
+    def _converged(self, results):
+        """
+        check if the relative standard errors of the mean of `Sx` and `Sy` are
+        below `target_relative_error`, sequences without any valid shot are
+        abandoned
+        """
+        sizes = np.array(
+            [[result.get("Sx"), result.get("Sy")] for result in results],
+            dtype=np.double,
+        )
+        sizes = sizes[np.all(np.isfinite(sizes), axis=1)]
+
+        if len(sizes) == 0:
+            return True
+        if len(sizes) < 2:
+            return False
+
+        relative_error = (
+            sizes.std(axis=0, ddof=1) / np.sqrt(len(sizes)) / np.abs(sizes.mean(axis=0))
+        )
+        return bool(np.all(relative_error < self.target_relative_error))
+
+    def _pipelined_acquisition(self, n_shots):
+        """
+        capture images into a preallocated buffer while a worker pool fits the
+        images that have already been captured, shot N+1 is captured while shot N
+        is being fit
+
+        workers only fit, all shots use the tracking window of the start of the
+        measurement and tracking and rendering are updated on the calling thread in
+        shot order, so results are the same as those of a serial acquisition
+        """
+        images = None
+        window = None
+        extra_data = []
+        raw_images = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            for i in range(n_shots):
+                raw_img, extra = self.get_raw_data()
+                if i == 0:
+                    window = self._capture_window(raw_img.shape)
+                img = self._preprocess(raw_img, window)
+                if images is None:
+                    images = np.empty((n_shots, *img.shape), dtype=img.dtype)
+                    # images that were not cropped are fit inside the window
+                    fit_window = window or self._tracking_window(img.shape)
+                images[i] = img
+
+                extra_data += [extra]
+                raw_images += [raw_img]
+                futures += [
+                    executor.submit(
+                        self._fit_beams,
+                        images[i : i + 1],
+                        fit_window,
+                        raw_images[i : i + 1] if window is not None else None,
+                    )
+                ]
+                self._wait_for_next_frame()
+
+            # collect fits in shot order
+            fit_images, checks, fits = [], [], []
+            for future in futures:
+                img, check, fit = future.result()
+                fit_images += img
+                checks += check
+                fits += fit
+
+        results = self._analyze_beams(fit_images, checks, fits)
+        results = [
+            self._convert_units(result) | extra
+            for result, extra in zip(results, extra_data)
+        ]
+
+        return results, self._saved_images(images, raw_images)
+
+    def _wait_for_next_frame(self):
+        """
+        when polling, wait a fixed time so that the same frame is not read twice,
+        monitored frames are already unique
+        """
+        if not self._monitoring:
+            sleep(self.wait_time)
+
+    def _convert_units(self, result):
+        # map pixel results of binned images back to the unbinned frame
+        bin_factor = self.bin_factor
+        if bin_factor > 1:
+            result["Cx"] = result["Cx"] * bin_factor + (bin_factor - 1) / 2
+            result["Cy"] = result["Cy"] * bin_factor + (bin_factor - 1) / 2
+            result["bb_penalty"] = result["bb_penalty"] * bin_factor
+
+        # convert beam size results to microns
+        if result["Sx"] is not None:
+            result["Sx"] = result["Sx"] * self.effective_resolution
+            result["Sy"] = result["Sy"] * self.effective_resolution
+
+        return result
+
+    @property
+    def bin_factor(self) -> int:
+        """binning of processed images, fixed for the duration of a measurement"""
+        if self.binning == "auto":
+            return self._auto_bin_factor
+        return self.binning
+
+    @property
+    def effective_resolution(self) -> float:
+        """resolution of a pixel of the processed (binned) images"""
+        return self.resolution * self.bin_factor
+
+    def _update_auto_bin_factor(self, results):
+        """choose the binning of the next measurement from the measured beam sizes"""
+        sizes = np.array(
+            [[result.get("Sx", np.nan), result.get("Sy", np.nan)] for result in results],
+            dtype=np.double,
+        )
+
+        self._auto_bin_factor = 1
+        if np.any(np.isfinite(sizes)):
+            size = np.nanmin(sizes) / self.resolution
+            for factor in [4, 2]:
+                if size / factor >= self.min_binned_size:
+                    self._auto_bin_factor = factor
+                    break
 
     def test_measurement(self):
-        """test the beam size measurement w/o saving data"""
+        """
+        test the beam size measurement w/o saving data, the diagnostic figure of
+        the shot is rendered afterwards and is the last element of `render()`
+        """
         old_visualize_state = copy(self.visualize)
         old_save_location = copy(self.save_image_location)
         self.visualize = True
@@ -167,9 +544,26 @@ class ImageDiagnostic(BaseModel):
         results = self.measure_beamsize(n_shots=1)
         self.visualize = old_visualize_state
         self.save_image_location = old_save_location
+        self.render()
 
         return results
 
+    @property
+    def renderer(self) -> DiagnosticRenderer:
+        """renderer of diagnostic figures, created on first use"""
+        if self._renderer is None:
+            self._renderer = DiagnosticRenderer(
+                self.screen_name,
+                mode=self.render_mode,
+                cache_size=self.figure_cache_size,
+                save_location=self.figure_location,
+            )
+        return self._renderer
+
+    def render(self) -> list:
+        """render the recorded shots, returns the cached diagnostic figures"""
+        return self.renderer.render()
+
     @property
     def pv_names(self) -> list:
         suffixes = [
@@ -182,10 +576,25 @@ class ImageDiagnostic(BaseModel):
 
         return [f"{self.screen_name}:{ele}" for ele in suffixes]
 
+    @property
+    def _monitoring(self) -> bool:
+        return self.capture_mode == "monitor" and not self.testing
+
+    @property
+    def camera(self) -> MonitoredCamera:
+        """camera monitor used in "monitor" capture mode, created on first use"""
+        if self._camera is None:
+            self._camera = MonitoredCamera(
+                *self.pv_names[:3],
+                extra_pvs=self.extra_pvs,
+                maxlen=self.frame_buffer_size,
+            )
+        return self._camera
+
     @property
     def background_image(self) -> Union[np.ndarray, float]:
         if self.background_file is not None:
-            return np.load(self.background_file)
+            return self._background_cache.image(self.background_file)
         else:
             return 0.0
 
@@ -198,68 +607,353 @@ class ImageDiagnostic(BaseModel):
                 "ICT1": np.random.randn() + 1.0,
                 "ICT2": np.random.randn() + 1.0
             }
+        elif self._monitoring:
+            img, extra_data = self.camera.next_frame(self.frame_timeout)
         else:
             # get pvs
             results = [ele.get() for ele in self._pvs]
             img, nx, ny = results[0], results[1], results[2]
             img = img.reshape(ny, nx)
 
-            extra_data = dict(zip(self.extra_pvs, results[2:]))
+            extra_data = dict(zip(self.extra_pvs, results[len(self.pv_names) :]))
         return img, extra_data
 
     def get_processed_image(self):
+        """
+        get an image cropped to the roi with the background and threshold
+        subtracted, in the native dtype of the camera
+        """
         img, extra_data = self.get_raw_data()
 
-        # subtract background
-        img = img - self.background_image
-        img = np.where(img >= 0, img, 0)
+        return self._preprocess(img), extra_data
+
+    def _preprocess(self, img, window=None):
+        """
+        crop a raw frame to the roi, replace hot pixels and subtract the background
+        and threshold, if `window` is given only the part of the frame inside the
+        window (in the coordinates of the processed image) is preprocessed
+        """
+        level, _ = self._subtraction_level(binned_dtype(img.dtype, self.bin_factor))
+        hot_pixels = None
+        if self.hot_pixel_file is not None:
+            hot_pixels = self._background_cache.hot_pixels(self.hot_pixel_file)
+        if window is None:
+            return preprocess_image(img, self.roi, level, self.bin_factor, hot_pixels)
 
-        # crop image if specified
         if self.roi is not None:
             img = self.roi.crop_image(img)
+            hot_pixels = None if hot_pixels is None else self.roi.crop_image(hot_pixels)
+        region = tuple(
+            slice(s.start * self.bin_factor, s.stop * self.bin_factor) for s in window
+        )
+        if hot_pixels is not None:
+            # replace hot pixels with a margin of one pixel around the window, so
+            # that hot pixels on its edge get all their neighbours
+            padded = tuple(slice(max(s.start - 1, 0), s.stop + 1) for s in region)
+            img = replace_hot_pixels(img[padded], hot_pixels[padded])
+            region = tuple(
+                slice(s.start - p.start, s.stop - p.start)
+                for s, p in zip(region, padded)
+            )
+        img = img[region]
 
-        return img, extra_data
+        return preprocess_image(
+            img, None, crop_to_window(level, window), self.bin_factor
+        )
 
-    def measure_background(self, n_measurements: int = 5, file_location: str = None):
+    def _processed_shape(self, raw_shape):
+        """shape of the processed image of a raw frame of `raw_shape`"""
+        img = np.broadcast_to(np.uint8(0), raw_shape)
+        if self.roi is not None:
+            img = self.roi.crop_image(img)
+
+        return tuple(length // self.bin_factor for length in img.shape)
+
+    def _subtraction_level(self, dtype):
+        """
+        background plus threshold, cropped to the roi, with hot pixels replaced and
+        binned, the threshold is per unbinned pixel, returns the level in `dtype`
+        that is subtracted during preprocessing and its (fractional) remainder that
+        is applied when images are projected (see `split_level`)
+        """
+        threshold = self.threshold * self.bin_factor**2
+        if self.background_file is not None:
+            return self._background_cache.cropped(
+                self.background_file,
+                self.roi,
+                dtype,
+                offset=threshold,
+                binning=self.bin_factor,
+                hot_pixel_file=self.hot_pixel_file,
+            )
+        else:
+            return split_level(threshold, dtype)
+
+    def measure_background(
+        self,
+        n_measurements: int = 5,
+        file_location: str = None,
+        use_median: bool = False,
+        hot_pixel_threshold: float = 5.0,
+    ):
+        """
+        measure the background with the beam shutter inserted, frames are streamed
+        into running per-pixel statistics so memory use does not depend on
+        `n_measurements`
+
+        saves the mean (or the median estimate if `use_median` is set) as the
+        background file and a mask of hot pixels, whose mean or noise is more than
+        `hot_pixel_threshold` robust standard deviations above that of the other
+        pixels, as the hot pixel file, hot pixels of frames and of the background
+        are replaced by the median of their neighbours during preprocessing
+        """
         file_location = file_location or ""
 
         filename = os.path.join(
             file_location, f"{self.screen_name}_background.npy".replace(":", "_")
         )
+        hot_pixel_filename = os.path.join(
+            file_location, f"{self.screen_name}_hot_pixels.npy".replace(":", "_")
+        )
         # insert shutter
         if self.beam_shutter_pv is not None:
             old_shutter_state = self._shutter_pv_obj.get()
             self._shutter_pv_obj.put(0)
             sleep(5.0)
 
-        images = []
+        if self._monitoring:
+            self.camera.buffer.clear()
+
+        statistics = RunningStatistics()
+        median = RunningMedian() if use_median else None
         for i in range(n_measurements):
-            images += [self.get_raw_image()]
-            sleep(self.wait_time)
+            img, _ = self.get_raw_data()
+            statistics.update(img)
+            if median is not None:
+                median.update(img)
+            self._wait_for_next_frame()
 
         # restore shutter state
         if self.beam_shutter_pv is not None:
             self._shutter_pv_obj.put(old_shutter_state)
 
-        # return average
-        images = np.stack(images)
-        mean = images.mean(axis=0)
+        background = statistics.mean if median is None else median.median
 
-        np.save(filename, mean)
+        np.save(filename, background)
+        np.save(hot_pixel_filename, statistics.hot_pixels(hot_pixel_threshold))
         self.background_file = filename
+        self.hot_pixel_file = hot_pixel_filename
 
-        return mean
+        return background
 
     def calculate_beamsize(self, img):
-        roi_c = np.array(img.shape) / 2
-        roi_radius = np.min((roi_c * 2, np.array(img.shape))) / 2
+        return self.calculate_beamsizes([img])[0]
+
+    def calculate_beamsizes(self, imgs):
+        """
+        calculate the beam sizes of several images, the projections of all images
+        above the intensity threshold are fit together in a single batch
+        """
+        window = self._tracking_window(imgs[0].shape) if len(imgs) else None
+        return self._analyze_beams(*self._fit_beams(imgs, window))
+
+    def _fit_beams(self, imgs, window=None, raw_imgs=None):
+        """
+        fit the images above the intensity threshold, returns the fit images, the
+        result of the intensity check (None if the image was fit) and the fits
+        (None if the image was not fit) of each image
 
-        # apply threshold
-        img = img - self.threshold
-        img = np.where(img >= 0, img, 0)
+        if `raw_imgs` are given, `imgs` were cropped to the tracking `window` before
+        preprocessing, the intensity check and the total intensity still use the
+        full roi (see `_roi_intensity`), shots where the beam is not inside the
+        window are preprocessed again and fit on the full roi
+
+        does not change the state of the diagnostic, so it can run in worker threads
+        """
+        imgs = list(imgs)
+        fits = [None] * len(imgs)
+        remainder = self._subtraction_level(imgs[0].dtype)[1] if len(imgs) else 0.0
+        if raw_imgs is not None:
+            shape = self._processed_shape(raw_imgs[0].shape)
+            offset = (window[1].start, window[0].start)
+            intensities = [
+                self._roi_intensity(img, raw_img, window, remainder)
+                for img, raw_img in zip(imgs, raw_imgs)
+            ]
+            window_ids = [
+                i
+                for i, intensity in enumerate(intensities)
+                if intensity >= 10**self.min_log_intensity
+            ]
+            if len(window_ids):
+                print(f"fitting {len(window_ids)} images")
+
+            window_fits = self._fit_window(
+                [imgs[i] for i in window_ids], window, remainder
+            )
+            for i, fit in zip(window_ids, window_fits):
+                if fit is not None:
+                    fits[i] = fit | {
+                        "shape": shape,
+                        "offset": offset,
+                        "total_intensity": intensities[i],
+                        "log10_total_intensity": np.log10(intensities[i]),
+                    }
+
+            for i in [i for i, fit in enumerate(fits) if fit is None]:
+                imgs[i] = self._preprocess(raw_imgs[i])
+            window = None
 
         # if image is below min intensity threshold avoid fitting
-        log10_total_intensity = np.log10(img.sum())
+        checks = [
+            self._check_intensity(img, remainder) if fit is None else None
+            for img, fit in zip(imgs, fits)
+        ]
+        fit_ids = [
+            i
+            for i, (check, fit) in enumerate(zip(checks, fits))
+            if check is None and fit is None
+        ]
+        if len(fit_ids):
+            print(f"fitting {len(fit_ids)} images")
+
+        tracked_fits = self._fit_tracked(
+            [imgs[i] for i in fit_ids], window, remainder
+        )
+        for i, fit in zip(fit_ids, tracked_fits):
+            fits[i] = fit
+
+        return imgs, checks, fits
+
+    def _roi_intensity(self, img, raw_img, window, remainder=0.0):
+        """
+        total intensity of the full roi of a frame whose part inside `window` was
+        preprocessed as `img`, the rest of the roi is preprocessed in strips that
+        are only summed, `remainder` is that of the subtraction level of the roi
+        """
+        shape = self._processed_shape(raw_img.shape)
+        rows, cols = window
+        strips = [
+            (slice(0, rows.start), slice(0, shape[1])),
+            (slice(rows.stop, shape[0]), slice(0, shape[1])),
+            (rows, slice(0, cols.start)),
+            (rows, slice(cols.stop, shape[1])),
+        ]
+
+        intensity = image_intensity(img, crop_to_window(remainder, window))
+        for strip in strips:
+            if all(s.start < s.stop for s in strip):
+                intensity += image_intensity(
+                    self._preprocess(raw_img, strip), crop_to_window(remainder, strip)
+                )
+
+        return intensity
+
+    def _analyze_beams(self, imgs, checks, fits):
+        """
+        get the beam size results of images from `_fit_beams` in shot order,
+        recording them for rendering and updating the tracked beam
+        """
+        results = []
+        for img, check, fit in zip(imgs, checks, fits):
+            if fit is None:
+                results += [check]
+            else:
+                results += [self._analyze_fits(img, fit)]
+                self._update_tracking(results[-1], fit.get("shape", img.shape))
+
+        return results
+
+    def _fit_tracked(self, imgs, window=None, remainder=0.0):
+        """
+        fit images inside the tracking `window` around the last measured beam and
+        refit the full roi of images where the beam is not inside the window,
+        `remainder` is that of the subtraction level of the images
+        """
+        fits = [None] * len(imgs)
+        if window is not None:
+            windowed = [img[window] for img in imgs]
+            window_fits = self._fit_window(
+                windowed, window, crop_to_window(remainder, window)
+            )
+            for i, fit in enumerate(window_fits):
+                if fit is not None:
+                    intensity = image_intensity(imgs[i], remainder)
+                    fits[i] = fit | {
+                        "total_intensity": intensity,
+                        "log10_total_intensity": np.log10(intensity),
+                    }
+
+        retry_ids = [i for i, fit in enumerate(fits) if fit is None]
+        retry_fits = self.fit_images(
+            [imgs[i] for i in retry_ids], [remainder] * len(retry_ids)
+        )
+        for i, fit in zip(retry_ids, retry_fits):
+            fits[i] = fit
+
+        return fits
+
+    def _fit_window(self, imgs, window, remainder=0.0):
+        """
+        fit images cropped to the tracking `window` (with subtraction level
+        `remainder`), returns the fits with the centroid in the coordinates of the
+        full image, None where the beam is not inside the window
+        """
+        fits = []
+        for img, fit in zip(imgs, self.fit_images(imgs, [remainder] * len(imgs))):
+            if self._inside_window(fit, img.shape):
+                fits += [
+                    fit
+                    | {"centroid": fit["centroid"] + (window[1].start, window[0].start)}
+                ]
+            else:
+                fits += [None]
+
+        return fits
+
+    def _tracking_window(self, shape):
+        """
+        processing window around the last measured beam, `tracking_margin` rms sizes
+        (added in quadrature) from the centroid, None if the full roi should be used
+        """
+        if not self.track_roi or self._tracking is None:
+            return None
+
+        centroid, sizes, tracked_shape = self._tracking
+        if tracked_shape != shape:
+            return None
+
+        half_width = max(self.tracking_margin * np.linalg.norm(sizes), 10.0)
+        window = []
+        for center, length in zip(centroid[::-1], shape):
+            start = int(max(np.floor(center - half_width), 0))
+            stop = int(min(np.ceil(center + half_width) + 1, length))
+            window += [slice(start, stop)]
+
+        if window[0] == slice(0, shape[0]) and window[1] == slice(0, shape[1]):
+            return None
+
+        return tuple(window)
+
+    def _inside_window(self, fit, shape):
+        """check that the fit of a windowed image is valid and inside the window"""
+        values = np.stack((fit["centroid"], fit["rms_sizes"]))
+        if np.any(np.isnan(values)):
+            return False
+
+        return self._bounding_box_penalty(*values, shape) <= 0
+
+    def _update_tracking(self, result, shape):
+        """track the last valid beam, reset tracking if the measurement failed"""
+        values = np.array([result[name] for name in ["Cx", "Cy", "Sx", "Sy"]])
+        if np.any(np.isnan(values)) or not result["bb_penalty"] <= 0:
+            self._tracking = None
+        else:
+            self._tracking = (values[:2], values[2:], shape)
+
+    def _check_intensity(self, img, remainder=0.0):
+        """returns a result of NaN's if the image is below the intensity threshold"""
+        log10_total_intensity = np.log10(image_intensity(img, remainder))
         if log10_total_intensity < self.min_log_intensity:
             print(f"log10 image intensity {log10_total_intensity} below threshold")
 
@@ -274,99 +968,130 @@ class ImageDiagnostic(BaseModel):
             }
             return result
 
-        else:
-            print("fitting image")
-            fits = self.fit_image(img)
-            centroid = fits["centroid"]
-            sizes = fits["rms_sizes"]
-
-            # do analysis if fits return all good values
-            if np.all(~np.isnan(np.stack((centroid, sizes)))):
-                # get beam region bounding box
-                n_stds = self.bounding_box_half_width
-                pts = np.array(
-                    (
-                        centroid - n_stds * sizes,
-                        centroid + n_stds * sizes,
-                        centroid - n_stds * sizes * np.array((-1, 1)),
-                        centroid + n_stds * sizes * np.array((-1, 1)),
-                    )
-                )
+        return None
+
+    def _analyze_fits(self, img, fits):
+        """get beam size results from the projection fits of an image"""
+        log10_total_intensity = fits["log10_total_intensity"]
+
+        centroid = fits["centroid"]
+        sizes = fits["rms_sizes"]
+
+        # images that were cropped to the tracking window before preprocessing
+        shape = fits.get("shape", img.shape)
+        offset = np.array(fits.get("offset", (0, 0)))
+
+        # record data for rendering diagnostic figures outside of the measurement
+        if self.visualize:
+            self.renderer.record(
+                {
+                    "image": img,
+                    "centroid": centroid - offset,
+                    "sizes": sizes,
+                    "n_stds": self.bounding_box_half_width,
+                    "projections": fits.get("projections", ()),
+                    "params": fits.get("params", ()),
+                }
+            )
 
-                # visualization
-                if self.visualize:
-                    fig, ax = plt.subplots()
-                    c = ax.imshow(img, origin="lower")
-                    ax.plot(*centroid, "+r")
-                    ax.plot(*roi_c[::-1], ".r")
-                    fig.colorbar(c)
+        # do analysis if fits return all good values
+        if np.all(~np.isnan(np.stack((centroid, sizes)))):
+            bb_penalty = self._bounding_box_penalty(centroid, sizes, shape)
 
-                    rect = patches.Rectangle(
-                        pts[0], *sizes * n_stds * 2.0, facecolor="none", edgecolor="r"
-                    )
-                    ax.add_patch(rect)
+            result = {
+                "Cx": centroid[0],
+                "Cy": centroid[1],
+                "Sx": sizes[0],
+                "Sy": sizes[1],
+                "bb_penalty": bb_penalty,
+                "total_intensity": fits["total_intensity"],
+                "log10_total_intensity": log10_total_intensity,
+            }
 
-                    circle = patches.Circle(
-                        roi_c[::-1], roi_radius, facecolor="none", edgecolor="r"
-                    )
-                    ax.add_patch(circle)
+            # set results to none if the beam extends beyond the roi
+            if bb_penalty > 0:
+                for name in ["Cx", "Cy", "Sx", "Sy"]:
+                    result[name] = np.NaN
 
-                distances = np.linalg.norm(pts - roi_c, axis=1)
+        else:
+            result = {
+                "Cx": np.NaN,
+                "Cy": np.NaN,
+                "Sx": np.NaN,
+                "Sy": np.NaN,
+                "bb_penalty": np.NaN,
+                "total_intensity": fits["total_intensity"],
+                "log10_total_intensity": log10_total_intensity,
+            }
 
-                # subtract radius to get penalty value
-                bb_penalty = np.max(distances) - roi_radius
+        return result
 
-                log10_total_intensity = fits["log10_total_intensity"]
+    def _bounding_box_penalty(self, centroid, sizes, shape):
+        """
+        distance of the furthest corner of the beam bounding box outside of the
+        circle inscribed in an image of `shape`, positive if the beam is clipped
+        """
+        roi_c = np.array(shape) / 2
+        roi_radius = np.min((roi_c * 2, np.array(shape))) / 2
+
+        n_stds = self.bounding_box_half_width
+        pts = np.array(
+            (
+                centroid - n_stds * sizes,
+                centroid + n_stds * sizes,
+                centroid - n_stds * sizes * np.array((-1, 1)),
+                centroid + n_stds * sizes * np.array((-1, 1)),
+            )
+        )
+        distances = np.linalg.norm(pts - roi_c, axis=1)
 
-                result = {
-                    "Cx": centroid[0],
-                    "Cy": centroid[1],
-                    "Sx": sizes[0],
-                    "Sy": sizes[1],
-                    "bb_penalty": bb_penalty,
-                    "total_intensity": fits["total_intensity"],
-                    "log10_total_intensity": log10_total_intensity,
-                }
+        # subtract radius to get penalty value
+        return np.max(distances) - roi_radius
 
-                # set results to none if the beam extends beyond the roi
-                if bb_penalty > 0:
-                    for name in ["Cx", "Cy", "Sx", "Sy"]:
-                        result[name] = np.NaN
+    def fit_image(self, img):
+        return self.fit_images([img])[0]
 
-            else:
-                result = {
-                    "Cx": np.NaN,
-                    "Cy": np.NaN,
-                    "Sx": np.NaN,
-                    "Sy": np.NaN,
-                    "bb_penalty": np.NaN,
-                    "total_intensity": fits["total_intensity"],
-                    "log10_total_intensity": log10_total_intensity,
-                }
+    def fit_images(self, imgs, remainders=None):
+        """
+        fit the x and y projections of all images in a single batch using the
+        estimator registered as `fit_method`, `remainders` are those of the
+        subtraction levels of preprocessed images (see `split_level`)
+        """
+        if not len(imgs):
+            return []
 
-            return result
+        remainders = [0.0] * len(imgs) if remainders is None else remainders
+        projections = []
+        intensities = []
+        for img, remainder in zip(imgs, remainders):
+            x_projection, y_projection = project_image(img, remainder)
+            intensities += [x_projection.sum()]
 
-    def fit_image(self, img):
-        x_projection = np.sum(img, axis=0)
-        y_projection = np.sum(img, axis=1)
+            # subtract min value from projections
+            x_projection = x_projection - x_projection[:10].min()
+            y_projection = y_projection - y_projection[:10].min()
 
-        # subtract min value from projections
-        x_projection = x_projection - x_projection[:10].min()
-        y_projection = y_projection - y_projection[:10].min()
+            projections += [x_projection, y_projection]
 
-        para_x = fit_gaussian_linear_background(
-            x_projection, visualize=self.visualize, n_restarts=self.n_fitting_restarts
-        )
-        para_y = fit_gaussian_linear_background(
-            y_projection, visualize=self.visualize, n_restarts=self.n_fitting_restarts
+        params, _ = FIT_METHODS[self.fit_method](
+            projections, n_restarts=self.n_fitting_restarts
         )
 
-        return {
-            "centroid": np.array((para_x[1], para_y[1])),
-            "rms_sizes": np.array((para_x[2], para_y[2])),
-            "total_intensity": img.sum(),
-            "log10_total_intensity": np.log10(img.sum()),
-        }
+        fits = []
+        for i, img in enumerate(imgs):
+            para_x, para_y = params[2 * i], params[2 * i + 1]
+            fits += [
+                {
+                    "centroid": np.array((para_x[1], para_y[1])),
+                    "rms_sizes": np.array((para_x[2], para_y[2])),
+                    "total_intensity": intensities[i],
+                    "log10_total_intensity": np.log10(intensities[i]),
+                    "projections": projections[2 * i : 2 * i + 2],
+                    "params": (para_x, para_y),
+                }
+            ]
+
+        return fits
 
     def yaml(self):
         return yaml.dump(self.dict(), default_flow_style=None, sort_keys=False)
@@ -375,4 +1100,16 @@ class ImageDiagnostic(BaseModel):
         """dump data to file"""
         output = json.loads(self.json())
         with open(fname, "w") as f:
-            yaml.dump(output, f)
\ No newline at end of file
+            yaml.dump(output, f)
+
+
+def save_image_file(fname, images, attrs):
+    """save images of a single measurement and their attributes to a new h5 file"""
+    with h5py.File(fname, "w") as hf:
+        dset = hf.create_dataset("images", data=images)
+        for name, val in attrs.items():
+            if val is not None:
+                try:
+                    dset.attrs[name] = val
+                except TypeError:
+                    dset.attrs[name] = str(val)
@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict
+
+from pydantic import BaseModel, PositiveInt
+
+from .image import ImageDiagnostic
+
+
+class ImageDiagnosticGroup(BaseModel):
+    """
+    Measures the beam size on several screens at the same time. Frames of each
+    screen are captured by their own thread and the captured frames are fit in a
+    worker pool shared by all screens. Results are merged into a single dictionary
+    with keys prefixed by the name of the screen, e.g. `OTR2_Sx`.
+    """
+
+    diagnostics: Dict[str, ImageDiagnostic]
+    n_workers: PositiveInt = 4
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._capture_pool = None
+        self._fit_pool = None
+
+    def measure_beamsize(self, n_shots: int = 1, fit_image=True, **kwargs):
+        """
+        conduct a simultaneous multi-shot measurement on all screens, returns the
+        outputs of `ImageDiagnostic.measure_beamsize` of each screen with keys
+        prefixed by `<name>_`
+        """
+        start_times = {
+            name: diagnostic._start_measurement()
+            for name, diagnostic in self.diagnostics.items()
+        }
+
+        # capture on all screens at once, fit each screen as soon as its frames
+        # are captured
+        captures = {
+            self.capture_pool.submit(diagnostic._capture, n_shots): name
+            for name, diagnostic in self.diagnostics.items()
+        }
+        saved_images = {}
+        fits = {}
+        for future in as_completed(captures):
+            name = captures[future]
+            diagnostic = self.diagnostics[name]
+            images, extra_data, raw_images, window = future.result()
+            saved_images[name] = diagnostic._saved_images(images, raw_images)
+            fits[name] = self.fit_pool.submit(
+                diagnostic._fit_shots,
+                images,
+                extra_data,
+                fit_image,
+                window,
+                raw_images,
+            )
+
+        outputs = {}
+        for name, diagnostic in self.diagnostics.items():
+            results = fits[name].result()
+            screen_outputs = diagnostic._collect_outputs(
+                results, saved_images[name], fit_image, start_times[name], **kwargs
+            )
+            outputs |= {f"{name}_{key}": val for key, val in screen_outputs.items()}
+
+        return outputs
+
+    @property
+    def capture_pool(self) -> ThreadPoolExecutor:
+        """one capture thread per screen"""
+        if self._capture_pool is None:
+            self._capture_pool = ThreadPoolExecutor(
+                max_workers=len(self.diagnostics), thread_name_prefix="capture"
+            )
+        return self._capture_pool
+
+    @property
+    def fit_pool(self) -> ThreadPoolExecutor:
+        """worker pool fitting the images of all screens"""
+        if self._fit_pool is None:
+            self._fit_pool = ThreadPoolExecutor(
+                max_workers=self.n_workers, thread_name_prefix="fit"
+            )
+        return self._fit_pool
+
+    def close(self):
+        """stop the capture and fitting threads"""
+        for pool in [self._capture_pool, self._fit_pool]:
+            if pool is not None:
+                pool.shutdown()
+        self._capture_pool = None
+        self._fit_pool = None
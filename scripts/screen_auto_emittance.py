@@ -2,7 +2,7 @@ import json
 import os
 from abc import ABC, abstractmethod
 from time import sleep, time
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Union
 from copy import deepcopy
 
 import numpy as np
@@ -15,11 +15,26 @@ from xopt import VOCS
 
 from scripts.characterize_emittance import characterize_emittance
 from scripts.image import ImageDiagnostic
+from scripts.utils.shot_results import ShotResults
 from scripts.automatic_emittance import BaseEmittanceMeasurement, BeamlineConfig
 
 import pandas as pd
-def explode_all_columns(data: pd.DataFrame):
-    """explode all data columns in dataframes that are lists or np.arrays"""
+def explode_all_columns(data: Union[pd.DataFrame, List[dict]]):
+    """
+    explode all data columns in dataframes that are lists or np.arrays, a list of
+    measurement outputs is converted directly into one row per shot
+    """
+    if isinstance(data, list):
+        return pd.concat(
+            [
+                ele.to_dataframe()
+                if isinstance(ele, ShotResults)
+                else pd.DataFrame(ele, index=[0])
+                for ele in data
+            ],
+            ignore_index=True,
+        )
+
     list_types = []
     for name, val in data.iloc[0].items():
         if isinstance(val, list) or isinstance(val, np.ndarray):
@@ -38,27 +53,31 @@ class ScreenEmittanceMeasurement(BaseEmittanceMeasurement):
     minimum_log_intensity: PositiveFloat = 4.0
     n_shots: PositiveInt = 3
 
+    @property
+    def screen_name(self):
+        return self.image_diagnostic.screen_name
+
     def eval_beamsize(self, inputs):
         # set PVs
         for k, v in inputs.items():
             print(f"CAPUT {k} {v}")
-            caput(k, v)
+            self.set_pv(k, v)
 
         sleep(self.wait_time)
 
         # get beam sizes from image diagnostic
         results = self.image_diagnostic.measure_beamsize(self.n_shots, **inputs)
-        results["S_x_mm"] = np.array(results["Sx"]) * 1e-3
-        results["S_y_mm"] = np.array(results["Sy"]) * 1e-3
+        results["S_x_mm"] = np.asarray(results["Sx"]) * 1e-3
+        results["S_y_mm"] = np.asarray(results["Sy"]) * 1e-3
 
         # get other PV's NOTE: Measurements not synchronous with beamsize measurements!
-        results = results | dict(
-            zip(self.secondary_observables, caget_many(self.secondary_observables))
+        results.update(
+            zip(self.secondary_observables, self.get_pvs(self.secondary_observables))
         )
 
         # add total beam size
         results["total_size"] = np.sqrt(
-            np.array(results["Sx"]) ** 2 + np.array(results["Sy"]) ** 2
+            np.asarray(results["Sx"]) ** 2 + np.asarray(results["Sy"]) ** 2
         )
         return results
 
@@ -67,7 +86,7 @@ class ScreenEmittanceMeasurement(BaseEmittanceMeasurement):
         perform a fast, rough scan of the parameter space 
         
         """
-        old_pv_value = caget(self.beamline_config.scan_quad_pv)
+        old_pv_value = self.get_pv(self.beamline_config.scan_quad_pv)
         
         scan_points = np.linspace(
             *self.beamline_config.scan_quad_range,
@@ -75,27 +94,27 @@ class ScreenEmittanceMeasurement(BaseEmittanceMeasurement):
         )
 
         print(f"CAPUT {self.beamline_config.scan_quad_pv} {scan_points[0]}")
-        caput(self.beamline_config.scan_quad_pv, scan_points[0])
+        self.set_pv(self.beamline_config.scan_quad_pv, scan_points[0])
         sleep(3.0)
 
         results = []
         for point in scan_points:
             print(f"CAPUT {self.beamline_config.scan_quad_pv} {point}")
-            caput(self.beamline_config.scan_quad_pv, point)
+            self.set_pv(self.beamline_config.scan_quad_pv, point)
 
             sleep(1.0)
 
             result = self.image_diagnostic.measure_beamsize(3)
-            result["S_x_mm"] = np.array(result["Sx"]) * 1e-3
-            result["S_y_mm"] = np.array(result["Sy"]) * 1e-3
+            result["S_x_mm"] = np.asarray(result["Sx"]) * 1e-3
+            result["S_y_mm"] = np.asarray(result["Sy"]) * 1e-3
             result[self.beamline_config.scan_quad_pv] = point
             results += [result]
             
 
         # reset old pv
-        caput(self.beamline_config.scan_quad_pv, old_pv_value)
+        self.set_pv(self.beamline_config.scan_quad_pv, old_pv_value)
 
-        return explode_all_columns(pd.DataFrame(results))
+        return explode_all_columns(results)
             
 
     @property
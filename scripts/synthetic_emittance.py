@@ -0,0 +1,44 @@
+from scripts.image import ImageDiagnostic
+from scripts.screen_auto_emittance import ScreenEmittanceMeasurement
+from scripts.utils.synthetic import SyntheticBeam
+
+
+class SyntheticImageDiagnostic(ImageDiagnostic):
+    """image diagnostic that takes frames from a synthetic beam instead of a camera"""
+
+    beam: SyntheticBeam
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.resolution = self.beam.resolution
+
+    def get_raw_data(self):
+        return self.beam.next_frame(), {}
+
+
+class SyntheticScreenEmittanceMeasurement(ScreenEmittanceMeasurement):
+    """
+    screen emittance measurement against a synthetic beam, pvs are read from and
+    written to the beam so that the whole measurement runs without a machine and
+    the results can be compared to `ground_truth`
+    """
+
+    image_diagnostic: SyntheticImageDiagnostic
+
+    @property
+    def beam(self) -> SyntheticBeam:
+        return self.image_diagnostic.beam
+
+    @property
+    def ground_truth(self) -> dict:
+        """normalized emittances of the synthetic beam in [mm-mrad]"""
+        return {"x_emittance": self.beam.emittance_x, "y_emittance": self.beam.emittance_y}
+
+    def get_pv(self, name):
+        return self.beam.get_pv(name)
+
+    def get_pvs(self, names):
+        return [self.beam.get_pv(name) for name in names]
+
+    def set_pv(self, name, value):
+        self.beam.set_pv(name, value)
@@ -0,0 +1,143 @@
+from typing import Dict, List
+
+import h5py
+import numpy as np
+
+
+class ImageArchive:
+    """
+    Append-only HDF5 archive of the images taken during a run.
+
+    Images are appended to a resizable, chunked and compressed `images` dataset in
+    their native dtype. For every image a row is appended to each column of the
+    `metadata` group (measurement inputs and fit results), so that row `i` of the
+    metadata belongs to image `i`. The file is created on the first append and is
+    switched to SWMR mode afterwards, it can be read (with `swmr=True`) while the
+    run is in progress. Datasets cannot be created in SWMR mode (and the file cannot
+    be reopened while readers hold it), metadata with columns that first appear
+    after the file was created is rejected before anything is written.
+    """
+
+    def __init__(
+        self,
+        fname: str,
+        attrs: Dict = None,
+        compression: str = "gzip",
+        compression_opts: int = 4,
+    ):
+        self.fname = fname
+        self.attrs = attrs or {}
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self._file = None
+        self._n_reserved = 0
+
+    def __len__(self):
+        if self._file is None:
+            return 0
+        return self._file["images"].shape[0]
+
+    def append(self, images: np.ndarray, metadata: List[Dict]) -> List[int]:
+        """
+        append a stack of images and one metadata dict per image, returns the
+        indices of the appended images in the archive
+        """
+        images = np.asarray(images)
+        if len(metadata) != len(images):
+            raise ValueError("must specify one metadata row per image")
+
+        if self._file is None:
+            self._create(images, metadata)
+
+        dset = self._file["images"]
+        if images.shape[1:] != dset.shape[1:]:
+            raise ValueError(
+                f"image shape {images.shape[1:]} does not match the archive image "
+                f"shape {dset.shape[1:]}, start a new archive"
+            )
+
+        group = self._file["metadata"]
+        new_columns = {key for row in metadata for key in row} - set(group)
+        if new_columns:
+            raise ValueError(
+                f"metadata columns {sorted(new_columns)} are not in the archive, "
+                f"start a new archive to store them"
+            )
+
+        start = dset.shape[0]
+        stop = start + len(images)
+        dset.resize(stop, axis=0)
+        dset[start:stop] = images
+        dset.flush()
+
+        for name, column in group.items():
+            values = [row.get(name) for row in metadata]
+            column.resize(stop, axis=0)
+            column[start:stop] = self._to_column(values, column.dtype)
+            column.flush()
+
+        self._n_reserved = max(self._n_reserved, stop)
+        return list(range(start, stop))
+
+    def reserve(self, n_images: int) -> List[int]:
+        """
+        return the indices that `n_images` images will get in the archive, used to
+        reference images before they are appended by an asynchronous writer
+        """
+        start = max(self._n_reserved, len(self))
+        self._n_reserved = start + n_images
+        return list(range(start, self._n_reserved))
+
+    def _create(self, images, metadata):
+        self._file = h5py.File(self.fname, "w", libver="latest")
+        for name, val in self.attrs.items():
+            if val is not None:
+                try:
+                    self._file.attrs[name] = val
+                except TypeError:
+                    self._file.attrs[name] = str(val)
+
+        self._file.create_dataset(
+            "images",
+            shape=(0, *images.shape[1:]),
+            maxshape=(None, *images.shape[1:]),
+            chunks=(1, *images.shape[1:]),
+            dtype=images.dtype,
+            compression=self.compression,
+            compression_opts=self.compression_opts,
+        )
+
+        group = self._file.create_group("metadata")
+        for name in dict.fromkeys(key for row in metadata for key in row):
+            values = [row.get(name) for row in metadata]
+            numeric = all(
+                val is None or isinstance(val, (bool, int, float, np.number))
+                for val in values
+            )
+            group.create_dataset(
+                name,
+                shape=(0,),
+                maxshape=(None,),
+                chunks=(1024,),
+                dtype=np.double if numeric else h5py.string_dtype(),
+            )
+
+        self._file.swmr_mode = True
+
+    @staticmethod
+    def _to_column(values, dtype):
+        if dtype == np.double:
+            column = []
+            for val in values:
+                try:
+                    column += [np.nan if val is None else float(val)]
+                except (TypeError, ValueError):
+                    column += [np.nan]
+            return np.array(column, dtype=np.double)
+        else:
+            return np.array(["" if val is None else str(val) for val in values], dtype=object)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+
+from scripts.utils.image_processing import (
+    bin_image,
+    replace_hot_pixels,
+    split_level,
+)
+
+
+class BackgroundCache:
+    """
+    Loads a background image once as a memory map and caches a copy of it that is
+    cropped to the region of interest, with hot pixels replaced like those of the
+    frames, binned, offset by the image threshold and split into the part that is
+    subtracted in the working dtype and its fractional remainder. The cache is
+    invalidated whenever the background or hot pixel file (or its modification
+    time), the ROI, the binning, the offset or the dtype changes.
+    """
+
+    def __init__(self):
+        self._file_key = None
+        self._image = None
+        self._cropped_key = None
+        self._cropped = None
+        self._hot_pixel_key = None
+        self._hot_pixels = None
+
+    def image(self, fname: str) -> np.ndarray:
+        """return the full (memory mapped) background image stored in `fname`"""
+        file_key = (os.path.abspath(fname), os.path.getmtime(fname))
+        if file_key != self._file_key:
+            self._image = np.load(fname, mmap_mode="r")
+            self._file_key = file_key
+            self._cropped_key = None
+            self._cropped = None
+
+        return self._image
+
+    def hot_pixels(self, fname: str) -> np.ndarray:
+        """return the (memory mapped) hot pixel mask stored in `fname`"""
+        hot_pixel_key = (os.path.abspath(fname), os.path.getmtime(fname))
+        if hot_pixel_key != self._hot_pixel_key:
+            self._hot_pixels = np.load(fname, mmap_mode="r")
+            self._hot_pixel_key = hot_pixel_key
+
+        return self._hot_pixels
+
+    def cropped(
+        self,
+        fname: str,
+        roi=None,
+        dtype=np.double,
+        offset: float = 0.0,
+        binning: int = 1,
+        hot_pixel_file: str = None,
+    ):
+        """
+        return the background image cropped to `roi`, with the hot pixels of
+        `hot_pixel_file` replaced, binned by `binning`, plus `offset` and split
+        into the level in `dtype` and its remainder (see `split_level`)
+        """
+        image = self.image(fname)
+        hot_pixels = None
+        if hot_pixel_file is not None:
+            hot_pixels = self.hot_pixels(hot_pixel_file)
+
+        roi_key = None if roi is None else (roi.xmin, roi.xmax, roi.ymin, roi.ymax)
+        hot_pixel_key = None if hot_pixels is None else self._hot_pixel_key
+        cropped_key = (roi_key, np.dtype(dtype), offset, binning, hot_pixel_key)
+        if cropped_key != self._cropped_key:
+            if roi is not None:
+                image = roi.crop_image(image)
+            image = np.asarray(image, dtype=np.double)
+            if hot_pixels is not None:
+                if roi is not None:
+                    hot_pixels = roi.crop_image(hot_pixels)
+                image = replace_hot_pixels(image, hot_pixels)
+            image = bin_image(image, binning)
+            level, remainder = split_level(image + offset, dtype)
+            self._cropped = (np.ascontiguousarray(level), remainder)
+            self._cropped_key = cropped_key
+
+        return self._cropped
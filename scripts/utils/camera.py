@@ -0,0 +1,94 @@
+import threading
+from collections import deque
+from typing import List
+
+import numpy as np
+from epics import PV
+
+
+class FrameBuffer:
+    """
+    Bounded ring buffer of unique camera frames. Each frame is pushed with a key
+    (e.g. the timestamp of the array), frames that repeat the key of the previous frame
+    are dropped and the oldest frames are discarded once `maxlen` frames are
+    waiting to be read.
+    """
+
+    def __init__(self, maxlen: int = 16):
+        self._frames = deque(maxlen=maxlen)
+        self._condition = threading.Condition()
+        self._last_key = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def push(self, frame, key=None) -> bool:
+        """add a frame to the buffer, returns False if it was a repeated frame"""
+        with self._condition:
+            if key is not None and key == self._last_key:
+                return False
+
+            self._last_key = key
+            self._frames.append(frame)
+            self._condition.notify_all()
+
+        return True
+
+    def pop(self, timeout: float = None):
+        """return the oldest unread frame, waiting up to `timeout` seconds for one"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: len(self._frames), timeout):
+                raise TimeoutError(f"no new frame received within {timeout} s")
+
+            return self._frames.popleft()
+
+    def clear(self):
+        """discard frames that have not been read yet"""
+        with self._condition:
+            self._frames.clear()
+
+
+class MonitoredCamera:
+    """
+    Subscribes to the image array PV of a camera and pushes every new frame into a
+    FrameBuffer together with the values of `extra_pvs` when the frame arrived.
+    Frames are deduplicated on the timestamp of the array update, which arrives
+    together with the frame.
+    """
+
+    def __init__(
+        self,
+        array_pv: str,
+        n_cols_pv: str,
+        n_rows_pv: str,
+        extra_pvs: List[str] = None,
+        maxlen: int = 16,
+    ):
+        self.buffer = FrameBuffer(maxlen)
+        self.extra_pvs = extra_pvs or []
+
+        self._n_cols = PV(n_cols_pv, auto_monitor=True)
+        self._n_rows = PV(n_rows_pv, auto_monitor=True)
+        self._extra = [PV(name, auto_monitor=True) for name in self.extra_pvs]
+        self._array = PV(array_pv, auto_monitor=True, callback=self._on_frame)
+
+    def _on_frame(self, value=None, timestamp=None, **kwargs):
+        if value is None:
+            return
+
+        nx, ny = self._n_cols.get(), self._n_rows.get()
+        if nx is None or ny is None:
+            return
+
+        img = np.array(value).reshape(ny, nx)
+        extra_data = dict(zip(self.extra_pvs, [ele.get() for ele in self._extra]))
+        self.buffer.push((img, extra_data), timestamp)
+
+    def next_frame(self, timeout: float = None):
+        """return the next unique frame and the extra data recorded with it"""
+        return self.buffer.pop(timeout)
+
+    def close(self):
+        """stop monitoring the camera"""
+        self._array.clear_callbacks()
+        self.buffer.clear()
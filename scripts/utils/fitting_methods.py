@@ -5,12 +5,32 @@ import matplotlib.pyplot as plt
 import numpy as np
 import torch
 from scipy.ndimage import gaussian_filter
+from scipy.special import erf
 from torch import Tensor
 
 from scripts.utils.batch_minimization import gen_candidates_scipy
+from scripts.utils.least_squares import GaussianLevenbergMarquardt
 
 logger = logging.getLogger(__name__)
 
+# registry of batch beam size estimators, see `register_fit_method`
+FIT_METHODS = {}
+
+
+def register_fit_method(name):
+    """
+    Register a batch beam size estimator under `name`. Estimators are called as
+    `estimator(ys, visualize=False, n_restarts=1)` with a list of 1D projections
+    and return an array of parameters amp, mu, sigma, offset (`n_projections x
+    4`, NaN for invalid fits) and a boolean array of validity flags.
+    """
+
+    def decorator(estimator):
+        FIT_METHODS[name] = estimator
+        return estimator
+
+    return decorator
+
 
 def gaussian_linear_background(x, amp, mu, sigma, offset=0):
     """Gaussian plus linear background fn"""
@@ -35,17 +55,53 @@ class GaussianLeastSquares:
         return loss
 
 
-def fit_gaussian_linear_background(y, inital_guess=None, visualize=True, n_restarts=1):
+class BatchGaussianLeastSquares:
     """
-    Takes a function y and inputs and fits and Gaussian with
-    linear bg to it. Returns the best fit estimates of the parameters
-    amp, mu, sigma and their associated 1sig error
+    Least squares loss of a Gaussian plus offset for a batch of projections of the
+    same length, evaluated with broadcasting for parameters of shape
+    `n_projections x n_candidates x 4`.
+
+    Parameters are normalized to the unit box spanned by `bounds` (shape
+    `2 x n_projections x 1 x 4`) and each projection is scaled by its norm, so
+    that the optimization is well conditioned.
     """
 
-    x = np.arange(y.shape[0])
+    def __init__(self, train_x: Tensor, train_y: Tensor, bounds: Tensor):
+        self.scale = train_y.norm(dim=-1).clamp(min=1.0).reshape(-1, 1, 1)
+        self.train_x = train_x
+        self.train_y = train_y.unsqueeze(-2) / self.scale
+        self.lower = bounds[0]
+        self.width = bounds[1] - bounds[0]
+
+    def to_parameters(self, U):
+        """convert normalized parameters to amp, mu, sigma, offset"""
+        return self.lower + U * self.width
+
+    def to_normalized(self, X):
+        """convert amp, mu, sigma, offset to normalized parameters"""
+        return (X - self.lower) / self.width
+
+    def forward(self, U):
+        X = self.to_parameters(U)
+        amp = X[..., 0].unsqueeze(-1) / self.scale
+        mu = X[..., 1].unsqueeze(-1)
+        sigma = X[..., 2].unsqueeze(-1)
+        offset = X[..., 3].unsqueeze(-1) / self.scale
+        pred = amp * torch.exp(-((self.train_x - mu) ** 2) / 2 / sigma**2) + offset
+        residuals = pred - self.train_y
+        loss = -torch.sum(residuals**2, dim=-1).sqrt()
+
+        return loss
+
+
+def get_initial_parameters(y, inital_guess=None, n_restarts=1, sigma_min=2.0):
+    """
+    Get initial parameters (amp, mu, sigma, offset) for fitting a Gaussian with
+    a constant background to `y`, along with `n_restarts` random perturbations of
+    them, the parameter bounds and a smoothed copy of `y`
+    """
     width = y.shape[0]
     inital_guess = inital_guess or {}
-    sigma_min = 2.0
 
     # specify initial guesses if not provided in initial_guess
     smoothed_y = np.clip(gaussian_filter(y, 3), 0, np.inf)
@@ -82,6 +138,38 @@ def fit_gaussian_linear_background(y, inital_guess=None, visualize=True, n_resta
     # clip on bounds
     para0 = torch.clip(para0, bounds[0], bounds[1])
 
+    return para0, bounds, smoothed_y
+
+
+def get_valid_candidates(candidates, width, sigma_min=2.0):
+    """
+    flag fit candidates (`... x 4`) that return a sigma value close to `sigma_min`
+    or comparable to the projection `width`, or an amplitude that is within the
+    noise
+    """
+    indiv_condition = torch.stack((
+        candidates[..., -2] > sigma_min * 1.1,
+        candidates[..., -2] < width / 1.5,
+        candidates[..., 0] > 100))
+
+    return torch.all(indiv_condition, dim=0)
+
+
+def fit_gaussian_linear_background(y, inital_guess=None, visualize=True, n_restarts=1):
+    """
+    Takes a function y and inputs and fits and Gaussian with
+    linear bg to it. Returns the best fit estimates of the parameters
+    amp, mu, sigma and their associated 1sig error
+    """
+
+    x = np.arange(y.shape[0])
+    width = y.shape[0]
+    sigma_min = 2.0
+
+    para0, bounds, smoothed_y = get_initial_parameters(
+        y, inital_guess, n_restarts, sigma_min
+    )
+
     # create LSQ model
     model = GaussianLeastSquares(torch.tensor(x), torch.tensor(y))
     smoothed_model = GaussianLeastSquares(torch.tensor(x), torch.tensor(smoothed_y))
@@ -107,15 +195,7 @@ def fit_gaussian_linear_background(y, inital_guess=None, visualize=True, n_resta
     # in some cases the fit will return a sigma value of 2.0
     # or an amplitude that is within the noise
     # drop these from candidates
-    # print(candidates)
-    indiv_condition = torch.stack((
-        candidates[:, -2] > sigma_min * 1.1, 
-        candidates[:, -2] < width / 1.5,
-        candidates[:, 0] > 100))
-    # print(indiv_condition)
-    
-    condition = torch.all(indiv_condition,dim=0)
-    # print(condition)
+    condition = get_valid_candidates(candidates, width, sigma_min)
     valid_candidates = candidates[condition]
     valid_values = values[condition]
 
@@ -139,12 +219,362 @@ def fit_gaussian_linear_background(y, inital_guess=None, visualize=True, n_resta
     return candidate
 
 
+@register_fit_method("gaussian")
+def fit_gaussian_linear_background_batch(ys, visualize=False, n_restarts=1):
+    """
+    Fits a Gaussian with a constant background to each projection in `ys` (a list
+    of 1D arrays that may differ in length), using the same initial guesses, bounds
+    and candidate selection as `fit_gaussian_linear_background`. Like the serial
+    fit, the smoothed projections are fit. All projections and restarts are fit in
+    a single vectorized Levenberg-Marquardt solve in which every fit terminates on
+    its own, see `fit_gaussian_linear_background_batch_lbfgs` for a fallback that
+    uses L-BFGS-B.
+
+    Returns an array of shape `n_projections x 4` with the best fit parameters
+    amp, mu, sigma, offset of each projection (NaN if no valid fit was found) and
+    a boolean array flagging the projections with a valid fit.
+    """
+    candidates, costs, condition = _fit_levenberg_marquardt(
+        ys, [None] * len(ys), n_restarts, smoothed=True
+    )
+
+    return _select_candidates(ys, candidates, costs, condition, visualize)
+
+
+@register_fit_method("gaussian_lbfgs")
+def fit_gaussian_linear_background_batch_lbfgs(ys, visualize=False, n_restarts=1):
+    """
+    Fallback of `fit_gaussian_linear_background_batch` that fits the smoothed
+    projections with L-BFGS-B as in the serial fit. Only the restarts of a
+    projection are optimized together, each projection is optimized on its own
+    (a joint solve stops when the summed loss converges, leaving single fits
+    unconverged), so this is much slower.
+    """
+    n_projections = len(ys)
+    sigma_min = 2.0
+
+    para0 = []
+    bounds = []
+    smoothed_ys = []
+    for y in ys:
+        p0, b, sy = get_initial_parameters(y, None, n_restarts, sigma_min)
+        para0 += [p0]
+        bounds += [b]
+        smoothed_ys += [sy]
+
+    # shapes `n_projections x n_candidates x 4` and `2 x n_projections x 1 x 4`
+    para0 = torch.stack(para0).double()
+    bounds = torch.stack(bounds, dim=1).unsqueeze(-2).double()
+    widths = torch.tensor([len(y) for y in ys], dtype=torch.double).unsqueeze(-1)
+
+    # projections where no candidate inside the bounds can be valid are not fit
+    candidates = para0.clone()
+    values = torch.full(para0.shape[:-1], -torch.inf, dtype=torch.double)
+    lower, upper = bounds[..., 0, :]
+    can_be_valid = torch.stack((
+        upper[:, 2] > sigma_min * 1.1,
+        lower[:, 2] < widths[:, 0] / 1.5,
+        upper[:, 0] > 100))
+    fit_ids = torch.where(torch.all(can_be_valid, dim=0))[0]
+
+    for idx in fit_ids:
+        # create LSQ model of the projection
+        smoothed_y = torch.from_numpy(smoothed_ys[idx]).unsqueeze(0)
+        x = torch.arange(smoothed_y.shape[-1], dtype=torch.double)
+        smoothed_model = BatchGaussianLeastSquares(
+            x, smoothed_y, bounds[:, idx : idx + 1]
+        )
+
+        # fit smoothed model to get better initial points
+        scandidates, svalues = gen_candidates_scipy(
+            smoothed_model.to_normalized(para0[idx : idx + 1]),
+            smoothed_model.forward,
+            lower_bounds=0.0,
+            upper_bounds=1.0,
+            options={"maxiter": 50},
+        )
+
+        # refine to convergence, so that identical projections give the same fit
+        fit_candidates, fit_values = gen_candidates_scipy(
+            scandidates,
+            smoothed_model.forward,
+            lower_bounds=0.0,
+            upper_bounds=1.0,
+            options={"maxiter": 500, "ftol": 1e-14, "gtol": 1e-10},
+        )
+        candidates[idx] = smoothed_model.to_parameters(fit_candidates).detach()[0]
+        values[idx] = fit_values.detach()[0]
+
+    # drop invalid candidates and select the best valid one of each projection
+    # (for projections without a valid fit keep the best invalid one for plotting)
+    condition = get_valid_candidates(candidates, widths, sigma_min)
+    masked_values = torch.where(condition, values, -torch.inf)
+    is_valid = torch.any(condition, dim=-1)
+    best = torch.where(
+        is_valid, torch.argmax(masked_values, dim=-1), torch.argmax(values, dim=-1)
+    )
+    is_valid = is_valid.numpy()
+
+    params = candidates[torch.arange(n_projections), best].numpy()
+    if visualize:
+        plot_fits(ys, params, is_valid)
+
+    params = np.where(is_valid[:, np.newaxis], params, np.NaN)
+
+    return params, is_valid
+
+
+def _fit_levenberg_marquardt(
+    ys, inital_guesses, n_restarts=1, sigma_min=2.0, smoothed=False
+):
+    """
+    fit Gaussians with a constant background to a list of projections using the
+    Levenberg-Marquardt engine, first to the smoothed projections to get better
+    initial points and then to the projections themselves (or, if `smoothed` is
+    set, to the smoothed projections until every fit has converged), returns
+    candidates and costs (`n_projections x n_candidates (x 4)`) and candidate
+    validity
+    """
+    para0 = []
+    bounds = []
+    smoothed_ys = []
+    for y, inital_guess in zip(ys, inital_guesses):
+        p0, b, sy = get_initial_parameters(y, inital_guess, n_restarts, sigma_min)
+        para0 += [p0.double().numpy()]
+        bounds += [b.double().numpy()]
+        smoothed_ys += [sy]
+
+    # shapes `n_projections x n_candidates x 4` and `2 x n_projections x 1 x 4`
+    para0 = np.stack(para0)
+    lower, upper = np.stack(bounds, axis=1)[:, :, np.newaxis]
+
+    y, mask, x = pad_projections(ys)
+    smoothed_y, _, _ = pad_projections(smoothed_ys)
+
+    smoothed_model = GaussianLevenbergMarquardt(
+        x, smoothed_y[:, np.newaxis], mask[:, np.newaxis], lower, upper, max_iter=50
+    )
+    scandidates, _, _ = smoothed_model.fit(para0)
+
+    if smoothed:
+        # every fit terminates on its own, so that identical projections give the
+        # same fit regardless of the other projections in the batch
+        model = GaussianLevenbergMarquardt(
+            x,
+            smoothed_y[:, np.newaxis],
+            mask[:, np.newaxis],
+            lower,
+            upper,
+            max_iter=500,
+            ftol=1e-12,
+            xtol=1e-10,
+        )
+    else:
+        model = GaussianLevenbergMarquardt(
+            x, y[:, np.newaxis], mask[:, np.newaxis], lower, upper, max_iter=50
+        )
+    candidates, costs, _ = model.fit(scandidates)
+
+    widths = torch.tensor([len(y) for y in ys], dtype=torch.double).unsqueeze(-1)
+    condition = get_valid_candidates(torch.from_numpy(candidates), widths, sigma_min)
+
+    return candidates, costs, condition.numpy()
+
+
+def fit_gaussian_linear_background_lm(
+    y, inital_guess=None, visualize=True, n_restarts=1
+):
+    """
+    Same as `fit_gaussian_linear_background`, using a Levenberg-Marquardt engine
+    with an analytic jacobian instead of L-BFGS-B with autograd. The smoothed
+    projection is only used to find initial points, the final fit is done on `y`.
+    """
+    x = np.arange(y.shape[0])
+    candidates, costs, condition = _fit_levenberg_marquardt(
+        [y], [inital_guess], n_restarts
+    )
+    candidates, costs, condition = candidates[0], costs[0], condition[0]
+
+    if np.any(condition):
+        # get best valid from restarts
+        candidate = candidates[condition][np.argmin(costs[condition])]
+
+        if visualize:
+            plot_fit(x, y, candidate)
+
+    else:
+        # if no fits were successful return nans
+        bad_candidate = candidates[np.argmin(costs)]
+        if visualize:
+            fig, ax = plot_fit(x, y, bad_candidate)
+            ax.set_title("bad fit")
+
+        candidate = [np.NaN] * 4
+
+    return candidate
+
+
+@register_fit_method("gaussian_lm")
+def fit_gaussian_lm_batch(ys, visualize=False, n_restarts=1):
+    """
+    Batched version of `fit_gaussian_linear_background_lm`, all projections and
+    restarts are fit together by broadcasting. Returns parameters amp, mu, sigma,
+    offset of each projection (NaN if no valid fit was found) and validity flags.
+    """
+    candidates, costs, condition = _fit_levenberg_marquardt(
+        ys, [None] * len(ys), n_restarts
+    )
+
+    return _select_candidates(ys, candidates, costs, condition, visualize)
+
+
+def _select_candidates(ys, candidates, costs, condition, visualize=False):
+    """
+    select the best valid candidate of each projection (for projections without a
+    valid fit the best invalid one is plotted), returns parameters (NaN if no
+    valid fit was found) and validity flags
+    """
+    is_valid = np.any(condition, axis=-1)
+    best = np.where(
+        is_valid,
+        np.argmin(np.where(condition, costs, np.inf), axis=-1),
+        np.argmin(costs, axis=-1),
+    )
+    params = candidates[np.arange(len(ys)), best]
+    if visualize:
+        plot_fits(ys, params, is_valid)
+
+    params = np.where(is_valid[:, np.newaxis], params, np.NaN)
+
+    return params, is_valid
+
+
+def pad_projections(ys):
+    """
+    zero pad a list of 1D projections to the same length, returns the padded
+    projections (`n_projections x length`), a mask of the original values and the
+    pixel coordinates
+    """
+    length = max(len(y) for y in ys)
+    padded = np.zeros((len(ys), length))
+    mask = np.zeros((len(ys), length), dtype=bool)
+    for i, y in enumerate(ys):
+        padded[i, : len(y)] = y
+        mask[i, : len(y)] = True
+
+    return padded, mask, np.arange(length, dtype=np.double)
+
+
+def _validate_estimates(ys, params, sigma_min=2.0):
+    """flag estimates with the same criteria as the Gaussian fit candidates"""
+    widths = torch.tensor([len(y) for y in ys], dtype=torch.double)
+    is_valid = get_valid_candidates(torch.from_numpy(params), widths, sigma_min)
+    is_valid = is_valid.numpy() & np.all(np.isfinite(params), axis=-1)
+
+    return np.where(is_valid[:, np.newaxis], params, np.NaN), is_valid
+
+
+@register_fit_method("moments")
+def fit_moments_batch(ys, visualize=False, n_restarts=1, threshold=0.1):
+    """
+    Thresholded second moment estimate of the beam size. A level of `threshold`
+    times the peak of each projection is subtracted and negative values are
+    clipped, the rms of what remains is corrected for the truncation of a
+    Gaussian profile at that level. Returns parameters amp, mu, sigma, offset of
+    each projection (offset is always zero) and validity flags, `n_restarts` is
+    ignored.
+    """
+    y, mask, x = pad_projections(ys)
+    y = np.where(mask, y, 0.0)
+
+    peak = y.max(axis=-1, keepdims=True)
+    weights = np.clip(y - threshold * peak, 0.0, None)
+    total = weights.sum(axis=-1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mu = (weights * x).sum(axis=-1) / total
+        rms = np.sqrt((weights * (x - mu[:, np.newaxis]) ** 2).sum(axis=-1) / total)
+
+    # ratio of the rms of a Gaussian with the threshold subtracted to sigma
+    a = np.sqrt(-2.0 * np.log(threshold))
+    area = np.sqrt(2.0 * np.pi) * erf(a / np.sqrt(2.0)) - 2.0 * a * threshold
+    correction = np.sqrt((area - 2.0 * threshold * a**3 / 3.0) / area)
+
+    params = np.stack((peak[:, 0], mu, rms / correction, np.zeros_like(mu)), axis=-1)
+    params, is_valid = _validate_estimates(ys, params)
+    if visualize:
+        plot_fits(ys, params, is_valid)
+
+    return params, is_valid
+
+
+@register_fit_method("log_parabola")
+def fit_log_parabola_batch(ys, visualize=False, n_restarts=1, threshold=0.1):
+    """
+    Closed form Gaussian fit by weighted least squares of a parabola to the log of
+    each projection, using the points above `threshold` times the peak weighted
+    by the squared projection values. Returns parameters amp, mu, sigma, offset of
+    each projection (offset is always zero) and validity flags, `n_restarts` is
+    ignored.
+    """
+    y, mask, x = pad_projections(ys)
+    y = np.where(mask, y, 0.0)
+
+    peak = y.max(axis=-1, keepdims=True)
+    used = y > threshold * peak
+    weights = np.where(used, y**2, 0.0)
+    log_y = np.log(np.where(used, y, 1.0))
+
+    # center coordinates on the peak to condition the normal equations
+    x_peak = np.argmax(y, axis=-1).astype(np.double)
+    u = x - x_peak[:, np.newaxis]
+
+    # weighted normal equations for log(y) = c0 + c1 u + c2 u^2
+    powers = u[..., np.newaxis] ** np.arange(5)
+    moments = np.einsum("nl,nlk->nk", weights, powers)
+    lhs = moments[:, np.array([[0, 1, 2], [1, 2, 3], [2, 3, 4]])]
+    rhs = np.einsum("nl,nlk->nk", weights * log_y, powers[..., :3])
+
+    # singular systems (too few points above threshold) give invalid estimates
+    singular = np.linalg.matrix_rank(lhs) < 3
+    lhs[singular] = np.eye(3)
+    c0, c1, c2 = np.linalg.solve(lhs, rhs[..., np.newaxis])[..., 0].T
+    c2 = np.where(singular, np.NaN, c2)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sigma = np.sqrt(-1.0 / (2.0 * c2))
+        mu = x_peak - c1 / (2.0 * c2)
+        amp = np.exp(c0 - c1**2 / (4.0 * c2))
+
+    params = np.stack((amp, mu, sigma, np.zeros_like(mu)), axis=-1)
+    params, is_valid = _validate_estimates(ys, params)
+    if visualize:
+        plot_fits(ys, params, is_valid)
+
+    return params, is_valid
+
+
+def plot_fits(ys, params, is_valid):
+    """plot fits of a batch of projections"""
+    for y, para, valid in zip(ys, params, is_valid):
+        fig, ax = plot_fit(np.arange(len(y)), y, para)
+        if not valid:
+            ax.set_title("bad fit")
+
+
 def plot_fit(x, y, para_x):
     """
     Plot  beamsize fit in x or y direction
     """
     fig, ax = plt.subplots(figsize=(7, 5))
+    draw_fit(ax, x, y, para_x)
+    fig.tight_layout()
+
+    return fig, ax
 
+
+def draw_fit(ax, x, y, para_x):
+    """draw a projection and its fit on `ax`"""
     ax.plot(x, y, label="data")
     ax.plot(
         x,
@@ -156,6 +586,3 @@ def plot_fit(x, y, para_x):
     ax.set_xlabel("Pixel")
     ax.set_ylabel("Counts")
     ax.legend(loc="lower center", bbox_to_anchor=(0.5, -0.3))
-    fig.tight_layout()
-
-    return fig, ax
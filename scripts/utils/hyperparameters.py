@@ -0,0 +1,131 @@
+import json
+import os
+import warnings
+
+import torch
+from botorch import fit_gpytorch_mll
+from botorch.exceptions import ModelFittingError
+from gpytorch import ExactMarginalLogLikelihood
+
+from scripts.utils.writer import write_text_file
+
+# maximum number of optimizer iterations of a warm started fit, a fit starting
+# from the converged values of a previous measurement only needs to follow the
+# (small) change of the data
+WARM_START_MAXITER = 20
+
+
+class HyperparameterStore:
+    """
+    Stores the fitted hyperparameters of the GP models of emittance measurements
+    in a json file so that model fits of repeated measurements can be warm started
+    from the last converged values. Entries are keyed by the measurement (screen,
+    scan quad, beam energy and plane) and a label of the model, since several
+    models (e.g. of the beam size during sampling and of the beam size squared
+    during analysis) are fit to the same measurement. A file that cannot be read
+    is treated as an empty store, the models are then fit from a cold start.
+    """
+
+    def __init__(self, filename: str = None):
+        self.filename = filename
+        self.entries = {}
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    entries = json.load(f)
+            except (OSError, ValueError) as e:
+                warnings.warn(f"could not read hyperparameters from {filename}: {e}")
+            else:
+                if isinstance(entries, dict):
+                    self.entries = entries
+
+    @staticmethod
+    def key(screen, scan_quad_pv, beam_energy, plane):
+        """key of the measurement of one plane"""
+        return f"{screen}|{scan_quad_pv}|{beam_energy:.6g}|{plane}"
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def load(self, model, key, label, index=None):
+        """
+        set the hyperparameters of `model` (or of batch `index` of a batched
+        model) to the stored values, returns True if all hyperparameters were set
+        """
+        stored = self.entries.get(key, {}).get(label)
+        if stored is None:
+            return False
+
+        n_loaded = 0
+        parameters = list(model.named_parameters())
+        with torch.no_grad():
+            for name, parameter in parameters:
+                value = stored.get(_parameter_key(name))
+                if value is None:
+                    continue
+                target = parameter if index is None else parameter[index]
+                value = torch.tensor(value).to(parameter)
+                if value.shape != target.shape:
+                    continue
+                target.copy_(value)
+                n_loaded += 1
+
+        return n_loaded == len(parameters)
+
+    def update(self, model, key, label, index=None):
+        """record the hyperparameters of `model` (or of batch `index`)"""
+        self.entries.setdefault(key, {})[label] = {
+            _parameter_key(name): (
+                parameter if index is None else parameter[index]
+            ).tolist()
+            for name, parameter in model.named_parameters()
+        }
+
+    def save(self):
+        """write the store to its file, replacing the file only once it is complete"""
+        if self.filename is None:
+            return
+        write_text_file(self.filename, json.dumps(self.entries, indent=2))
+
+
+def _parameter_key(name):
+    # the learned noise of a model with fixed (padding) noise is the same
+    # hyperparameter as the noise of a model with a gaussian likelihood
+    return name.replace("second_noise_covar", "noise_covar")
+
+
+def fit_model(model, store=None, keys=None, label=None):
+    """
+    fit the hyperparameters of `model` by maximizing the marginal likelihood, if
+    `store` has values for `keys` (one key, or a list of keys for the batches of a
+    batched model) the fit is warm started from them with an optimizer budget of
+    `WARM_START_MAXITER` iterations, the fitted values are recorded in `store`
+    """
+    mll = ExactMarginalLogLikelihood(model.likelihood, model)
+    if store is None:
+        fit_gpytorch_mll(mll)
+        return model
+
+    indices = [None] if isinstance(keys, str) else range(len(keys))
+    keys = [keys] if isinstance(keys, str) else keys
+
+    warm_start = all(
+        [store.load(model, key, label, index) for key, index in zip(keys, indices)]
+    )
+    try:
+        if warm_start:
+            fit_gpytorch_mll(
+                mll,
+                optimizer_kwargs={"options": {"maxiter": WARM_START_MAXITER}},
+                max_attempts=1,
+            )
+        else:
+            fit_gpytorch_mll(mll)
+    except ModelFittingError:
+        # fall back to a fit with restarts from the priors
+        fit_gpytorch_mll(mll)
+
+    for key, index in zip(keys, indices):
+        store.update(model, key, label, index)
+
+    return model
@@ -0,0 +1,141 @@
+import numpy as np
+
+
+def cast_to_dtype(values, dtype) -> np.ndarray:
+    """cast `values` to `dtype`, rounding and clipping to the range of integer types"""
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        values = np.clip(np.rint(values), info.min, info.max)
+
+    return np.asarray(values).astype(dtype)
+
+
+def split_level(level, dtype):
+    """
+    Split a (float) subtraction `level` into the part that is subtracted from
+    images of `dtype` in place and the remainder (float64, zero for float types).
+
+    For integer types the level is rounded down (and clipped to the range of the
+    type). A pixel that is `a > 0` after subtracting the rounded level is exactly
+    `a - remainder` since the remainder is below one, pixels at zero stay zero,
+    see `project_image`.
+    """
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.integer):
+        return cast_to_dtype(level, dtype), 0.0
+
+    whole = cast_to_dtype(np.floor(level), dtype)
+    remainder = np.asarray(level, dtype=np.double) - whole
+    if not np.any(remainder):
+        remainder = 0.0
+
+    return whole, remainder
+
+
+def crop_to_window(values, window):
+    """crop per pixel `values` to `window`, scalars are returned as they are"""
+    return values[window] if np.ndim(values) else values
+
+
+def project_image(img: np.ndarray, remainder=0.0):
+    """
+    x and y projections (float64) of a preprocessed image, the `remainder` of its
+    subtraction level (see `split_level`) is subtracted from the pixels above zero
+    """
+    x_projection = np.sum(img, axis=0, dtype=np.double)
+    y_projection = np.sum(img, axis=1, dtype=np.double)
+    if np.any(remainder):
+        correction = np.where(img > 0, remainder, 0.0)
+        x_projection -= correction.sum(axis=0)
+        y_projection -= correction.sum(axis=1)
+
+    return x_projection, y_projection
+
+
+def image_intensity(img: np.ndarray, remainder=0.0) -> float:
+    """total intensity of a preprocessed image, see `project_image`"""
+    intensity = img.sum(dtype=np.double)
+    if np.any(remainder):
+        intensity -= np.where(img > 0, remainder, 0.0).sum()
+
+    return intensity
+
+
+def preprocess_image(
+    img: np.ndarray, roi=None, level=0, binning: int = 1, hot_pixels=None
+) -> np.ndarray:
+    """
+    Crop `img` to `roi`, replace the pixels set in the `hot_pixels` mask (of the
+    uncropped image, see `replace_hot_pixels`), bin it by `binning` and subtract
+    `level` (background plus threshold), clipping negative values to zero.
+
+    Only the roi is copied, in the native dtype of `img` (widened if binned), and
+    the subtraction and clipping are done in place on that copy. `level` must
+    already be binned and cast to the dtype of the binned image (see
+    `binned_dtype` and `split_level`, the fractional remainder of the level of
+    integer images is applied when the image is projected). Computing
+    max(img, level) - level never goes below zero, which keeps this safe for
+    unsigned camera data.
+    """
+    if roi is not None:
+        img = roi.crop_image(img)
+        hot_pixels = None if hot_pixels is None else roi.crop_image(hot_pixels)
+
+    if hot_pixels is not None:
+        img = replace_hot_pixels(img, hot_pixels)
+
+    img = np.array(bin_image(img, binning), order="C")
+    np.maximum(img, level, out=img)
+    img -= level
+
+    return img
+
+
+def replace_hot_pixels(img: np.ndarray, hot_pixels: np.ndarray) -> np.ndarray:
+    """
+    Return a copy of `img` where the pixels set in the boolean `hot_pixels` mask
+    are replaced by the median of their (up to eight) neighbours that are not hot,
+    pixels without such neighbours are kept.
+    """
+    img = np.array(img)
+    rows, cols = np.nonzero(hot_pixels)
+    if not len(rows):
+        return img
+
+    neighbours = np.full((len(rows), 8), np.nan)
+    offsets = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx]
+    for i, (dy, dx) in enumerate(offsets):
+        r, c = rows + dy, cols + dx
+        valid = (r >= 0) & (r < img.shape[0]) & (c >= 0) & (c < img.shape[1])
+        valid[valid] = ~hot_pixels[r[valid], c[valid]]
+        neighbours[valid, i] = img[r[valid], c[valid]]
+
+    replaced = ~np.all(np.isnan(neighbours), axis=1)
+    img[rows[replaced], cols[replaced]] = cast_to_dtype(
+        np.nanmedian(neighbours[replaced], axis=1), img.dtype
+    )
+
+    return img
+
+
+def binned_dtype(dtype, factor: int = 1) -> np.dtype:
+    """dtype that holds the sum of `factor` x `factor` pixels of type `dtype`"""
+    dtype = np.dtype(dtype)
+    if factor > 1 and np.issubdtype(dtype, np.integer) and dtype.itemsize < 4:
+        return np.dtype(np.int32 if np.issubdtype(dtype, np.signedinteger) else np.uint32)
+    return dtype
+
+
+def bin_image(img: np.ndarray, factor: int = 1) -> np.ndarray:
+    """
+    Sum `factor` x `factor` blocks of pixels, trailing rows and columns that do not
+    fill a block are dropped. Integer images are summed in a wider dtype (see
+    `binned_dtype`) so that binning does not overflow.
+    """
+    if factor == 1:
+        return img
+
+    ny, nx = img.shape[0] // factor, img.shape[1] // factor
+    blocks = img[: ny * factor, : nx * factor].reshape(ny, factor, nx, factor)
+    return blocks.sum(axis=(1, 3), dtype=binned_dtype(img.dtype, factor))
@@ -0,0 +1,130 @@
+import numpy as np
+
+
+class GaussianLevenbergMarquardt:
+    """
+    Bounded Levenberg-Marquardt least squares fit of a Gaussian plus offset
+    `amp * exp(-(x - mu)^2 / 2 sigma^2) + offset` with an analytic jacobian.
+
+    Parameters have shape `... x 4` (amp, mu, sigma, offset) and the data `y` (and
+    optional `mask` of valid points) are broadcast against the leading dimensions
+    of the parameters, e.g. data of shape `n_projections x 1 x n_points` for
+    parameters of shape `n_projections x n_restarts x 4`. Bounds are enforced by
+    projecting every step onto the box `[lower, upper]`.
+    """
+
+    def __init__(
+        self,
+        x: np.ndarray,
+        y: np.ndarray,
+        mask: np.ndarray = None,
+        lower: np.ndarray = None,
+        upper: np.ndarray = None,
+        max_iter: int = 100,
+        ftol: float = 1e-8,
+        xtol: float = 1e-8,
+    ):
+        self.x = np.asarray(x, dtype=np.double)
+        self.y = np.asarray(y, dtype=np.double)
+        self.mask = None if mask is None else np.asarray(mask, dtype=np.double)
+        self.lower = -np.inf if lower is None else lower
+        self.upper = np.inf if upper is None else upper
+        self.max_iter = max_iter
+        self.ftol = ftol
+        self.xtol = xtol
+
+    def residuals(self, params, jacobian=False):
+        """residuals (`... x n_points`) and optionally the jacobian w.r.t. params"""
+        return self._evaluate(params, self.y, self.mask, jacobian)
+
+    def _evaluate(self, params, y, mask, jacobian=False):
+        amp, mu, sigma, offset = [params[..., i, np.newaxis] for i in range(4)]
+        dx = self.x - mu
+        gaussian = np.exp(-(dx**2) / 2 / sigma**2)
+        residuals = amp * gaussian + offset - y
+        if mask is not None:
+            residuals = residuals * mask
+
+        if not jacobian:
+            return residuals
+
+        d_amp = gaussian
+        d_mu = amp * gaussian * dx / sigma**2
+        d_sigma = d_mu * dx / sigma
+        d_offset = np.ones_like(gaussian)
+        jac = np.stack((d_amp, d_mu, d_sigma, d_offset), axis=-1)
+        if mask is not None:
+            jac = jac * mask[..., np.newaxis]
+
+        return residuals, jac
+
+    def fit(self, params0):
+        """
+        minimize the sum of squared residuals starting from `params0`, returns the
+        best fit parameters, the final cost (half the sum of squared residuals)
+        and the number of model (residual and jacobian) evaluations
+        """
+        params = np.clip(np.asarray(params0, dtype=np.double), self.lower, self.upper)
+        shape = params.shape
+        n_points = self.x.shape[-1]
+
+        # broadcast data and bounds against the parameters and flatten the batch,
+        # only fits that have not converged yet are evaluated in each iteration
+        data_shape = shape[:-1] + (n_points,)
+        y = np.broadcast_to(self.y, data_shape).reshape(-1, n_points)
+        mask = None
+        if self.mask is not None:
+            mask = np.broadcast_to(self.mask, data_shape).reshape(-1, n_points)
+        lower = np.broadcast_to(self.lower, shape).reshape(-1, 4)
+        upper = np.broadcast_to(self.upper, shape).reshape(-1, 4)
+        params = params.reshape(-1, 4).copy()
+
+        residuals, jac = self._evaluate(params, y, mask, jacobian=True)
+        cost = 0.5 * np.sum(residuals**2, axis=-1)
+        damping = np.full(len(params), 1e-3)
+        active = np.arange(len(params))
+        n_evaluations = 1
+
+        for _ in range(self.max_iter):
+            jac_t = np.swapaxes(jac, -1, -2)
+            jtj = jac_t @ jac
+            gradient = (jac_t @ residuals[..., np.newaxis])[..., 0]
+
+            # scale damping by the diagonal of the approximate hessian
+            diagonal = np.diagonal(jtj, axis1=-2, axis2=-1)
+            scaled = damping[active, np.newaxis] * np.maximum(diagonal, 1e-12)
+            step = -np.linalg.solve(
+                jtj + scaled[..., np.newaxis] * np.eye(4), gradient[..., np.newaxis]
+            )[..., 0]
+
+            current = params[active]
+            trial = np.clip(current + step, lower[active], upper[active])
+            trial_residuals, trial_jac = self._evaluate(
+                trial, y[active], None if mask is None else mask[active], True
+            )
+            trial_cost = 0.5 * np.sum(trial_residuals**2, axis=-1)
+            n_evaluations += 1
+
+            improved = trial_cost < cost[active]
+            converged = improved & (
+                (cost[active] - trial_cost <= self.ftol * cost[active])
+                | np.all(
+                    np.abs(trial - current) <= self.xtol * (np.abs(current) + self.xtol),
+                    axis=-1,
+                )
+            )
+
+            params[active[improved]] = trial[improved]
+            cost[active[improved]] = trial_cost[improved]
+            damping[active] = np.where(
+                improved, damping[active] / 10.0, damping[active] * 10.0
+            )
+            residuals = np.where(improved[:, np.newaxis], trial_residuals, residuals)
+            jac = np.where(improved[:, np.newaxis, np.newaxis], trial_jac, jac)
+
+            keep = ~converged & (damping[active] < 1e12)
+            active, residuals, jac = active[keep], residuals[keep], jac[keep]
+            if not len(active):
+                break
+
+        return params.reshape(shape), cost.reshape(shape[:-1]), n_evaluations
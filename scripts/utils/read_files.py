@@ -1,21 +1,167 @@
+import glob
+import os
+from typing import Dict, Tuple, Union
+
 import h5py
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
 
 
-def read_file(fname):
-    with h5py.File(fname, "r") as f:
-        results = {"images": f["images"][:]}
+class ImageFile:
+    """
+    Lazy view of the images saved in a single measurement file or a run archive.
+    The file is opened on first access and frames are only read when they are
+    indexed, e.g. `ImageFile(fname)[10:20]` reads ten frames.
+    """
 
-        for name, val in f["images"].attrs.items():
-            results[name] = val
+    def __init__(self, fname: str):
+        self.fname = fname
+        self._file = None
 
-    return results
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def __getitem__(self, item):
+        return self.images[item]
+
+    @property
+    def file(self) -> h5py.File:
+        if self._file is None:
+            self._file = h5py.File(self.fname, "r", swmr=True)
+        return self._file
+
+    @property
+    def images(self) -> h5py.Dataset:
+        return self.file["images"]
 
+    @property
+    def is_archive(self) -> bool:
+        return "metadata" in self.file
 
-def plot_file(fname):
-    with h5py.File(fname, "r") as f:
-        results = {"images": f["images"][:]}
+    @property
+    def attrs(self) -> Dict:
+        """attributes of the file, for archives the configuration of the screen"""
+        attrs = self.file.attrs if self.is_archive else self.images.attrs
+        return dict(attrs.items())
 
-        for name, val in f["images"].attrs.items():
-            results[name] = val
+    def frames(self) -> Union[np.ndarray, h5py.Dataset]:
+        """
+        return a memory map of the images if they are stored contiguously and
+        uncompressed, otherwise the (lazily sliced) h5 dataset
+        """
+        dset = self.images
+        offset = dset.id.get_offset()
+        if dset.chunks is None and offset is not None:
+            return np.memmap(
+                self.fname, mode="r", dtype=dset.dtype, shape=dset.shape, offset=offset
+            )
+        return dset
+
+    def metadata(self) -> pd.DataFrame:
+        """one row of attributes per frame"""
+        n_frames = len(self)
+        if self.is_archive:
+            columns = {}
+            for name, dset in self.file["metadata"].items():
+                values = dset[:n_frames]
+                if h5py.check_string_dtype(dset.dtype) is not None:
+                    values = values.astype(str)
+                columns[name] = values
+            return pd.DataFrame(columns, index=range(n_frames))
+
+        # per-measurement files store one attribute per measurement, lists with one
+        # element per shot are split into rows
+        columns = {}
+        for name, val in self.attrs.items():
+            if isinstance(val, np.ndarray) and val.ndim == 1 and len(val) == n_frames:
+                columns[name] = val
+            elif np.ndim(val) == 0:
+                columns[name] = [val] * n_frames
+        return pd.DataFrame(columns, index=range(n_frames))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_file(fname, frames=slice(None)):
+    """
+    read the attributes and the images of a saved file, `frames` selects the frames
+    that are read (all by default, none if `frames` is None)
+    """
+    with ImageFile(fname) as f:
+        results = {"images": None if frames is None else f[frames]}
+        results.update(f.attrs)
 
     return results
+
+
+def build_index(run_dir: str, pattern: str = "*.h5") -> pd.DataFrame:
+    """
+    build an index with one row per frame of all files in `run_dir`, containing
+    the file name (`fname`), the frame in the file (`frame`) and the attributes
+    of the frame, only attributes are read
+    """
+    indices = []
+    for fname in sorted(glob.glob(os.path.join(run_dir, pattern))):
+        with ImageFile(fname) as f:
+            if "images" not in f.file:
+                continue
+            index = f.metadata()
+            index.insert(0, "frame", np.arange(len(index)))
+            index.insert(0, "fname", fname)
+            indices += [index]
+
+    if not indices:
+        return pd.DataFrame(columns=["fname", "frame"])
+
+    return pd.concat(indices, ignore_index=True)
+
+
+def query_frames(
+    index: pd.DataFrame, **ranges: Tuple[float, float]
+) -> Tuple[np.ndarray, pd.DataFrame]:
+    """
+    read the frames in `index` whose attributes are inside the given (inclusive)
+    ranges, e.g. `query_frames(index, **{"QUAD:IN20:525:BCTRL": (-2.0, 2.0)})`,
+    returns the stacked frames and the matching rows of the index, no frames are
+    returned as an empty stack of frames of the shape of the first indexed file
+    """
+    mask = np.ones(len(index), dtype=bool)
+    for name, (low, high) in ranges.items():
+        mask &= index[name].between(low, high).to_numpy()
+    selected = index[mask].sort_values(["fname", "frame"])
+
+    images = []
+    for fname, rows in selected.groupby("fname"):
+        with ImageFile(fname) as f:
+            images += [f[rows["frame"].to_numpy()]]
+
+    if not images:
+        if not len(index):
+            return np.empty((0,)), selected
+        with ImageFile(index["fname"].iloc[0]) as f:
+            shape, dtype = f.images.shape[1:], f.images.dtype
+        return np.empty((0, *shape), dtype=dtype), selected
+
+    return np.concatenate(images), selected
+
+
+def plot_file(fname, frame: int = 0, ax=None):
+    """plot a single frame of a saved file"""
+    if ax is None:
+        fig, ax = plt.subplots()
+
+    with ImageFile(fname) as f:
+        ax.imshow(f[frame])
+        ax.set_title(f"{os.path.basename(fname)}, frame {frame}")
+
+    return ax
@@ -0,0 +1,129 @@
+import os
+import threading
+from collections import deque, OrderedDict
+from typing import Dict, List
+
+import numpy as np
+from matplotlib import patches
+from matplotlib.figure import Figure
+
+from scripts.utils.fitting_methods import draw_fit
+from scripts.utils.writer import AsyncWriter
+
+
+class DiagnosticRenderer:
+    """
+    Renders diagnostic figures of beam size measurements outside of the
+    measurement loop. The measurement only records the processed image and the
+    fit results of each shot (see `record`), figures are rendered either on demand
+    by `render` or by a background thread (`mode="background"`).
+
+    Figures are created without pyplot, so they are never registered with a GUI
+    and are freed once they drop out of the cache of the last `cache_size`
+    figures. If `save_location` is given every rendered figure is also saved to a
+    png file there.
+    """
+
+    def __init__(
+        self,
+        name: str = "diagnostic",
+        mode: str = "on_demand",
+        cache_size: int = 16,
+        save_location: str = None,
+    ):
+        self.name = name.replace(":", "_")
+        self.mode = mode
+        self.save_location = save_location
+        self._pending = deque(maxlen=cache_size)
+        self._figures = OrderedDict()
+        self._cache_size = cache_size
+        self._count = 0
+        self._lock = threading.Lock()
+        self._writer = AsyncWriter(maxsize=cache_size) if mode == "background" else None
+
+    def record(self, record: Dict):
+        """record the data needed to render the figure of a shot"""
+        with self._lock:
+            self._count += 1
+            key = self._count
+
+        if self._writer is not None:
+            self._writer.submit(self._render_record, key, record)
+        else:
+            with self._lock:
+                self._pending.append((key, record))
+
+    def render(self) -> List[Figure]:
+        """render recorded shots that were not rendered yet, returns all cached figures"""
+        if self._writer is not None:
+            self._writer.flush()
+
+        while True:
+            with self._lock:
+                if not self._pending:
+                    break
+                key, record = self._pending.popleft()
+            self._render_record(key, record)
+
+        return self.figures
+
+    @property
+    def figures(self) -> List[Figure]:
+        """cached figures, oldest first"""
+        with self._lock:
+            return list(self._figures.values())
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    def _render_record(self, key, record):
+        fig = render_shot(record)
+        if self.save_location is not None:
+            fig.savefig(os.path.join(self.save_location, f"{self.name}_{key}.png"))
+
+        with self._lock:
+            self._figures[key] = fig
+            while len(self._figures) > self._cache_size:
+                self._figures.popitem(last=False)
+
+
+def render_shot(record: Dict) -> Figure:
+    """
+    figure of the processed image of a shot with the beam bounding box and the
+    roi circle, and of the fits of its x and y projections
+    """
+    fig = Figure(figsize=(14, 4.5))
+    image_ax, x_ax, y_ax = fig.subplots(1, 3)
+
+    img = record["image"]
+    c = image_ax.imshow(img, origin="lower")
+    fig.colorbar(c, ax=image_ax)
+
+    roi_c = np.array(img.shape) / 2
+    roi_radius = np.min((roi_c * 2, np.array(img.shape))) / 2
+    image_ax.plot(*roi_c[::-1], ".r")
+    image_ax.add_patch(
+        patches.Circle(roi_c[::-1], roi_radius, facecolor="none", edgecolor="r")
+    )
+
+    centroid, sizes = record["centroid"], record["sizes"]
+    if np.all(np.isfinite(np.stack((centroid, sizes)))):
+        n_stds = record["n_stds"]
+        image_ax.plot(*centroid, "+r")
+        image_ax.add_patch(
+            patches.Rectangle(
+                centroid - n_stds * sizes,
+                *sizes * n_stds * 2.0,
+                facecolor="none",
+                edgecolor="r",
+            )
+        )
+
+    for ax, y, para in zip((x_ax, y_ax), record["projections"], record["params"]):
+        draw_fit(ax, np.arange(len(y)), y, para)
+        if np.any(np.isnan(para)):
+            ax.set_title("bad fit")
+
+    fig.tight_layout()
+    return fig
@@ -0,0 +1,114 @@
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+
+class ShotResults(dict):
+    """
+    Results of a multi-shot measurement stored by column, one contiguous numpy
+    array of length `n_shots` per per-shot quantity. Quantities added after the
+    measurement (e.g. the name of the file the images were saved to) are stored
+    as they are. Being a dictionary, results can be returned directly by Xopt
+    evaluators, which expand array outputs into one row per shot.
+    """
+
+    __slots__ = ("n_shots",)
+
+    def __init__(self, columns: Dict[str, np.ndarray] = None, n_shots: int = 0):
+        super().__init__(columns or {})
+        self.n_shots = n_shots
+
+    @classmethod
+    def from_shots(cls, results: List[dict]) -> "ShotResults":
+        """combine per-shot result dictionaries, missing values are NaN"""
+        names = dict.fromkeys(name for result in results for name in result)
+        columns = {
+            name: _column([result.get(name, np.nan) for result in results])
+            for name in names
+        }
+        return cls(columns, len(results))
+
+    def is_column(self, name) -> bool:
+        """check if `name` holds one value per shot"""
+        value = self[name]
+        return (
+            isinstance(value, np.ndarray)
+            and value.ndim > 0
+            and len(value) == self.n_shots
+        )
+
+    @property
+    def numerical_columns(self) -> List[str]:
+        """names of scalar floating point per-shot quantities"""
+        return [
+            name
+            for name, value in self.items()
+            if self.is_column(name) and value.ndim == 1 and value.dtype.kind == "f"
+        ]
+
+    def mean(self) -> Dict[str, float]:
+        return {name: self[name].mean() for name in self.numerical_columns}
+
+    def var(self) -> Dict[str, float]:
+        return {name: self[name].var() for name in self.numerical_columns}
+
+    def std(self) -> Dict[str, float]:
+        return {name: self[name].std() for name in self.numerical_columns}
+
+    def sem(self) -> Dict[str, float]:
+        """standard error of the mean of each quantity, ignoring NaN shots"""
+        sem = {}
+        for name in self.numerical_columns:
+            n_valid = np.count_nonzero(~np.isnan(self[name]))
+            sem[name] = (
+                np.nanstd(self[name], ddof=1) / np.sqrt(n_valid)
+                if n_valid > 1
+                else np.nan
+            )
+        return sem
+
+    def statistics(self) -> dict:
+        """
+        replace numerical per-shot quantities by their mean and add their
+        variance as `<name>_var`, other quantities are passed on unchanged
+        """
+        numerical_columns = self.numerical_columns
+        outputs = {}
+        for name, value in self.items():
+            if name in numerical_columns:
+                outputs[name] = value.mean()
+                outputs[f"{name}_var"] = value.var()
+            else:
+                outputs[name] = value
+
+        return outputs
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        one row per shot, quantities that are not per-shot are repeated for every
+        shot and per-shot arrays are stored as one array per row
+        """
+        data = {
+            name: list(value) if self.is_column(name) and value.ndim > 1 else value
+            for name, value in self.items()
+        }
+        return pd.DataFrame(data, index=pd.RangeIndex(self.n_shots), copy=False)
+
+
+def _column(values: list) -> np.ndarray:
+    try:
+        column = np.asarray(values)
+    except ValueError:
+        # per-shot arrays that differ in shape
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+
+    if column.dtype == object:
+        # e.g. shots with a missing (None) result
+        try:
+            column = column.astype(np.double)
+        except (TypeError, ValueError):
+            pass
+    return column
@@ -0,0 +1,198 @@
+import numpy as np
+
+
+class RunningStatistics:
+    """
+    Per-pixel running mean and variance of a stream of frames (Welford's
+    algorithm), using constant memory independent of the number of frames.
+    Frames are accepted in their native dtype, statistics are accumulated in
+    double precision. Statistics of separate streams are combined with `merge`
+    (Chan et al.).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._mean = None
+        self._m2 = None
+
+    def update(self, frame: np.ndarray):
+        """add a frame to the statistics"""
+        if self._mean is None:
+            self._mean = np.zeros(frame.shape)
+            self._m2 = np.zeros(frame.shape)
+
+        self.count += 1
+        delta = np.subtract(frame, self._mean, dtype=np.double)
+        self._mean += delta / self.count
+        delta *= np.subtract(frame, self._mean, dtype=np.double)
+        self._m2 += delta
+
+    def update_batch(self, values: np.ndarray):
+        """add a batch of observations stacked along the first axis"""
+        if len(values) == 0:
+            return
+
+        batch = RunningStatistics()
+        batch.count = len(values)
+        batch._mean = np.asarray(np.mean(values, axis=0, dtype=np.double))
+        batch._m2 = np.asarray(np.sum((values - batch._mean) ** 2, axis=0))
+        self.merge(batch)
+
+    def merge(self, other: "RunningStatistics"):
+        """combine the statistics of another stream into these statistics"""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self._mean = other._mean.copy()
+            self._m2 = other._m2.copy()
+            return
+
+        count = self.count + other.count
+        delta = other._mean - self._mean
+        self._mean += delta * other.count / count
+        self._m2 += other._m2 + delta**2 * self.count * other.count / count
+        self.count = count
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self._mean
+
+    @property
+    def variance(self) -> np.ndarray:
+        """unbiased sample variance"""
+        if self.count < 2:
+            return np.zeros_like(self._mean)
+        return self._m2 / (self.count - 1)
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.variance)
+
+    def hot_pixels(self, n_sigma: float = 5.0) -> np.ndarray:
+        """
+        flag pixels whose mean or standard deviation is more than `n_sigma` robust
+        standard deviations (scaled median absolute deviation) above the median
+        over all pixels
+        """
+        return _outliers(self.mean, n_sigma) | _outliers(self.std, n_sigma)
+
+
+class RunningMedian:
+    """
+    Per-pixel median estimate of a stream of frames in constant memory (remedian,
+    Rousseeuw and Bassett 1990). Frames are collected in buffers of `base` frames,
+    the median of a full buffer is passed on to the buffer of the next level. The
+    estimate is the weighted median of all buffered values, each weighted by the
+    number of frames it represents. Memory grows with the logarithm of the number
+    of frames.
+    """
+
+    def __init__(self, base: int = 11):
+        self.base = base
+        self.count = 0
+        self._levels = []
+
+    def update(self, frame: np.ndarray):
+        """add a frame to the estimate"""
+        self.count += 1
+        value = np.array(frame)
+        for level in self._levels:
+            level.append(value)
+            if len(level) < self.base:
+                return
+            value = np.median(np.stack(level), axis=0)
+            level.clear()
+
+        self._levels.append([value])
+
+    @property
+    def median(self) -> np.ndarray:
+        values = []
+        weights = []
+        for i, level in enumerate(self._levels):
+            values += level
+            weights += [self.base**i] * len(level)
+
+        values = np.stack(values).astype(np.double)
+        weights = np.array(weights, dtype=np.double)
+
+        # per-pixel weighted median
+        order = np.argsort(values, axis=0)
+        cumulative = np.cumsum(weights[order], axis=0)
+        index = np.argmax(cumulative >= cumulative[-1] / 2, axis=0)
+        return np.take_along_axis(
+            np.take_along_axis(values, order, axis=0), index[np.newaxis], axis=0
+        )[0]
+
+
+class QuantileSketch:
+    """
+    Quantiles of a stream of values in bounded memory (compactor sketch, Karnin,
+    Lang and Liberty 2016). Values are collected in a buffer of `capacity` items,
+    a full buffer is sorted and every other item (random offset) is passed on to
+    the buffer of the next level, where it represents twice as many values. The
+    memory grows with the logarithm of the number of values, the rank error of the
+    quantiles is of the order of 1 / `capacity`. Sketches of separate streams are
+    combined with `merge`.
+    """
+
+    def __init__(self, capacity: int = 4096, seed: int = None):
+        self.capacity = capacity
+        self.count = 0
+        self._levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values: np.ndarray):
+        """add values to the sketch"""
+        values = np.asarray(values, dtype=np.double).ravel()
+        self.count += len(values)
+        self._levels[0] = np.concatenate((self._levels[0], values))
+        self._compact()
+
+    def merge(self, other: "QuantileSketch"):
+        """combine the values of another sketch into this sketch"""
+        self.count += other.count
+        for level, values in enumerate(other._levels):
+            if level == len(self._levels):
+                self._levels.append(np.empty(0))
+            self._levels[level] = np.concatenate((self._levels[level], values))
+        self._compact()
+
+    def _compact(self):
+        level = 0
+        while level < len(self._levels):
+            values = self._levels[level]
+            if len(values) > self.capacity:
+                values = np.sort(values)
+
+                # an odd item out stays at this level
+                n_compacted = len(values) - len(values) % 2
+                offset = self._rng.integers(2)
+                if level + 1 == len(self._levels):
+                    self._levels.append(np.empty(0))
+                self._levels[level + 1] = np.concatenate(
+                    (self._levels[level + 1], values[offset:n_compacted:2])
+                )
+                self._levels[level] = values[n_compacted:]
+            level += 1
+
+    def quantile(self, q) -> np.ndarray:
+        """estimate the quantile(s) `q` of all values added to the sketch"""
+        values = np.concatenate(self._levels)
+        weights = np.concatenate(
+            [np.full(len(values), 2.0**i) for i, values in enumerate(self._levels)]
+        )
+        if len(values) == 0:
+            return np.full(np.shape(q), np.nan)
+
+        order = np.argsort(values)
+        cumulative = np.cumsum(weights[order])
+        index = np.searchsorted(cumulative, np.asarray(q) * cumulative[-1])
+        return values[order][np.minimum(index, len(values) - 1)]
+
+
+def _outliers(values: np.ndarray, n_sigma: float) -> np.ndarray:
+    median = np.median(values)
+    spread = 1.4826 * np.median(np.abs(values - median))
+    return values > median + n_sigma * max(spread, np.finfo(np.double).eps)
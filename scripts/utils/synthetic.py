@@ -0,0 +1,113 @@
+import time
+from typing import Dict, List
+
+import numpy as np
+import torch
+from emitopt.utils import build_quad_rmat
+from pydantic import BaseModel, NonNegativeFloat, PositiveFloat, PositiveInt
+
+from scripts.automatic_emittance import BeamlineConfig
+from scripts.utils.image_processing import cast_to_dtype
+
+
+class SyntheticBeam(BaseModel):
+    """
+    Synthetic beam and screen camera for offline testing of quad scan emittance
+    measurements.
+
+    The beam is described by Twiss parameters and normalized emittances (in
+    [mm-mrad], the units of the emittance analysis results) at the entrance of the
+    scan quadrupole. Beam sizes on the screen are calculated with the same thick
+    quad transport used by `compute_emit_bmag_thick_quad` for the scan quad value
+    stored in `pvs`, and frames of a Gaussian beam with shot noise and read noise
+    are rendered at up to `frame_rate` frames per second.
+    """
+
+    beamline_config: BeamlineConfig
+    beta_x: PositiveFloat
+    alpha_x: float = 0.0
+    emittance_x: PositiveFloat
+    beta_y: PositiveFloat
+    alpha_y: float = 0.0
+    emittance_y: PositiveFloat
+
+    shape: List[PositiveInt] = [1000, 1000]
+    dtype: str = "uint16"
+    resolution: PositiveFloat = 10.0  # in microns per pixel
+    total_intensity: PositiveFloat = 1e7
+    background_level: NonNegativeFloat = 100.0
+    read_noise: NonNegativeFloat = 5.0
+    centroid_jitter: NonNegativeFloat = 1.0
+    frame_rate: PositiveFloat = 10.0
+    seed: int = None
+
+    pvs: Dict[str, float] = {}
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._rng = np.random.default_rng(self.seed)
+        self._last_frame_time = 0.0
+
+    def get_pv(self, name):
+        return self.pvs.get(name, 0.0)
+
+    def set_pv(self, name, value):
+        self.pvs[name] = value
+
+    def beam_sizes(self, quad_value: float = None) -> np.ndarray:
+        """rms beam sizes (x, y) on the screen in [m] for a scan quad pv value"""
+        if quad_value is None:
+            quad_value = self.get_pv(self.beamline_config.scan_quad_pv)
+
+        gamma = self.beamline_config.beam_energy / 0.511e-3
+        k = quad_value * self.beamline_config.pv_to_focusing_strength
+
+        sizes = []
+        for sign, rmat, beta, alpha, emittance in (
+            (1.0, self.beamline_config.transport_matrix_x, self.beta_x,
+             self.alpha_x, self.emittance_x),
+            (-1.0, self.beamline_config.transport_matrix_y, self.beta_y,
+             self.alpha_y, self.emittance_y),
+        ):
+            # beam matrix at the quad entrance in [m^2], emittances are in
+            # normalized [mm-mrad]
+            geometric_emittance = emittance * 1e-6 / gamma
+            sig = geometric_emittance * torch.tensor(
+                [[beta, -alpha], [-alpha, (1 + alpha**2) / beta]]
+            ).double()
+
+            # flip sign of focusing strengths for y
+            quad_rmat = build_quad_rmat(
+                torch.tensor([sign * k]).double(), self.beamline_config.scan_quad_length
+            )[0]
+            total_rmat = torch.tensor(rmat).double() @ quad_rmat
+            sizes += [float(torch.sqrt((total_rmat @ sig @ total_rmat.T)[0, 0]))]
+
+        return np.array(sizes)
+
+    def render(self, quad_value: float = None) -> np.ndarray:
+        """render a noisy frame of the beam on the screen"""
+        ny, nx = self.shape
+        sx, sy = self.beam_sizes(quad_value) * 1e6 / self.resolution
+        cx, cy = (
+            np.array((nx, ny)) / 2 + self._rng.normal(size=2) * self.centroid_jitter
+        )
+
+        # the beam is separable, render it as an outer product of its projections
+        x = np.exp(-((np.arange(nx) - cx) ** 2) / 2 / sx**2)
+        y = np.exp(-((np.arange(ny) - cy) ** 2) / 2 / sy**2)
+        img = np.outer(y, x) * self.total_intensity / (2 * np.pi * sx * sy)
+
+        img = self._rng.poisson(img) + self.background_level
+        img += self._rng.normal(size=img.shape) * self.read_noise
+
+        return cast_to_dtype(img, self.dtype)
+
+    def next_frame(self) -> np.ndarray:
+        """render the next frame, waiting to limit the rate to `frame_rate`"""
+        wait = self._last_frame_time + 1.0 / self.frame_rate - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        self._last_frame_time = time.perf_counter()
+
+        return self.render()
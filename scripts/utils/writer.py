@@ -0,0 +1,77 @@
+import atexit
+import os
+import queue
+import threading
+from typing import Callable
+
+_STOP = object()
+
+
+class AsyncWriter:
+    """
+    Runs write tasks (e.g. saving images or dumping optimizer state) in a
+    background thread so that they do not block the measurement. Tasks are queued
+    in submission order, at most `maxsize` tasks can be waiting and `submit` blocks
+    until there is space in the queue (backpressure). Pending tasks are written
+    when the interpreter exits. An exception raised by a task is re-raised by the
+    next call to `submit`, `flush` or `close`.
+    """
+
+    def __init__(self, maxsize: int = 8, name: str = "async-writer"):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def submit(self, function: Callable, *args, **kwargs):
+        """queue `function(*args, **kwargs)` to be run by the writer thread"""
+        self._raise_error()
+        if self._closed:
+            raise RuntimeError("cannot submit to a closed writer")
+        self._queue.put((function, args, kwargs))
+
+    def flush(self):
+        """wait until all queued tasks are written"""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """write all queued tasks and stop the writer thread"""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_STOP)
+            self._thread.join()
+            atexit.unregister(self.close)
+        self._raise_error()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is _STOP:
+                    return
+                function, args, kwargs = task
+                function(*args, **kwargs)
+            except Exception as e:
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("asynchronous write failed") from error
+
+
+def write_text_file(fname: str, text: str):
+    """write `text` to `fname`, replacing the file only once it is complete"""
+    tmp_fname = f"{fname}.tmp"
+    with open(tmp_fname, "w") as f:
+        f.write(text)
+    os.replace(tmp_fname, fname)
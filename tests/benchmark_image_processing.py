@@ -0,0 +1,217 @@
+"""
+Benchmarks of the image processing stages of the beam size measurement.
+
+Each stage is timed on synthetic frames of a Gaussian beam for a grid of frame
+sizes, ROIs, noise levels, fit restarts and fit methods. The report lists the
+median latency of each stage, the corresponding throughput in frames per second
+and the peak memory allocated by the stage (tracemalloc, numpy and python
+allocations only).
+
+Run from the repository root:
+
+    python -m tests.benchmark_image_processing --output benchmarks.csv
+
+and compare against a previous report to catch regressions:
+
+    python -m tests.benchmark_image_processing --baseline benchmarks.csv
+"""
+import argparse
+import itertools
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+from scripts.image import ImageDiagnostic, ROI
+from scripts.utils.fitting_methods import FIT_METHODS, fit_gaussian_linear_background
+
+
+def make_frame(size, noise=5.0, background=100.0, dtype="uint16", seed=0):
+    """square frame of a Gaussian beam with shot noise and read noise"""
+    rng = np.random.default_rng(seed)
+    sigma_x, sigma_y = size / 20, size / 15
+    x = np.exp(-((np.arange(size) - size * 0.45) ** 2) / 2 / sigma_x**2)
+    y = np.exp(-((np.arange(size) - size * 0.55) ** 2) / 2 / sigma_y**2)
+    img = np.outer(y, x) * 1e3
+
+    img = rng.poisson(img) + background + rng.normal(size=img.shape) * noise
+    return np.clip(img, 0, np.iinfo(dtype).max).astype(dtype)
+
+
+class FrameDiagnostic(ImageDiagnostic):
+    """image diagnostic that returns a fixed frame instead of reading a camera"""
+
+    def __init__(self, frame, **kwargs):
+        super().__init__(**kwargs)
+        self._frame = frame
+
+    def get_raw_data(self):
+        return self._frame, {}
+
+
+def centered_roi(size, fraction):
+    """square roi covering `fraction` of the frame around its center"""
+    if fraction >= 1.0:
+        return None
+    half_width = int(size * fraction / 2)
+    return ROI(
+        xmin=size // 2 - half_width,
+        xmax=size // 2 + half_width,
+        ymin=size // 2 - half_width,
+        ymax=size // 2 + half_width,
+    )
+
+
+def time_stage(function, n_repeats=5):
+    """returns the median latency in [s] and the peak memory in [MB] of `function`"""
+    # warm up caches before timing
+    function()
+
+    latencies = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        function()
+        latencies += [time.perf_counter() - start]
+
+    # measure memory in a separate call, tracing slows down allocations
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return np.median(latencies), peak / 1e6
+
+
+def benchmark_case(size, roi, noise, n_restarts, fit_method, n_repeats=5):
+    """benchmark all stages for a single configuration, returns a list of rows"""
+    frame = make_frame(size, noise)
+    diagnostic = FrameDiagnostic(
+        frame,
+        screen_name="BENCHMARK",
+        n_fitting_restarts=n_restarts,
+        fit_method=fit_method,
+        visualize=False,
+    )
+    diagnostic.roi = centered_roi(size, roi)
+    img, _ = diagnostic.get_processed_image()
+    projection = np.sum(img, axis=0, dtype=np.double)
+    projection = projection - projection[:10].min()
+
+    stages = {
+        "get_processed_image": diagnostic.get_processed_image,
+        "calculate_beamsize": lambda: diagnostic.calculate_beamsize(img),
+        "fit_image": lambda: diagnostic.fit_image(img),
+        "fit_gaussian_linear_background": lambda: fit_gaussian_linear_background(
+            projection, visualize=False, n_restarts=n_restarts
+        ),
+    }
+
+    rows = []
+    for stage, function in stages.items():
+        # the single projection fit does not depend on the fit method
+        if stage == "fit_gaussian_linear_background" and fit_method != "gaussian":
+            continue
+
+        with redirect_stdout(StringIO()):
+            latency, peak_memory = time_stage(function, n_repeats)
+        rows += [
+            {
+                "stage": stage,
+                "size": size,
+                "roi": roi,
+                "noise": noise,
+                "n_restarts": n_restarts,
+                "fit_method": fit_method,
+                "latency_ms": latency * 1e3,
+                "fps": 1.0 / latency,
+                "peak_memory_mb": peak_memory,
+            }
+        ]
+
+    return rows
+
+
+def run_benchmarks(
+    sizes=(500, 1000, 2000),
+    rois=(1.0, 0.5),
+    noise_levels=(5.0, 50.0),
+    n_restarts=(1, 5),
+    fit_methods=None,
+    n_repeats=5,
+) -> pd.DataFrame:
+    """
+    benchmark all combinations of the given parameters, rois are given as the
+    fraction of the frame they cover
+    """
+    fit_methods = fit_methods or list(FIT_METHODS)
+
+    rows = []
+    for case in itertools.product(sizes, rois, noise_levels, n_restarts, fit_methods):
+        rows += benchmark_case(*case, n_repeats=n_repeats)
+
+    return pd.DataFrame(rows)
+
+
+def compare(results, baseline, tolerance=0.2) -> pd.DataFrame:
+    """
+    compare the latencies of a report to a baseline report, returns the cases
+    that are slower than the baseline by more than `tolerance` (relative)
+    """
+    keys = ["stage", "size", "roi", "noise", "n_restarts", "fit_method"]
+    merged = pd.merge(
+        results,
+        baseline,
+        on=keys,
+        suffixes=("", "_baseline"),
+    )
+    merged["slowdown"] = merged["latency_ms"] / merged["latency_ms_baseline"]
+
+    return merged[merged["slowdown"] > 1.0 + tolerance][
+        keys + ["latency_ms_baseline", "latency_ms", "slowdown"]
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 1000, 2000])
+    parser.add_argument("--rois", type=float, nargs="+", default=[1.0, 0.5])
+    parser.add_argument("--noise", type=float, nargs="+", default=[5.0, 50.0])
+    parser.add_argument("--restarts", type=int, nargs="+", default=[1, 5])
+    parser.add_argument("--fit-methods", nargs="+", default=list(FIT_METHODS))
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", help="write the report to a csv file")
+    parser.add_argument("--baseline", help="csv report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        sizes=args.sizes,
+        rois=args.rois,
+        noise_levels=args.noise,
+        n_restarts=args.restarts,
+        fit_methods=args.fit_methods,
+        n_repeats=args.repeats,
+    )
+
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(results.to_string(index=False, float_format="{:.3g}".format))
+
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+
+    if args.baseline is not None:
+        regressions = compare(results, pd.read_csv(args.baseline), args.tolerance)
+        if len(regressions):
+            print("\nregressions:")
+            print(regressions.to_string(index=False, float_format="{:.3g}".format))
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,9 +4,21 @@ from time import time
 import matplotlib.pyplot as plt
 
 import numpy as np
+import pandas as pd
+import pytest
+import torch
+from botorch.models import ModelListGP, SingleTaskGP
 
 from scripts.automatic_emittance import BaseEmittanceMeasurement, BeamlineConfig
-from scripts.characterize_emittance import characterize_emittance
+from scripts.custom_turbo import JointQuadScanTurbo
+from scripts.utils.hyperparameters import HyperparameterStore
+from scripts.utils.statistics import QuantileSketch, RunningStatistics
+import scripts.characterize_emittance as characterize
+from scripts.characterize_emittance import (
+    characterize_emittance,
+    compute_emit_bmag_quadratic,
+    compute_emit_bmag_thick_quad,
+)
 from xopt import VOCS
 
 
@@ -124,3 +136,299 @@ class TestAutomaticEmittance:
 
         os.remove(emittance_measurement.dump_file)
         plt.show()
+
+
+class TestThickQuadEmittance:
+    def test_batched_emittance(self):
+        k = torch.linspace(-10, 10, 10).double()
+        rmat = torch.tensor([[1.0, 2.0], [0.0, 1.0]]).double()
+        y_batch = torch.rand(3, 100, 10).double() * 1e-8
+
+        # two scan grids and three sets of virtual scans in a single call
+        k_batch = torch.stack((k, 0.5 * k)).unsqueeze(1)
+        emit, bmag, sig, is_valid = compute_emit_bmag_thick_quad(
+            k_batch, y_batch, 0.1, rmat, beta0=5.0, alpha0=0.5
+        )
+        assert emit.shape == (2, 3, 100, 1)
+        assert bmag.shape == (2, 3, 100, 1)
+        assert sig.shape == (2, 3, 100, 3, 1)
+        assert is_valid.shape == (2, 3, 100)
+
+        emit_single, bmag_single, _, is_valid_single = compute_emit_bmag_thick_quad(
+            0.5 * k, y_batch[2], 0.1, rmat, beta0=5.0, alpha0=0.5
+        )
+        assert torch.allclose(emit[1, 2], emit_single, equal_nan=True)
+        assert torch.allclose(bmag[1, 2], bmag_single, equal_nan=True)
+        assert torch.equal(is_valid[1, 2], is_valid_single)
+
+
+    def test_weight_space_sampling(self, monkeypatch):
+        torch.manual_seed(0)
+        k = torch.linspace(-8, 12, 12).double()
+        y = torch.sqrt(1 + 0.02 * (k - 3) ** 2) * (1 + 0.03 * torch.randn(12).double())
+
+        # sample from the same fitted model as the posterior it is compared to
+        model = characterize._fit_quad_scan_model(k, y)
+        monkeypatch.setattr(characterize, "_fit_quad_scan_model", lambda *_: model)
+        coefficients = characterize.sample_quad_scan_polynomials(
+            k, y, n_samples=100000
+        )
+
+        k_virtual = torch.linspace(-8, 12, 5).double()
+        vandermonde = torch.stack(
+            (torch.ones_like(k_virtual), k_virtual, k_virtual**2), dim=-1
+        )
+        samples = coefficients @ vandermonde.T
+        posterior = model.posterior(k_virtual.reshape(-1, 1))
+        assert torch.allclose(
+            samples.mean(dim=0), posterior.mean.detach().flatten(), rtol=1e-3
+        )
+        assert torch.allclose(
+            samples.std(dim=0),
+            posterior.variance.detach().flatten().sqrt(),
+            rtol=2e-2,
+        )
+
+        # the analytic emittance fit agrees with the fit of the evaluated scans
+        rmat = torch.tensor([[1.0, 2.0], [0.0, 1.0]]).double()
+        analytic = compute_emit_bmag_quadratic(
+            coefficients[:100], k_virtual, 0.1, rmat, beta0=5.0, alpha0=0.5
+        )
+        evaluated = compute_emit_bmag_thick_quad(
+            k_virtual, samples[:100], 0.1, rmat, beta0=5.0, alpha0=0.5
+        )
+        for a, b in zip(analytic, evaluated):
+            assert torch.allclose(a, b, equal_nan=True)
+
+
+    def test_streaming_emittance(self):
+        torch.manual_seed(0)
+        rmat = torch.tensor([[1.0, 2.0], [0.0, 1.0]]).double()
+        k = torch.linspace(-20, 20, 12).double()
+        sig = torch.tensor([[4e-8, -1e-8], [-1e-8, 1e-8]]).double()
+        transport = rmat @ characterize.build_quad_rmat(k, 0.1)
+        beam_size = torch.sqrt((transport @ sig @ transport.transpose(-1, -2))[:, 0, 0])
+        y = (beam_size * (1 + 0.03 * torch.randn(12).double())).numpy()
+
+        emit, bmag, _, _ = characterize.get_valid_emit_bmag_samples_from_quad_scan(
+            k.numpy(), y, 0.1, rmat, beta0=5.0, alpha0=0.5, n_samples=100000
+        )
+        result = characterize.stream_emit_bmag_samples_from_quad_scan(
+            k.numpy(),
+            y,
+            0.1,
+            rmat,
+            beta0=5.0,
+            alpha0=0.5,
+            n_samples=10000000,
+            chunk_size=10000,
+            rtol=1e-3,
+        )
+
+        # stops early once the quantiles have converged
+        assert result["n_samples"] < 10000000
+        assert np.all(result["emit_quantiles_sem"] < 1e-3 * result["emit_quantiles"])
+
+        quantiles = torch.quantile(
+            emit.flatten(), torch.tensor([0.05, 0.5, 0.95]).double()
+        )
+        assert np.allclose(result["emit_quantiles"], quantiles.numpy(), rtol=1e-2)
+        assert np.isclose(result["emit_var"], float(emit.var()), rtol=5e-2)
+        assert np.isclose(result["bmag_median"], float(bmag.median()), rtol=1e-2)
+
+
+    def test_batched_planes(self):
+        torch.manual_seed(0)
+        k = [torch.linspace(-8, 12, 12).double(), torch.linspace(-5, 9, 11).double()]
+        y = [
+            torch.sqrt(1 + 0.02 * (k[0] - 3) ** 2),
+            torch.sqrt(2 + 0.05 * (k[1] - 1) ** 2),
+        ]
+        y = [ele * (1 + 0.03 * torch.randn(len(ele)).double()) for ele in y]
+
+        # scans of different lengths are fit by a single padded model
+        model, k_padded = characterize._fit_batched_quad_scan_model(k, y)
+        assert k_padded.shape == (2, 14)
+        coefficients = characterize._polynomial_sampler(model, k_padded)(100000)
+        assert coefficients.shape == (2, 100000, 3)
+
+        # padding leaves the fit and the posterior of each scan unchanged
+        for i in range(2):
+            single_model = characterize._fit_quad_scan_model(k[i], y[i])
+            single = characterize._polynomial_sampler(single_model, k[i])(100000)
+            assert torch.allclose(
+                coefficients[i].mean(dim=0), single.mean(dim=0), rtol=1e-2
+            )
+            assert torch.allclose(
+                coefficients[i].std(dim=0), single.std(dim=0), rtol=2e-2
+            )
+
+
+class TestQuantileSketch:
+    def test_quantiles(self):
+        # skewed and bimodal, like emittance samples of a poorly constrained fit
+        rng = np.random.default_rng(0)
+        values = np.concatenate(
+            (rng.lognormal(size=700000), rng.normal(10.0, 0.5, size=300000))
+        )
+        rng.shuffle(values)
+
+        sketch = QuantileSketch(capacity=1024, seed=0)
+        other = QuantileSketch(capacity=1024, seed=1)
+        statistics = RunningStatistics()
+        for i, chunk in enumerate(np.split(values, 100)):
+            if i < 50:
+                sketch.update(chunk)
+            else:
+                other.update(chunk)
+            statistics.update_batch(chunk)
+        sketch.merge(other)
+
+        # memory is bounded, quantiles and rank errors are small
+        assert sketch.count == len(values)
+        assert sum(len(level) for level in sketch._levels) < 20 * 1024
+        quantiles = [0.05, 0.5, 0.95]
+        estimates = sketch.quantile(quantiles)
+        assert np.allclose(estimates, np.quantile(values, quantiles), rtol=2e-2)
+        ranks = np.searchsorted(np.sort(values), estimates) / len(values)
+        assert np.allclose(ranks, quantiles, atol=2e-3)
+
+        assert np.isclose(statistics.mean, values.mean())
+        assert np.isclose(statistics.variance, values.var(ddof=1))
+
+
+class TestJointQuadScanTurbo:
+    def test_joint_trust_region(self):
+        vocs = VOCS(
+            variables={"x": [-5, 5]},
+            objectives={"Sx": "MINIMIZE"},
+            observables=["Sx", "Sy"],
+        )
+        x = np.linspace(-5, 5, 11)
+        data = pd.DataFrame({"x": x, "Sx": (x - 2) ** 2 + 1, "Sy": (x + 1) ** 2 + 2})
+
+        turbo = JointQuadScanTurbo(vocs, length=0.2, objective_names=["Sx", "Sy"])
+        turbo.update_state(data)
+        assert turbo.centers == {"Sx": {"x": 2.0}, "Sy": {"x": -1.0}}
+        assert turbo.best_values == {"Sx": 1.0, "Sy": 2.0}
+        assert turbo.center_x == {"x": 2.0}
+
+        # trust region covers the trust regions around both minima
+        model = ModelListGP(
+            *[
+                SingleTaskGP(
+                    torch.tensor(x).reshape(-1, 1),
+                    torch.tensor(data[name].to_numpy()).reshape(-1, 1),
+                )
+                for name in vocs.output_names
+            ]
+        )
+        trust_region = turbo.get_trust_region(model)
+        assert torch.allclose(trust_region.flatten(), torch.tensor([-2.0, 3.0]).double())
+
+        # switching the active objective
+        vocs.objectives = {"Sy": "MINIMIZE"}
+        turbo.update_state(data)
+        assert turbo.center_x == {"x": -1.0}
+        assert turbo.best_value == 2.0
+
+
+class TestHyperparameterStore:
+    def test_warm_start(self, tmp_path):
+        torch.manual_seed(0)
+        k = [torch.linspace(-8, 12, 12).double(), torch.linspace(-5, 9, 11).double()]
+        y = [
+            torch.sqrt(1 + 0.02 * (k[0] - 3) ** 2),
+            torch.sqrt(2 + 0.05 * (k[1] - 1) ** 2),
+        ]
+        y = [ele * (1 + 0.03 * torch.randn(len(ele)).double()) for ele in y]
+
+        filename = os.path.join(tmp_path, "hyperparameters.json")
+        store = HyperparameterStore(filename)
+        keys = [store.key("OTRS:IN20:571", "QUAD:IN20:525", 0.135, p) for p in "xy"]
+
+        # single plane fits are stored and reloaded from file
+        model = characterize._fit_quad_scan_model(k[0], y[0], None, store, keys[0])
+        store.save()
+        store = HyperparameterStore(filename)
+        assert keys[0] in store and keys[1] not in store
+
+        warm_model = characterize._fit_quad_scan_model(
+            k[0], y[0], None, store, keys[0]
+        )
+        for a, b in zip(model.parameters(), warm_model.parameters()):
+            assert torch.allclose(a, b, atol=1e-3)
+
+        # the batched fit of both planes is warm started from the single plane fits
+        characterize._fit_quad_scan_model(k[1], y[1], None, store, keys[1])
+        batched_model, _ = characterize._fit_batched_quad_scan_model(
+            k, y, None, store, keys
+        )
+        assert torch.allclose(
+            batched_model.covar_module.outputscale[0],
+            warm_model.covar_module.outputscale,
+            rtol=1e-2,
+        )
+
+    def test_unreadable_file(self, tmp_path):
+        filename = os.path.join(tmp_path, "hyperparameters.json")
+        store = HyperparameterStore(filename)
+        key = store.key("OTRS:IN20:571", "QUAD:IN20:525", 0.135, "x")
+        store.entries[key] = {"beam_size": {"mean_module.constant": [1.0]}}
+        store.save()
+        assert os.listdir(tmp_path) == ["hyperparameters.json"]
+
+        # a file truncated by an interrupted write is a cold start
+        with open(filename, "r+") as f:
+            f.truncate(10)
+        with pytest.warns(UserWarning):
+            store = HyperparameterStore(filename)
+        assert store.entries == {}
+
+        store.entries[key] = {}
+        store.save()
+        assert key in HyperparameterStore(filename)
+
+
+class TestSyntheticBeam:
+    def test_synthetic_beam(self):
+        from scripts.synthetic_emittance import SyntheticImageDiagnostic
+        from scripts.utils.synthetic import SyntheticBeam
+
+        beamline_config = BeamlineConfig(
+            scan_quad_pv="x",
+            scan_quad_range=[-5, 5],
+            scan_quad_length=0.1,
+            transport_matrix_x=[[1.0, 2.0], [0.0, 1.0]],
+            transport_matrix_y=[[1.0, 2.0], [0.0, 1.0]],
+            beam_energy=0.1,
+        )
+        beam = SyntheticBeam(
+            beamline_config=beamline_config,
+            beta_x=5.0,
+            emittance_x=1.0,
+            beta_y=5.0,
+            emittance_y=1.0,
+            shape=[400, 400],
+            resolution=20.0,
+            frame_rate=100.0,
+            seed=0,
+        )
+
+        # quad off: drift of 2.1 m, sigma_11 = emittance * (beta + L^2 / beta)
+        emittance = 1e-6 / (0.1 / 0.511e-3)
+        expected = np.sqrt(emittance * (5.0 + 2.1**2 / 5.0))
+        assert np.allclose(beam.beam_sizes(0.0), expected)
+
+        # focusing in x defocuses in y
+        beam.set_pv("x", 2.0)
+        sx, sy = beam.beam_sizes()
+        assert sx != sy
+
+        diagnostic = SyntheticImageDiagnostic(
+            screen_name="test", beam=beam, fit_method="moments"
+        )
+        beam.set_pv("x", 0.0)
+        results = diagnostic.measure_beamsize(2)
+        assert np.allclose(results["Sx"], expected * 1e6, rtol=0.05)
+        assert np.allclose(results["Sy"], expected * 1e6, rtol=0.05)
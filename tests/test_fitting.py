@@ -4,7 +4,12 @@ import matplotlib.pyplot as plt
 
 import numpy as np
 
-from scripts.utils.fitting_methods import fit_gaussian_linear_background
+from scripts.utils.fitting_methods import (
+    FIT_METHODS,
+    fit_gaussian_linear_background,
+    fit_gaussian_linear_background_batch,
+    fit_gaussian_linear_background_lm,
+)
 
 
 class TestImageFitting:
@@ -21,3 +26,57 @@ class TestImageFitting:
             fit_gaussian_linear_background(x_projection)
 
         plt.show()
+
+    def test_batch_fitting(self):
+        x = np.arange(200)
+        sigmas = [10.0, 15.0, 20.0]
+        projections = [
+            1000.0 * np.exp(-((x - 100) ** 2) / 2 / sigma**2) for sigma in sigmas
+        ]
+
+        # projections may differ in length, a flat projection has no valid fit
+        projections += [projections[0][50:150], np.zeros(120), projections[1]]
+
+        lbfgs = FIT_METHODS["gaussian_lbfgs"]
+        for fit in [fit_gaussian_linear_background_batch, lbfgs]:
+            params, is_valid = fit(projections, n_restarts=3)
+            assert params.shape == (6, 4)
+            assert np.all(is_valid == [True, True, True, True, False, True])
+            assert np.all(np.isnan(params[4]))
+
+            # fits are done on smoothed projections (gaussian_filter, sigma = 3)
+            expected_sigmas = np.sqrt(np.array(sigmas + [10.0]) ** 2 + 3.0**2)
+            assert np.allclose(params[:4, 2], expected_sigmas, rtol=0.05)
+            assert np.allclose(params[:4, 1], [100, 100, 100, 50], atol=1.0)
+
+            # every fit converges, identical projections give the same fit
+            assert np.allclose(params[5], params[1], rtol=1e-5, atol=1e-3)
+
+    def test_fast_fit_methods(self):
+        rng = np.random.default_rng(0)
+        x = np.arange(300)
+        sigmas = np.array([5.0, 12.0, 30.0])
+        projections = [
+            2000.0 * np.exp(-((x - 140) ** 2) / 2 / sigma**2) + rng.normal(0, 5, 300)
+            for sigma in sigmas
+        ]
+        projections += [rng.normal(0, 5, 100)]
+
+        for name in ["moments", "log_parabola"]:
+            params, is_valid = FIT_METHODS[name](projections)
+            assert np.all(is_valid == [True, True, True, False])
+            assert np.allclose(params[:3, 1], 140, atol=0.5)
+            assert np.allclose(params[:3, 2], sigmas, rtol=0.05)
+
+    def test_levenberg_marquardt(self):
+        rng = np.random.default_rng(0)
+        x = np.arange(200)
+        y = 1000.0 * np.exp(-((x - 80) ** 2) / 2 / 12.0**2) + rng.normal(0, 5, 200)
+
+        candidate = fit_gaussian_linear_background_lm(y, visualize=False)
+        assert np.allclose(candidate[:3], [1000.0, 80.0, 12.0], rtol=0.02)
+
+        params, is_valid = FIT_METHODS["gaussian_lm"]([y, y[20:150], np.zeros(50)])
+        assert np.all(is_valid == [True, True, False])
+        assert np.allclose(params[:2, 1], [80.0, 60.0], atol=0.5)
+        assert np.allclose(params[:2, 2], 12.0, rtol=0.02)
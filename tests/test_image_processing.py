@@ -1,18 +1,117 @@
 import os
 
+import h5py
 import numpy as np
+import pytest
+import torch
 import yaml
+from matplotlib import pyplot as plt
 
-from scripts.image import ImageDiagnostic
-from scripts.utils.read_files import read_file
+from scripts.image import ImageDiagnostic, ROI
+from scripts.image_group import ImageDiagnosticGroup
+from scripts.utils.archive import ImageArchive
+from scripts.utils.camera import FrameBuffer
+from scripts.utils.read_files import build_index, query_frames, read_file
+from scripts.utils.shot_results import ShotResults
+from scripts.utils.statistics import RunningMedian, RunningStatistics
+from scripts.utils.writer import AsyncWriter
+
+TEST_CONFIG = os.path.join(os.path.dirname(__file__), "TEST_config.yml")
+
+
+class TestFrameBuffer:
+    def test_unique_frames(self):
+        buffer = FrameBuffer(maxlen=3)
+        assert buffer.push(np.zeros(1), key=1)
+        assert not buffer.push(np.zeros(1), key=1)
+        assert buffer.push(np.ones(1), key=2)
+        assert len(buffer) == 2
+
+        assert buffer.pop(timeout=0.1)[0] == 0.0
+        assert buffer.pop(timeout=0.1)[0] == 1.0
+        with pytest.raises(TimeoutError):
+            buffer.pop(timeout=0.01)
+
+    def test_bounded(self):
+        buffer = FrameBuffer(maxlen=2)
+        for i in range(5):
+            buffer.push(i, key=i)
+
+        # the oldest frames are dropped
+        assert [buffer.pop(), buffer.pop()] == [3, 4]
+
+
+class TestRunningStatistics:
+    def test_welford(self):
+        rng = np.random.default_rng(0)
+        frames = rng.integers(0, 4096, size=(50, 20, 30), dtype=np.uint16)
+
+        statistics = RunningStatistics()
+        for frame in frames[:20]:
+            statistics.update(frame)
+        other = RunningStatistics()
+        for frame in frames[20:]:
+            other.update(frame)
+        statistics.merge(other)
+
+        assert statistics.count == 50
+        assert np.allclose(statistics.mean, frames.mean(axis=0))
+        assert np.allclose(statistics.variance, frames.var(axis=0, ddof=1))
+
+    def test_median_and_hot_pixels(self):
+        rng = np.random.default_rng(0)
+        frames = rng.normal(100.0, 5.0, size=(200, 20, 30))
+        frames[::10] += 1000.0
+        frames[:, 3, 4] += 500.0
+
+        statistics = RunningStatistics()
+        median = RunningMedian(base=5)
+        for frame in frames:
+            statistics.update(frame)
+            median.update(frame)
+
+        # the median estimate is robust to the outlier frames
+        assert np.allclose(median.median, np.median(frames, axis=0), atol=3.0)
+        assert np.argwhere(statistics.hot_pixels()).tolist() == [[3, 4]]
+
+
+class TestShotResults:
+    def test_columns(self):
+        shots = [
+            {"Sx": 1.0, "Sy": 2.0, "quad": 0.5, "waveform": np.arange(3)},
+            {"Sx": 3.0, "Sy": None, "quad": 0.5, "waveform": np.arange(3)},
+        ]
+        results = ShotResults.from_shots(shots)
+        results["save_filename"] = "test.h5"
+
+        assert isinstance(results, dict)
+        assert results.n_shots == 2
+        assert results["Sx"].dtype == np.double
+        assert np.isnan(results["Sy"][1])
+        assert results["waveform"].shape == (2, 3)
+        assert results.numerical_columns == ["Sx", "Sy", "quad"]
+
+        assert results.mean()["Sx"] == 2.0
+        assert results.sem()["Sx"] == 1.0
+        assert np.isnan(results.sem()["Sy"])
+
+        statistics = results.statistics()
+        assert statistics["Sx"] == 2.0
+        assert statistics["Sx_var"] == 1.0
+        assert statistics["save_filename"] == "test.h5"
+
+        data = results.to_dataframe()
+        assert len(data) == 2
+        assert list(data["save_filename"]) == ["test.h5"] * 2
+        assert np.all(data["waveform"].iloc[1] == np.arange(3))
 
 
 class TestImageDiagnostic:
     def test_load_from_file(self):
-        ImageDiagnostic.parse_obj(yaml.safe_load(open("TEST_config.yml")))
+        ImageDiagnostic.parse_obj(yaml.safe_load(open(TEST_CONFIG)))
 
     def test_statistics(self):
-        diagnostic = ImageDiagnostic.parse_obj(yaml.safe_load(open("TEST_config.yml")))
+        diagnostic = ImageDiagnostic.parse_obj(yaml.safe_load(open(TEST_CONFIG)))
         diagnostic.return_statistics = True
 
         result = diagnostic.measure_beamsize(5)
@@ -21,7 +120,7 @@ class TestImageDiagnostic:
         assert isinstance(result["Sx"], float)
 
     def test_image_saving(self):
-        diagnostic = ImageDiagnostic.parse_obj(yaml.safe_load(open("TEST_config.yml")))
+        diagnostic = ImageDiagnostic.parse_obj(yaml.safe_load(open(TEST_CONFIG)))
 
         # set save image location
         diagnostic.save_image_location = os.getcwd()
@@ -34,6 +133,483 @@ class TestImageDiagnostic:
 
         os.remove(result["save_filename"])
 
+    def test_image_archive(self, tmp_path):
+        diagnostic = ImageDiagnostic(
+            screen_name="TEST",
+            testing=True,
+            visualize=False,
+            wait_time=0.01,
+            save_image_location=str(tmp_path),
+            save_mode="archive",
+        )
+
+        first = diagnostic.measure_beamsize(3, quad=0.0)
+        second = diagnostic.measure_beamsize(1, quad=1.0)
+        assert first["save_filename"] == second["save_filename"]
+        assert first["save_index"] == [0, 1, 2]
+        assert second["save_index"] == 3
+
+        # the archive is readable while the run is in progress
+        with h5py.File(first["save_filename"], "r", swmr=True) as f:
+            assert f["images"].shape[0] == 4
+            assert np.allclose(f["metadata/quad"][:], [0.0, 0.0, 0.0, 1.0])
+            assert np.allclose(f["metadata/Sx"][:3], first["Sx"])
+
+        diagnostic.close_archive()
+
+    def test_archive_new_columns(self, tmp_path):
+        archive = ImageArchive(str(tmp_path / "run.h5"))
+        archive.append(np.zeros((2, 4, 4)), [{"quad": 0.0}, {"quad": 1.0}])
+
+        # metadata with columns that are not in the archive is not written
+        with pytest.raises(ValueError):
+            archive.append(np.ones((1, 4, 4)), [{"quad": 2.0, "Sx": 1.0}])
+        assert len(archive) == 2
+        assert archive._file["metadata/quad"].shape == (2,)
+        archive.close()
+
+        # a diagnostic starts a new run when the columns change
+        diagnostic = ImageDiagnostic(
+            screen_name="TEST",
+            testing=True,
+            visualize=False,
+            wait_time=0.01,
+            save_image_location=str(tmp_path),
+            save_mode="archive",
+        )
+        unfitted = diagnostic.measure_beamsize(1, fit_image=False)
+        fitted = diagnostic.measure_beamsize(1)
+        diagnostic.close_archive()
+        assert unfitted["save_filename"] != fitted["save_filename"]
+        with h5py.File(fitted["save_filename"], "r") as f:
+            assert "Sx" in f["metadata"]
+
+    def test_archive_raw_frames(self, tmp_path):
+        diagnostic = ImageDiagnostic(
+            screen_name="TEST",
+            testing=True,
+            visualize=False,
+            wait_time=0.01,
+            roi=ROI(xmin=700, xmax=1300, ymin=600, ymax=1400),
+            bin_factor=2,
+            save_image_location=str(tmp_path),
+            save_mode="archive",
+        )
+        outputs = diagnostic.measure_beamsize(2)
+        diagnostic.close_archive()
+
+        # the archive keeps the full frames, not the cropped and binned images
+        raw, _ = diagnostic.get_raw_data()
+        with h5py.File(outputs["save_filename"], "r") as f:
+            assert f["images"].shape == (2, *raw.shape)
+            assert f["images"].dtype == raw.dtype
+            assert np.array_equal(f["images"][0], raw)
+
+    def test_run_index(self, tmp_path):
+        kwargs = {
+            "screen_name": "TEST",
+            "testing": True,
+            "visualize": False,
+            "wait_time": 0.01,
+            "save_image_location": str(tmp_path),
+        }
+        diagnostic = ImageDiagnostic(save_mode="archive", **kwargs)
+        for quad in [-1.0, 0.0, 1.0]:
+            diagnostic.measure_beamsize(2, quad=quad)
+        diagnostic.close_archive()
+
+        legacy = ImageDiagnostic(**kwargs).measure_beamsize(2, quad=0.5)
+
+        index = build_index(str(tmp_path))
+        assert len(index) == 8
+        assert np.allclose(np.sort(index["quad"]), [-1, -1, 0, 0, 0.5, 0.5, 1, 1])
+
+        images, rows = query_frames(index, quad=(-0.1, 0.6))
+        assert images.shape == (4, 2000, 2000)
+        assert set(rows["quad"]) == {0.0, 0.5}
+
+        # an empty selection is an empty stack of frames
+        images, rows = query_frames(index, quad=(2.0, 3.0))
+        assert images.shape == (0, 2000, 2000)
+        assert images.dtype == read_file(legacy["save_filename"])["images"].dtype
+        assert len(rows) == 0
+
+        file_info = read_file(legacy["save_filename"], frames=None)
+        assert file_info["images"] is None
+        assert file_info["resolution"] == 1.0
+
+    def test_async_saving(self, tmp_path):
+        diagnostic = ImageDiagnostic(
+            screen_name="TEST",
+            testing=True,
+            visualize=False,
+            wait_time=0.01,
+            save_image_location=str(tmp_path),
+            save_mode="archive",
+            async_save=True,
+        )
+
+        indices = [diagnostic.measure_beamsize(2)["save_index"] for _ in range(3)]
+        assert indices == [[0, 1], [2, 3], [4, 5]]
+
+        fname = diagnostic.archive.fname
+        diagnostic.close_archive()
+        with h5py.File(fname, "r") as f:
+            assert f["images"].shape[0] == 6
+
+    def test_async_writer_error(self):
+        def fail():
+            raise OSError("disk full")
+
+        writer = AsyncWriter(maxsize=1)
+        writer.submit(fail)
+        with pytest.raises(RuntimeError):
+            writer.flush()
+        writer.close()
+
+    def test_pipelined_acquisition(self):
+        kwargs = {
+            "screen_name": "TEST",
+            "testing": True,
+            "visualize": False,
+            "wait_time": 0.01,
+        }
+        torch.manual_seed(0)
+        serial = ImageDiagnostic(**kwargs).measure_beamsize(3)
+
+        torch.manual_seed(0)
+        diagnostic = ImageDiagnostic(pipelined=True, n_workers=1, **kwargs)
+        pipelined = diagnostic.measure_beamsize(3)
+
+        for name in ["Cx", "Cy", "Sx", "Sy", "bb_penalty", "total_intensity"]:
+            assert np.allclose(serial[name], pipelined[name])
+
+        # with tracking, all shots of a pipelined measurement use the same window
+        kwargs |= {"track_roi": True, "fit_method": "moments"}
+        serial_diagnostic = ImageDiagnostic(**kwargs)
+        diagnostic = ImageDiagnostic(pipelined=True, n_workers=3, **kwargs)
+        for _ in range(2):
+            serial = serial_diagnostic.measure_beamsize(4)
+            pipelined = diagnostic.measure_beamsize(4)
+            for name in ["Cx", "Cy", "Sx", "Sy", "bb_penalty", "total_intensity"]:
+                assert np.array_equal(serial[name], pipelined[name])
+        assert diagnostic._tracking_window((2000, 2000)) is not None
+
+    def test_background_cache(self, tmp_path):
+        background_file = os.path.join(tmp_path, "TEST_background.npy")
+        np.save(background_file, np.full((2000, 2000), 0.25))
+
+        diagnostic = ImageDiagnostic(
+            screen_name="TEST", testing=True, background_file=background_file
+        )
+        img, _ = diagnostic.get_processed_image()
+        assert img.shape == (2000, 2000)
+        assert np.isclose(img.max(), 0.75)
+        assert np.isclose(img.min(), 0.0)
+
+        # changing the roi or the background file invalidates the cache
+        diagnostic.roi = ROI(xmin=900, xmax=1100, ymin=900, ymax=1000)
+        img, _ = diagnostic.get_processed_image()
+        assert img.shape == (200, 100)
+        assert np.allclose(img, 0.75)
+
+        new_background_file = os.path.join(tmp_path, "TEST_background_2.npy")
+        np.save(new_background_file, np.full((2000, 2000), 0.5))
+        diagnostic.background_file = new_background_file
+        img, _ = diagnostic.get_processed_image()
+        assert np.allclose(img, 0.5)
+
+    def test_native_dtype_preprocessing(self, tmp_path):
+        class IntegerImageDiagnostic(ImageDiagnostic):
+            def get_raw_data(self):
+                img = np.full((200, 300), 100, dtype=np.uint16)
+                img[50:150, 100:200] = 1000
+                return img, {}
+
+        background_file = os.path.join(tmp_path, "TEST_background.npy")
+        np.save(background_file, np.full((200, 300), 120.4))
+
+        diagnostic = IntegerImageDiagnostic(
+            screen_name="TEST",
+            background_file=background_file,
+            threshold=10.0,
+            roi=ROI(xmin=0, xmax=200, ymin=50, ymax=250),
+        )
+        img, _ = diagnostic.get_processed_image()
+
+        # background and threshold are subtracted without wrapping around zero
+        assert img.dtype == np.uint16
+        assert img.shape == (200, 200)
+        assert img.min() == 0
+        assert img.max() == 1000 - 130
+
+    @pytest.mark.parametrize("threshold", [0.4, 2.5])
+    def test_fractional_threshold(self, threshold):
+        xx, yy = np.meshgrid(np.arange(200), np.arange(200))
+        frame = np.rint(500 * np.exp(-((xx - 120) ** 2 + (yy - 90) ** 2) / 200))
+
+        class FrameDiagnostic(ImageDiagnostic):
+            dtype: str = "uint16"
+
+            def get_raw_data(self):
+                return frame.astype(self.dtype), {}
+
+        results = {}
+        for dtype in ["uint16", "float64"]:
+            diagnostic = FrameDiagnostic(
+                screen_name="TEST",
+                threshold=threshold,
+                dtype=dtype,
+                fit_method="moments",
+                visualize=False,
+                wait_time=0.01,
+            )
+            results[dtype] = diagnostic.measure_beamsize(1)
+
+        # the fractional part of the threshold is not lost on integer frames
+        expected = np.maximum(frame - threshold, 0).sum()
+        for dtype in ["uint16", "float64"]:
+            assert np.isclose(results[dtype]["total_intensity"], expected)
+        for name in ["Cx", "Cy", "Sx", "Sy"]:
+            assert np.isclose(results["uint16"][name], results["float64"][name])
+
+    def test_binning(self):
+        kwargs = {
+            "screen_name": "TEST",
+            "testing": True,
+            "visualize": False,
+            "wait_time": 0.01,
+        }
+        full = ImageDiagnostic(**kwargs).measure_beamsize(1)
+        binned = ImageDiagnostic(binning=4, **kwargs).measure_beamsize(1)
+
+        # results are reported in units of the unbinned frame
+        for name in ["Cx", "Cy", "Sx", "Sy"]:
+            assert np.isclose(full[name], binned[name], rtol=1e-2)
+        assert np.isclose(full["total_intensity"], binned["total_intensity"])
+
+        diagnostic = ImageDiagnostic(binning="auto", **kwargs)
+        assert diagnostic.bin_factor == 1
+        diagnostic.measure_beamsize(1)
+        assert diagnostic.bin_factor == 4
+
+    def test_binned_preprocessing(self, tmp_path):
+        class IntegerImageDiagnostic(ImageDiagnostic):
+            def get_raw_data(self):
+                img = np.full((200, 300), 60000, dtype=np.uint16)
+                return img, {}
+
+        background_file = os.path.join(tmp_path, "TEST_background.npy")
+        np.save(background_file, np.full((200, 300), 100.0))
+
+        diagnostic = IntegerImageDiagnostic(
+            screen_name="TEST",
+            background_file=background_file,
+            threshold=10.0,
+            binning=2,
+        )
+        img, _ = diagnostic.get_processed_image()
+
+        # binned pixels are summed in a wider dtype, background and threshold
+        # are binned as well
+        assert img.dtype == np.uint32
+        assert img.shape == (100, 150)
+        assert np.all(img == 4 * (60000 - 110))
+
+    def test_hot_pixels(self, tmp_path):
+        class HotPixelDiagnostic(ImageDiagnostic):
+            def get_raw_data(self):
+                img = np.full((20, 30), 1000, dtype=np.uint16)
+                img[5, 6] = 4000
+                img[0, 0] = 60000
+                return img, {}
+
+        background = np.full((20, 30), 100.0)
+        background[5, 6] = 3000.0
+        hot_pixels = np.zeros((20, 30), dtype=bool)
+        hot_pixels[5, 6] = hot_pixels[0, 0] = True
+        background_file = os.path.join(tmp_path, "TEST_background.npy")
+        hot_pixel_file = os.path.join(tmp_path, "TEST_hot_pixels.npy")
+        np.save(background_file, background)
+        np.save(hot_pixel_file, hot_pixels)
+
+        diagnostic = HotPixelDiagnostic(
+            screen_name="TEST",
+            background_file=background_file,
+            hot_pixel_file=hot_pixel_file,
+        )
+        img, _ = diagnostic.get_processed_image()
+
+        # hot pixels of the frame and the background are replaced by the median
+        # of their neighbours, the raw frame is not changed
+        assert img.dtype == np.uint16
+        assert np.all(img == 900)
+        assert diagnostic.get_raw_data()[0][5, 6] == 4000
+
+    def test_windowed_preprocessing(self, tmp_path):
+        rng = np.random.default_rng(0)
+        raw = rng.integers(0, 4096, size=(200, 300), dtype=np.uint16)
+        background_file = os.path.join(tmp_path, "TEST_background.npy")
+        np.save(background_file, rng.uniform(0.0, 200.0, size=(200, 300)))
+        hot_pixel_file = os.path.join(tmp_path, "TEST_hot_pixels.npy")
+        np.save(hot_pixel_file, rng.uniform(size=(200, 300)) > 0.99)
+
+        diagnostic = ImageDiagnostic(
+            screen_name="TEST",
+            background_file=background_file,
+            hot_pixel_file=hot_pixel_file,
+            threshold=10.0,
+            roi=ROI(xmin=20, xmax=180, ymin=30, ymax=270),
+            binning=2,
+        )
+        assert diagnostic._processed_shape(raw.shape) == (80, 120)
+
+        # preprocessing the window of a frame matches cropping the processed image
+        window = (slice(11, 47), slice(5, 90))
+        assert np.array_equal(
+            diagnostic._preprocess(raw, window), diagnostic._preprocess(raw)[window]
+        )
+
+    def test_roi_tracking(self):
+        class MovingBeamDiagnostic(ImageDiagnostic):
+            position: int = 200
+
+            def get_raw_data(self):
+                x, y = np.meshgrid(np.arange(400), np.arange(400))
+                img = 100.0 * np.exp(
+                    -((x - self.position) ** 2) / 2 / 10**2 - (y - 200) ** 2 / 2 / 20**2
+                )
+                return img, {}
+
+        diagnostic = MovingBeamDiagnostic(
+            screen_name="TEST",
+            visualize=False,
+            wait_time=0.01,
+            fit_method="moments",
+            track_roi=True,
+        )
+        first = diagnostic.measure_beamsize(1)
+        window = diagnostic._tracking_window((400, 400))
+        assert window is not None
+
+        # frames are cropped to the window before preprocessing
+        images, _, _, capture_window = diagnostic._capture(1)
+        assert capture_window == window
+        assert np.array_equal(images[0], diagnostic.get_processed_image()[0][window])
+
+        # beam inside the window gives the same result as the full roi
+        second = diagnostic.measure_beamsize(1)
+        for name in ["Cx", "Cy", "Sx", "Sy", "total_intensity"]:
+            assert np.isclose(first[name], second[name])
+
+        # beam outside of the window falls back to the full roi
+        diagnostic.position = 100
+        moved = diagnostic.measure_beamsize(1)
+        assert np.isclose(moved["Cx"], 100.0, atol=0.1)
+        assert diagnostic._tracking_window((400, 400)) != window
+
+    def test_tracked_intensity(self):
+        class PedestalDiagnostic(ImageDiagnostic):
+            def get_raw_data(self):
+                x, y = np.meshgrid(np.arange(400), np.arange(400))
+                img = 1.0 + 100.0 * np.exp(
+                    -((x - 200) ** 2) / 2 / 10**2 - (y - 200) ** 2 / 2 / 20**2
+                )
+                return img, {}
+
+        kwargs = {
+            "screen_name": "TEST",
+            "visualize": False,
+            "wait_time": 0.01,
+            "fit_method": "moments",
+        }
+        untracked = PedestalDiagnostic(**kwargs).measure_beamsize(1)
+
+        diagnostic = PedestalDiagnostic(track_roi=True, **kwargs)
+        diagnostic.measure_beamsize(1)
+        images, _, _, window = diagnostic._capture(1)
+        assert window is not None
+        assert images[0].sum() < 0.9 * untracked["total_intensity"]
+
+        # the intensity of a shot cropped to the window is that of the full roi
+        tracked = diagnostic.measure_beamsize(1)
+        assert np.isclose(tracked["total_intensity"], untracked["total_intensity"])
+        assert np.isclose(tracked["Sx"], untracked["Sx"])
+
+    def test_adaptive_shots(self):
+        class JitterDiagnostic(ImageDiagnostic):
+            jitter: float = 0.0
+            intensity: float = 100.0
+
+            def get_raw_data(self):
+                sigma = 10.0 * (1.0 + self.jitter * np.random.randn())
+                x, y = np.meshgrid(np.arange(200), np.arange(200))
+                img = self.intensity * np.exp(
+                    -((x - 100) ** 2) / 2 / sigma**2 - (y - 100) ** 2 / 2 / 15**2
+                )
+                return img, {}
+
+        diagnostic = JitterDiagnostic(
+            screen_name="TEST",
+            visualize=False,
+            wait_time=0.01,
+            fit_method="moments",
+            adaptive_shots=True,
+            min_shots=3,
+            max_shots=8,
+        )
+
+        # a stable beam converges after the minimum number of shots
+        result = diagnostic.measure_beamsize()
+        assert len(result["Sx"]) == 3
+
+        # a jittering beam needs more shots
+        np.random.seed(0)
+        diagnostic.jitter = 0.5
+        result = diagnostic.measure_beamsize()
+        assert len(result["Sx"]) == 8
+
+        # sequences without any valid shot are abandoned
+        diagnostic.intensity = 0.01
+        result = diagnostic.measure_beamsize()
+        assert len(result["Sx"]) == 3
+        assert np.all(np.isnan(result["Sx"]))
+
+        with pytest.raises(ValueError):
+            JitterDiagnostic(screen_name="TEST", min_shots=5, max_shots=3)
+
+    def test_rendering(self, tmp_path):
+        kwargs = {
+            "screen_name": "TEST",
+            "testing": True,
+            "wait_time": 0.01,
+            "fit_method": "moments",
+            "figure_cache_size": 2,
+        }
+        n_figures = len(plt.get_fignums())
+
+        # figures are only rendered on demand and the cache is bounded
+        diagnostic = ImageDiagnostic(**kwargs)
+        diagnostic.measure_beamsize(3)
+        assert len(plt.get_fignums()) == n_figures
+        assert len(diagnostic.render()) == 2
+
+        # background rendering saves figures to disk
+        diagnostic = ImageDiagnostic(
+            render_mode="background", figure_location=str(tmp_path), **kwargs
+        )
+        diagnostic.measure_beamsize(3)
+        assert len(diagnostic.render()) == 2
+        assert len(os.listdir(tmp_path)) == 3
+        assert len(plt.get_fignums()) == n_figures
+
+    def test_measure_background(self, tmp_path):
+        diagnostic = ImageDiagnostic(screen_name="TEST", testing=True, wait_time=0.01)
+        background = diagnostic.measure_background(3, str(tmp_path), use_median=True)
+
+        assert np.allclose(background, np.load(diagnostic.background_file))
+        assert np.load(diagnostic.hot_pixel_file).shape == background.shape
+
     def test_fitting_fail(self):
         class BadImageDiagnostic(ImageDiagnostic):
             def fit_image(self, img):
@@ -51,3 +627,27 @@ class TestImageDiagnostic:
         bad_image_diagnostic = BadImageDiagnostic(screen_name="TEST")
         result = bad_image_diagnostic.calculate_beamsize(np.ones((20, 20)))
         assert result["Cx"] == np.Nan
+
+
+class TestImageDiagnosticGroup:
+    def test_group_measurement(self):
+        kwargs = {
+            "screen_name": "TEST",
+            "testing": True,
+            "visualize": False,
+            "wait_time": 0.01,
+            "fit_method": "moments",
+        }
+        group = ImageDiagnosticGroup(
+            diagnostics={
+                "OTR2": ImageDiagnostic(**kwargs),
+                "OTR3": ImageDiagnostic(binning=2, **kwargs),
+            }
+        )
+        result = group.measure_beamsize(2)
+        single = ImageDiagnostic(**kwargs).measure_beamsize(2)
+        group.close()
+
+        for name in ["OTR2", "OTR3"]:
+            assert np.allclose(result[f"{name}_Sx"], single["Sx"], rtol=1e-2)
+            assert len(result[f"{name}_ICT1"]) == 2